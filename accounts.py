@@ -0,0 +1,130 @@
+"""Deleting accounts.
+
+Deleting a user row cascades through every message, like, follow and
+timeline entry that refers to it, all in one transaction. For a busy
+account that transaction runs long and holds locks on rows other users are
+writing. Instead, `disable_user` marks the account disabled -- it can no
+longer log in, and its profile and directory entry are gone -- and queues
+a job (see jobs.py) that deletes its rows in batches of PURGE_BATCH_SIZE,
+one transaction each. Each batch adjusts the counters of the other users
+it touches (see counters.py). The user row goes last.
+
+The account's messages stay visible until the purge reaches them, except
+in search results (see search.py); their timeline entries are removed
+first.
+"""
+
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+from counters import counters_changed
+from jobs import enqueue, job
+from models import db, Follows, Likes, Message, TimelineEntry, User
+from user_cache import current_users
+
+DEFAULT_BATCH_SIZE = 1000
+
+USERS = User.__table__
+FOLLOWS = Follows.__table__
+LIKES = Likes.__table__
+MESSAGES = Message.__table__
+TIMELINE = TimelineEntry.__table__
+
+
+def disable_user(user):
+    """Disable `user` and queue the purge of their rows; caller commits."""
+
+    user.disabled_at = datetime.utcnow()
+    enqueue('purge-user', user_id=user.id)
+
+
+def _purge_batch(table, where, batch_size, counter=None, owner=None):
+    """Delete up to `batch_size` rows of `table` matching `where`.
+
+    With `counter`, first decrements that counter of the user each row's
+    `owner` column refers to. Commits, and returns the number of rows
+    deleted.
+    """
+
+    keys = list(table.primary_key.columns)
+    columns = keys + ([owner] if owner is not None else [])
+
+    # locked, so a concurrent delete can't make the counters count it twice
+    rows = db.session.execute(
+        db.select(columns).where(where).limit(batch_size)
+        .with_for_update()).fetchall()
+    if not rows:
+        return 0
+
+    counts = Counter(row[owner] for row in rows) if counter else {}
+    by_count = defaultdict(list)
+    for user_id, count in counts.items():
+        by_count[count].append(user_id)
+
+    for count, user_ids in by_count.items():
+        db.session.execute(
+            USERS.update()
+            .where(USERS.c.id.in_(user_ids))
+            .values({counter: USERS.c[counter] - count}))
+
+    if len(keys) == 1:
+        key, values = keys[0], [row[0] for row in rows]
+    else:
+        key = tuple_(*keys)
+        values = [tuple(row[:len(keys)]) for row in rows]
+
+    db.session.execute(table.delete().where(key.in_(values)))
+    db.session.commit()
+
+    if counts:
+        counters_changed.send(db.session, user_ids=set(counts))
+
+    return len(rows)
+
+
+@job('purge-user')
+def purge_user(user_id, batch_size=None):
+    """Delete disabled user `user_id` and everything of theirs, in batches.
+
+    Returns the number of rows deleted. Safe to run again after an
+    interruption: each step picks up the rows that are left.
+    """
+
+    batch_size = batch_size or db.get_app().config.get('PURGE_BATCH_SIZE',
+                                                       DEFAULT_BATCH_SIZE)
+
+    user = User.query.get(user_id)
+    if user is None or user.disabled_at is None:
+        return 0
+
+    authored = db.select([MESSAGES.c.id]).where(MESSAGES.c.user_id == user_id)
+
+    # (table, rows, counter to decrement, user whose counter it is)
+    steps = [
+        (TIMELINE, TIMELINE.c.user_id == user_id, None, None),
+        (TIMELINE, TIMELINE.c.message_id.in_(authored), None, None),
+        (LIKES, LIKES.c.message_id.in_(authored),
+         'like_count', LIKES.c.user_id),
+        (LIKES, LIKES.c.user_id == user_id, None, None),
+        (FOLLOWS, FOLLOWS.c.user_following_id == user_id,
+         'follower_count', FOLLOWS.c.user_being_followed_id),
+        (FOLLOWS, FOLLOWS.c.user_being_followed_id == user_id,
+         'following_count', FOLLOWS.c.user_following_id),
+        (MESSAGES, MESSAGES.c.user_id == user_id, None, None),
+    ]
+
+    purged = 0
+    for table, where, counter, owner in steps:
+        while True:
+            deleted = _purge_batch(table, where, batch_size, counter, owner)
+            purged += deleted
+            if deleted < batch_size:
+                break
+
+    db.session.execute(USERS.delete().where(USERS.c.id == user_id))
+    db.session.commit()
+    current_users.invalidate(user_id)
+
+    return purged + 1
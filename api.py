@@ -0,0 +1,270 @@
+"""Compact JSON for Warbler's API (the /api routes in app.py).
+
+The API lists the same messages as the HTML pages, through the same
+timeline functions, but selects only the columns a response needs. Rows
+come back as plain tuples rather than Message or User objects, and are
+written to the client as they're serialized rather than collected into one
+big document first.
+
+Clients choose what they get with `?fields=id,text,username` and page with
+the `next` cursor of the previous response, passed back as `?before=` for
+messages or `?after=` for users. `?limit=` asks for up to
+API_MAX_PAGE_SIZE items a page. Responses are encoded with orjson when it's
+installed, and the stdlib json module otherwise.
+"""
+
+import json
+from datetime import datetime
+
+from flask import Response, current_app, request, stream_with_context
+
+from models import db, Follows, Message, User
+from timelines import decode_cursor, page_size
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DEFAULT_MAX_PAGE_SIZE = 500
+
+# rows serialized per chunk written to the client
+ROWS_PER_CHUNK = 100
+
+# rows fetched from the database at a time when streaming users
+ROWS_PER_FETCH = 500
+
+MESSAGE_FIELDS = {
+    'id': Message.id,
+    'text': Message.text,
+    'timestamp': Message.timestamp,
+    'user_id': Message.user_id,
+    'username': User.username,
+    'image_url': User.image_url,
+}
+
+USER_FIELDS = {
+    'id': User.id,
+    'username': User.username,
+    'image_url': User.image_url,
+    'bio': User.bio,
+    'location': User.location,
+    'message_count': User.message_count,
+    'following_count': User.following_count,
+    'follower_count': User.follower_count,
+}
+
+
+class APIError(Exception):
+    """A request the API can't answer; sent as {"error": message}."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def _encode_default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f"Can't serialize {type(obj).__name__}")
+
+
+_encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False,
+                            default=_encode_default)
+
+
+def dumps(obj):
+    """`obj` as compact JSON bytes; datetimes as ISO 8601 strings."""
+
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return _encoder.encode(obj).encode('UTF-8')
+
+
+def requested_fields(available):
+    """Field names asked for with `?fields=` (all of `available` if none)."""
+
+    asked = request.args.get('fields')
+    if not asked:
+        return list(available)
+
+    fields = list(dict.fromkeys(name.strip() for name in asked.split(',')
+                                if name.strip()))
+    unknown = [name for name in fields if name not in available]
+    if unknown:
+        raise APIError(400, f"Unknown fields: {', '.join(unknown)}")
+
+    return fields
+
+
+def page_limit():
+    """Page size asked for with `?limit=`, or None for the default."""
+
+    limit = request.args.get('limit')
+    if limit is None:
+        return None
+
+    maximum = current_app.config.get('API_MAX_PAGE_SIZE',
+                                     DEFAULT_MAX_PAGE_SIZE)
+    if not limit.isdigit() or not 1 <= int(limit) <= maximum:
+        raise APIError(400, f"limit must be between 1 and {maximum}")
+
+    return int(limit)
+
+
+def before_cursor():
+    """The `?before=` cursor of a message list, decoded."""
+
+    before = request.args.get('before')
+    if not before:
+        return None
+
+    try:
+        return decode_cursor(before)
+    except ValueError:
+        raise APIError(400, "Invalid before cursor")
+
+
+def after_cursor():
+    """The `?after=` cursor (a user id) of a user list."""
+
+    after = request.args.get('after')
+    if not after:
+        return None
+
+    if not after.isdigit():
+        raise APIError(400, "Invalid after cursor")
+    return int(after)
+
+
+def require_user(user_id):
+    """Raise a 404 APIError unless user `user_id` exists and is enabled."""
+
+    found = (db.session.query(User.id)
+             .filter(User.id == user_id, User.disabled_at.is_(None))
+             .first())
+    if found is None:
+        raise APIError(404, "No such user")
+
+
+def message_query(fields):
+    """Select of messages' `fields` columns, for the timeline functions.
+
+    The id and timestamp are always selected since pages are cut on them,
+    and users are only joined if one of their columns is asked for.
+    """
+
+    names = list(dict.fromkeys(['id', 'timestamp'] + fields))
+    query = (db.session.query(*[MESSAGE_FIELDS[name].label(name)
+                                for name in names])
+             .select_from(Message))
+
+    if any(MESSAGE_FIELDS[name].class_ is User for name in names):
+        query = query.join(User, User.id == Message.user_id)
+
+    return query
+
+
+def user_query(fields):
+    """Select of users' `fields` columns (and their id)."""
+
+    names = list(dict.fromkeys(['id'] + fields))
+    return db.session.query(*[USER_FIELDS[name].label(name)
+                              for name in names])
+
+
+def followers_query(fields, user_id):
+    """`user_query` of the followers of `user_id`, keyed on follower id."""
+
+    return (user_query(fields)
+            .join(Follows, Follows.user_following_id == User.id)
+            .filter(Follows.user_being_followed_id == user_id),
+            Follows.user_following_id)
+
+
+def following_query(fields, user_id):
+    """`user_query` of the users `user_id` follows, keyed on their id."""
+
+    return (user_query(fields)
+            .join(Follows, Follows.user_being_followed_id == User.id)
+            .filter(Follows.user_following_id == user_id),
+            Follows.user_being_followed_id)
+
+
+class UserPage:
+    """A page of users ordered by `id_col`, fetched while it's iterated.
+
+    Once iteration is over, `next_cursor` holds the `?after=` cursor of the
+    next page, or None if this was the last one.
+    """
+
+    def __init__(self, query, id_col, after, limit):
+        if after is not None:
+            query = query.filter(id_col > after)
+
+        self.rows = (query
+                     .order_by(id_col)
+                     .limit(limit + 1)
+                     .yield_per(ROWS_PER_FETCH))
+        self.limit = limit
+        self.next_cursor = None
+
+    def __iter__(self):
+        last = None
+        for count, row in enumerate(self.rows):
+            if count == self.limit:
+                self.next_cursor = str(last.id)
+                break
+            yield row
+            last = row
+
+
+def stream(name, rows, fields, next_cursor):
+    """Response streaming {name: [rows], "next": cursor} as JSON.
+
+    Each row becomes an object of its `fields`. `next_cursor()` is called
+    once every row has been written.
+    """
+
+    def generate():
+        yield b'{"' + name.encode('UTF-8') + b'":['
+        separator = b''
+        chunk = []
+
+        for row in rows:
+            chunk.append(dumps({field: getattr(row, field)
+                                for field in fields}))
+            if len(chunk) == ROWS_PER_CHUNK:
+                yield separator + b','.join(chunk)
+                separator = b','
+                chunk = []
+
+        if chunk:
+            yield separator + b','.join(chunk)
+        yield b'],"next":' + dumps(next_cursor()) + b'}'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
+
+
+def message_list(page, user_id):
+    """Stream the page of `page(user_id)` (a timelines.py function)."""
+
+    fields = requested_fields(MESSAGE_FIELDS)
+    messages, next_cursor = page(user_id, before=before_cursor(),
+                                 limit=page_limit(),
+                                 query=message_query(fields))
+
+    return stream('messages', messages, fields, lambda: next_cursor)
+
+
+def user_list(select, user_id):
+    """Stream a page of `select(fields, user_id)`'s users."""
+
+    fields = requested_fields(USER_FIELDS)
+    query, id_col = select(fields, user_id)
+    page = UserPage(query, id_col, after_cursor(),
+                    page_limit() or page_size())
+
+    return stream('users', page, fields, lambda: page.next_cursor)
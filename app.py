@@ -1,12 +1,39 @@
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import click
+from flask import (Flask, render_template, request, flash, redirect, session, g,
+                   abort, url_for, make_response, jsonify)
+from flask.ctx import _AppCtxGlobals
+from flask_migrate import Migrate
 
 # from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message, Likes
+from models import db, connect_db, User, Message, Likes, Follows
+from passwords import HashingBusy
+import api
+from api import APIError
+import sql_stats
+import thumbnails
+import fragments
+import assets
+import live
+import replicas
+from replicas import reads_from_replica
+from live import TooManyConnections
+from bulk_load import load_csvs, BulkLoadError, DEFAULT_CHUNK_SIZE
+from accounts import disable_user
+from jobs import work
+from conditional import conditional
+from streaming import stream_template, in_chunks
+from counters import repair_counters
+from search import (search_users, directory_page, search_messages,
+                    message_search, decode_search_cursor, decode_user_cursor)
+from user_cache import current_users
+from timelines import (fan_out_message, remove_message, backfill_follow,
+                       trim_unfollow, home_timeline, user_messages,
+                       liked_messages, decode_cursor)
 
 CURR_USER_KEY = "curr_user"
 
@@ -17,28 +44,125 @@ app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgres:///warbler2'))
 
+# Read replicas, as space-separated URLs: read-only pages query them, except
+# for clients that wrote in the last few seconds (see replicas.py)
+replica_urls = os.environ.get('DATABASE_REPLICA_URLS', '').split()
+app.config['SQLALCHEMY_BINDS'] = {
+    f'replica{i}': url for i, url in enumerate(replica_urls)}
+app.config['REPLICA_BINDS'] = list(app.config['SQLALCHEMY_BINDS'])
+app.config['REPLICA_STICKY_SECONDS'] = 10
+
+# Connection pool of each worker process (see db_pool.py); DB_PGBOUNCER=1
+# when connecting through PgBouncer in transaction mode
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+app.config['DB_POOL_TIMEOUT'] = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+app.config['DB_POOL_PRE_PING'] = os.environ.get('DB_POOL_PRE_PING') != '0'
+app.config['DB_PGBOUNCER'] = os.environ.get('DB_PGBOUNCER') == '1'
+
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
 # toolbar = DebugToolbarExtension(app)
 
+# Authors with this many followers are merged into timelines at read time
+# instead of being copied into every follower's timeline when they post.
+app.config['TIMELINE_FANOUT_LIMIT'] = 10000
+app.config['TIMELINE_BACKFILL'] = 100
+app.config['TIMELINE_PAGE_SIZE'] = 20
+app.config['USERS_PER_PAGE'] = 24
+app.config['MESSAGES_PER_PAGE'] = 20
+
+# bcrypt cost for new and upgraded password hashes, and how many hashes may
+# run (and wait) at once; see passwords.py
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['BCRYPT_MAX_CONCURRENCY'] = int(
+    os.environ.get('BCRYPT_MAX_CONCURRENCY', 4))
+app.config['BCRYPT_MAX_QUEUED'] = 16
+app.config['BCRYPT_QUEUE_TIMEOUT'] = 5
+
+# Static files may be reused for an hour before revalidating
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 3600
+
+# Resized copies of users' images (see thumbnails.py); the directory
+# defaults to instance/thumbnails
+app.config['THUMBNAIL_CACHE_DIR'] = os.environ.get('THUMBNAIL_CACHE_DIR')
+app.config['THUMBNAIL_CACHE_MAX_BYTES'] = 512 * 1024 * 1024
+
+# Long list pages are sent in pieces of this size as they render, reading
+# rows this many at a time (see streaming.py)
+app.config['STREAM_FLUSH_BYTES'] = 8192
+app.config['STREAM_CHUNK_SIZE'] = 100
+
+# Live timeline streams (see live.py): 'local' delivers within this process,
+# 'postgres' across workers with LISTEN/NOTIFY
+app.config['LIVE_BROKER'] = os.environ.get('LIVE_BROKER', 'local')
+app.config['LIVE_MAX_CONNECTIONS'] = 100
+app.config['LIVE_QUEUE_SIZE'] = 100
+app.config['LIVE_HEARTBEAT'] = 15
+
+# Largest page the JSON API returns for `?limit=` (see api.py)
+app.config['API_MAX_PAGE_SIZE'] = 500
+
+# Rendered message fragments kept in process (see fragments.py); set
+# FRAGMENT_CACHE to a cachelib-style cache to share them between processes
+app.config['FRAGMENT_CACHE_SIZE'] = 10000
+app.config['FRAGMENT_CACHE'] = None
+
+# Per-request query count/time headers; set SQL_REPEAT_LIMIT to fail
+# requests that repeat one query more than that many times (see sql_stats.py)
+app.config['SQL_STATS'] = True
+app.config['SQL_REPEAT_LIMIT'] = None
+
+# Background jobs, run by `flask worker` (see jobs.py); deleted accounts are
+# purged PURGE_BATCH_SIZE rows per transaction (see accounts.py)
+app.config['JOB_MAX_ATTEMPTS'] = 5
+app.config['JOB_RETRY_DELAY'] = 30
+app.config['JOB_LOCK_TIMEOUT'] = 600
+app.config['JOB_POLL_INTERVAL'] = 1
+app.config['PURGE_BATCH_SIZE'] = int(
+    os.environ.get('PURGE_BATCH_SIZE', 1000))
+
 connect_db(app)
+# Schema changes: `flask db upgrade` (see migrations/README)
+migrate = Migrate(app, db,
+                  directory=os.path.join(app.root_path, 'migrations'))
+sql_stats.init_app(app)
+assets.init_app(app)
+thumbnails.init_app(app)
+fragments.init_app(app)
+live.init_app(app)
+replicas.init_app(app)
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
-def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+class LazyUserGlobals(_AppCtxGlobals):
+    """Flask global whose `user` is looked up the first time it's read.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    If we're logged in, `g.user` is the curr user, otherwise None. Requests
+    that never read it (redirects, static files) don't touch the database,
+    and the rest are usually answered by the current-user cache.
+    """
 
-    else:
-        g.user = None
+    def __getattr__(self, name):
+        if name != 'user':
+            raise AttributeError(name)
+
+        if CURR_USER_KEY in session:
+            self.user = current_users.get(session[CURR_USER_KEY])
+
+        else:
+            self.user = None
+
+        return self.user
+
+
+app.app_ctx_globals_class = LazyUserGlobals
 
 
 def do_login(user):
@@ -54,6 +178,29 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
+def page_cursor():
+    """Decode the `?before=` cursor of a message list (400 if invalid)."""
+
+    before = request.args.get('before')
+    if not before:
+        return None
+
+    try:
+        return decode_cursor(before)
+    except ValueError:
+        abort(400)
+
+
+def get_user_or_404(user_id):
+    """The user with `user_id`; 404 if there's none or it's disabled."""
+
+    user = User.query.get_or_404(user_id)
+    if user.disabled_at is not None:
+        abort(404)
+
+    return user
+
+
 @app.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
@@ -102,6 +249,8 @@ def login():
                                  form.password.data)
 
         if user:
+            # saves the upgraded hash if authenticate rehashed the password
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -124,41 +273,62 @@ def logout():
 # General user routes:
 
 @app.route('/users')
+@reads_from_replica
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username; results
+    are ranked. Either way the list is paged with 'after'; without 'q', all
+    users are listed in username order.
     """
 
     search = request.args.get('q')
+    next_url = None
 
     if not search:
-        users = User.query.all()
+        users, after = directory_page(after=request.args.get('after'))
+        if after:
+            next_url = url_for('list_users', after=after)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        after = request.args.get('after')
+        try:
+            after = decode_user_cursor(after) if after else None
+        except ValueError:
+            abort(400)
+
+        users, after = search_users(search, after=after)
+        if after:
+            next_url = url_for('list_users', q=search, after=after)
+
+    if g.user:
+        g.user.following_ids([u.id for u in users])
 
-    return render_template('users/index.html', users=users)
+    return stream_template('users/index.html', users=users,
+                           next_url=next_url)
 
 
 @app.route('/users/<int:user_id>')
+@reads_from_replica
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
-    likes = [l.message_id for l in Likes.query.all()]
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
+    user = get_user_or_404(user_id)
+    before = page_cursor()
+
+    def render():
+        # snagging messages in order from the database;
+        # user.messages won't be in order by default
+        messages, next_cursor = user_messages(user_id, before=before)
+        likes = Likes.liked_message_ids(g.user, [m.id for m in messages])
+
+        return render_template('users/show.html', user=user, likes=likes,
+                               messages=messages, next_cursor=next_cursor)
 
-    return render_template('users/show.html', user=user, likes=likes, messages=messages)
+    return conditional(render, g.user, [user_id])
 
 
 @app.route('/users/<int:user_id>/following')
+@reads_from_replica
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -166,11 +336,27 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = get_user_or_404(user_id)
+
+    def render():
+        following = in_chunks(
+            User.query
+            .join(Follows, Follows.user_being_followed_id == User.id)
+            .filter(Follows.user_following_id == user_id)
+            .order_by(Follows.user_being_followed_id),
+            prepare=lambda users: g.user.following_ids(
+                [user.id] + [u.id for u in users]))
+
+        return stream_template('users/following.html', user=user,
+                               following=following)
+
+    following = (db.select([Follows.user_being_followed_id])
+                 .where(Follows.user_following_id == user_id))
+    return conditional(render, g.user, [user_id], related=following)
 
 
 @app.route('/users/<int:user_id>/followers')
+@reads_from_replica
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -178,11 +364,27 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = get_user_or_404(user_id)
+
+    def render():
+        followers = in_chunks(
+            User.query
+            .join(Follows, Follows.user_following_id == User.id)
+            .filter(Follows.user_being_followed_id == user_id)
+            .order_by(Follows.user_following_id),
+            prepare=lambda users: g.user.following_ids(
+                [user.id] + [u.id for u in users]))
+
+        return stream_template('users/followers.html', user=user,
+                               followers=followers)
+
+    followers = (db.select([Follows.user_following_id])
+                 .where(Follows.user_being_followed_id == user_id))
+    return conditional(render, g.user, [user_id], related=followers)
 
 
 @app.route('/users/<int:user_id>/likes')
+@reads_from_replica
 def users_likes(user_id):
     """Show list of liked messages of this user."""
 
@@ -190,17 +392,12 @@ def users_likes(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    liked_messages = [
-        l.message_id for l in Likes.query.filter_by(user_id=user_id).all()]
-    likes = [l.message_id for l in Likes.query.all()]
+    user = get_user_or_404(user_id)
 
-    messages = (db.session.query(Message)
-                .filter(Message.id.in_(liked_messages))
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('home.html', user=user, messages=messages, likes=likes)
+    messages, next_cursor = liked_messages(user_id, before=page_cursor())
+    likes = Likes.liked_message_ids(g.user, [m.id for m in messages])
+    return render_template('home.html', user=user, messages=messages,
+                           likes=likes, next_cursor=next_cursor)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -211,8 +408,10 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
+    followed_user = get_user_or_404(follow_id)
     g.user.following.append(followed_user)
+    db.session.flush()
+    backfill_follow(g.user.id, followed_user.id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -226,9 +425,12 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    followed_user = get_user_or_404(follow_id)
+    # already not following them (a repeated or stale form): nothing to do
+    if g.user.is_following(followed_user):
+        g.user.following.remove(followed_user)
+        trim_unfollow(g.user.id, followed_user.id)
+        db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -245,16 +447,22 @@ def edit_profile():
     form = UserEditForm(obj=user)
 
     if form.validate_on_submit():
-        if User.authenticate(user.username,
-                             form.password.data):
-            user.username = form.username.data,
-            user.email = form.email.data,
-            user.image_url = form.image_url.data or User.image_url.default.arg,
-            user.header_image_url = form.header_image_url.data or User.image_url.default.arg,
+        if user.check_password(form.password.data):
+            image_url = form.image_url.data or User.image_url.default.arg
+            if (user.username, user.image_url) != (form.username.data,
+                                                   image_url):
+                user.profile_version = User.profile_version + 1
+
+            user.username = form.username.data
+            user.email = form.email.data
+            user.image_url = image_url
+            user.header_image_url = (form.header_image_url.data or
+                                     User.header_image_url.default.arg)
             user.bio = form.bio.data
             user.location = form.location.data
 
             db.session.commit()
+            current_users.invalidate(user.id)
             return redirect(f"/users/{user.id}")
         else:
             flash("Incorrect Password.", "danger")
@@ -271,8 +479,10 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    # disabled now; its rows are purged by a background job
+    disable_user(g.user)
     db.session.commit()
+    current_users.invalidate(g.user.id)
 
     return redirect("/signup")
 
@@ -296,19 +506,53 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+        fan_out_message(msg)
         db.session.commit()
+        message_search().add(msg)
+        live.publish(msg)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
+@app.route('/messages/search')
+@reads_from_replica
+def messages_search():
+    """Full-text search over messages.
+
+    Takes a 'q' param in querystring; results are ranked by relevance and
+    paged with an 'after' cursor.
+    """
+
+    q = request.args.get('q', '').strip()
+    messages, next_cursor = [], None
+
+    if q:
+        after = request.args.get('after')
+        try:
+            after = decode_search_cursor(after) if after else None
+        except ValueError:
+            abort(400)
+
+        messages, next_cursor = search_messages(q, after=after)
+
+    return render_template('messages/search.html', q=q, messages=messages,
+                           next_cursor=next_cursor)
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@reads_from_replica
 def messages_show(message_id):
     """Show a message."""
 
     msg = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=msg)
+
+    # messages never change, but their author and the viewer's follow can
+    return conditional(
+        lambda: render_template('messages/show.html', message=msg),
+        g.user, [msg.user_id], key=message_id)
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -323,8 +567,10 @@ def messages_destroy(message_id):
     if msg.user_id != g.user.id:
         flash("Access unauthorized.", "danger")
         return redirect("/")
+    remove_message(msg)
     db.session.delete(msg)
     db.session.commit()
+    message_search().remove(message_id)
 
     return redirect(f"/users/{g.user.id}")
 
@@ -337,63 +583,215 @@ def add_like(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    likes = [l.message_id for l in Likes.query.all()]
-    if message_id in likes:
-        like = Likes.query.filter_by(message_id=message_id).first()
+    like = Likes.query.filter_by(user_id=g.user.id,
+                                 message_id=message_id).first()
+    if like:
         db.session.delete(like)
         db.session.commit()
         return redirect("/")
 
-    msg = Message.query.get(message_id)
+    msg = Message.query.get_or_404(message_id)
+    # a disabled author's messages are being purged, likes and all
+    if msg.user.disabled_at is not None:
+        abort(404)
+
     like = Likes(user_id=g.user.id, message_id=msg.id)
     db.session.add(like)
     db.session.commit()
 
     return redirect("/")
 
+##############################################################################
+# JSON API (see api.py)
+
+@app.route('/api/timeline')
+@reads_from_replica
+def api_timeline():
+    """The logged-in user's home timeline."""
+
+    if not g.user:
+        raise APIError(401, "Access unauthorized.")
+
+    return api.message_list(home_timeline, g.user.id)
+
+
+@app.route('/api/timeline/events')
+def api_timeline_events():
+    """Server-Sent Events of new messages for the home timeline."""
+
+    if not g.user:
+        raise APIError(401, "Access unauthorized.")
+
+    return live.event_stream(g.user.id)
+
+
+@app.route('/api/users/<int:user_id>/messages')
+@reads_from_replica
+def api_user_messages(user_id):
+    """Messages written by a user."""
+
+    api.require_user(user_id)
+    return api.message_list(user_messages, user_id)
+
+
+@app.route('/api/users/<int:user_id>/likes')
+@reads_from_replica
+def api_user_likes(user_id):
+    """Messages liked by a user."""
+
+    if not g.user:
+        raise APIError(401, "Access unauthorized.")
+
+    api.require_user(user_id)
+    return api.message_list(liked_messages, user_id)
+
+
+@app.route('/api/users/<int:user_id>/followers')
+@reads_from_replica
+def api_user_followers(user_id):
+    """Users following a user."""
+
+    if not g.user:
+        raise APIError(401, "Access unauthorized.")
+
+    api.require_user(user_id)
+    return api.user_list(api.followers_query, user_id)
+
+
+@app.route('/api/users/<int:user_id>/following')
+@reads_from_replica
+def api_user_following(user_id):
+    """Users a user follows."""
+
+    if not g.user:
+        raise APIError(401, "Access unauthorized.")
+
+    api.require_user(user_id)
+    return api.user_list(api.following_query, user_id)
+
+
+@app.errorhandler(APIError)
+def api_error(error):
+    """Report API errors as JSON."""
+
+    return jsonify(error=error.message), error.status
+
+
+@app.errorhandler(TooManyConnections)
+def too_many_streams(error):
+    """This worker's live streams are all taken: retry (maybe elsewhere)."""
+
+    return (jsonify(error="Too many live connections."), 503,
+            {'Retry-After': '30'})
+
+
 ##############################################################################
 # Homepage and error pages
 
 
 @app.route('/')
+@reads_from_replica
 def homepage():
     """Show homepage:
 
-    - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - anon users: no messages (cacheable by anyone for a few minutes)
+    - logged in: most recent messages of followed_users, a page at a time
     """
 
     if g.user:
-        user = User.query.get_or_404(g.user.id)
-        user_following = [f.id for f in user.following]
-        user_following.append(user.id)
+        user = g.user
 
-        likes = [l.message_id for l in Likes.query.all()]
-        messages = (db.session.query(Message)
-                    .filter(Message.user_id.in_(user_following))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        messages, next_cursor = home_timeline(user.id, before=page_cursor())
+        likes = Likes.liked_message_ids(user, [m.id for m in messages])
 
-        return render_template('home.html', messages=messages, user=user, likes=likes)
+        return render_template('home.html', messages=messages, user=user,
+                               likes=likes, next_cursor=next_cursor)
 
-    else:
+    elif '_flashes' in session:
         return render_template('home-anon.html')
 
+    else:
+        response = make_response(render_template('home-anon.html'))
+        response.headers['Cache-Control'] = 'public, max-age=300'
+        response.vary.add('Cookie')
+        return response
+
+
+@app.errorhandler(HashingBusy)
+def hashing_busy(error):
+    """Too many logins/signups in flight: ask the client to retry."""
+
+    return ("Too many sign-ins right now, please try again shortly.", 503,
+            {'Retry-After': '5'})
+
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
+# Cache policy
 #
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Pages that can be validated set their own headers (see conditional.py), as
+# do static files (SEND_FILE_MAX_AGE_DEFAULT; fingerprinted ones are
+# immutable, see assets.py) and the anonymous homepage.
+# Everything else -- forms with CSRF tokens, redirects, timelines -- is
+# never stored.
 
 @app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+def add_header(response):
+    """Forbid caching of responses that didn't choose a policy."""
+
+    if 'Cache-Control' not in response.headers:
+        response.headers['Cache-Control'] = (
+            'no-cache, no-store, must-revalidate')
+        response.headers['Pragma'] = 'no-cache'
+        response.headers['Expires'] = '0'
+    return response
+
+
+##############################################################################
+# Maintenance commands (run with `flask <command>`)
+
+@app.cli.command('repair-counters')
+@click.option('--batch-size', default=10000,
+              help='Users recomputed per transaction.')
+def repair_counters_command(batch_size):
+    """Recompute every user's message/follow/like counters."""
+
+    repaired = repair_counters(batch_size=batch_size)
+    click.echo(f"Recomputed counters for {repaired} users.")
+
+
+@app.cli.command('bulk-load')
+@click.argument('directory', default='generator')
+@click.option('--chunk-size', default=DEFAULT_CHUNK_SIZE,
+              help='Rows loaded per transaction.')
+@click.option('--reset', is_flag=True,
+              help='Drop all data first instead of resuming.')
+def bulk_load_command(directory, chunk_size, reset):
+    """Load users/messages/follows/likes CSVs from DIRECTORY."""
+
+    try:
+        counts = load_csvs(directory, chunk_size=chunk_size, reset=reset,
+                           report=click.echo)
+    except BulkLoadError as error:
+        raise click.ClickException(str(error))
+    click.echo(", ".join(f"{count:,} {table}"
+                         for table, count in counts.items()) + " loaded.")
+
+
+@app.cli.command('worker')
+@click.option('--burst', is_flag=True,
+              help='Exit once no jobs are due instead of waiting for more.')
+@click.option('--poll-interval', type=float, default=None,
+              help='Seconds between checks of an empty queue.')
+def worker_command(burst, poll_interval):
+    """Run background jobs; start several for more throughput."""
+
+    ran = work(burst=burst, poll_interval=poll_interval)
+    click.echo(f"Ran {ran} jobs.")
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Fingerprint and precompress static files into static/dist."""
+
+    manifest = assets.build(app.static_folder)
+    click.echo(f"Built {len(manifest)} assets.")
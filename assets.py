@@ -0,0 +1,162 @@
+"""Fingerprinted, precompressed static assets.
+
+`flask build-assets` copies every file under static/ to static/dist/, with
+a hash of its contents in the name:
+
+    stylesheets/style.css -> dist/stylesheets/style.1a2b3c4d5e6f.css
+
+url() references in stylesheets are rewritten to the hashed names.
+Compressible assets also get .gz copies, plus .br copies if the `brotli`
+package is installed. static/dist/manifest.json maps each original name to
+its hashed name.
+
+Templates link assets with `asset_url('stylesheets/style.css')`. Once the
+manifest exists this gives the hashed URL. Hashed names never change
+content, so they're served with a year-long `immutable` Cache-Control, in
+the best encoding the client accepts. Without a build (in development) it
+falls back to the plain /static/ URL.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+
+from flask import current_app, request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DIST = 'dist'
+MANIFEST = 'manifest.json'
+IMMUTABLE = 'public, max-age=31536000, immutable'
+COMPRESSIBLE = {'.css', '.js', '.svg', '.txt', '.ico'}
+
+# (encoding, file suffix), best first
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+CSS_URL = re.compile(r"""url\(\s*(['"]?)/static/([^'")]+)\1\s*\)""")
+
+
+def _hashed_name(path, content):
+    root, ext = os.path.splitext(path)
+    return f"{root}.{hashlib.sha256(content).hexdigest()[:12]}{ext}"
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as out:
+        out.write(content)
+
+
+def _sources(static_folder):
+    """Paths (relative to static/) of the files to fingerprint.
+
+    Stylesheets come last so the images they refer to are hashed first.
+    """
+
+    paths = []
+    for root, dirs, files in os.walk(static_folder):
+        dirs[:] = sorted(d for d in dirs
+                         if os.path.join(root, d) !=
+                         os.path.join(static_folder, DIST))
+        for name in sorted(files):
+            paths.append(os.path.relpath(os.path.join(root, name),
+                                         static_folder).replace(os.sep, '/'))
+
+    return sorted(paths, key=lambda path: path.endswith('.css'))
+
+
+def build(static_folder):
+    """Rebuild static/dist from static/; returns the manifest."""
+
+    dist = os.path.join(static_folder, DIST)
+    shutil.rmtree(dist, ignore_errors=True)
+    manifest = {}
+
+    for path in _sources(static_folder):
+        with open(os.path.join(static_folder, path), 'rb') as source:
+            content = source.read()
+
+        if path.endswith('.css'):
+            content = CSS_URL.sub(
+                lambda match: (f'url("/static/{DIST}/{manifest[match[2]]}")'
+                               if match[2] in manifest else match[0]),
+                content.decode('UTF-8')).encode('UTF-8')
+
+        hashed = _hashed_name(path, content)
+        manifest[path] = hashed
+        target = os.path.join(dist, hashed)
+        _write(target, content)
+
+        if os.path.splitext(path)[1] in COMPRESSIBLE:
+            _write(target + '.gz', gzip.compress(content, 9))
+            if brotli is not None:
+                _write(target + '.br', brotli.compress(content))
+
+    _write(os.path.join(dist, MANIFEST),
+           json.dumps(manifest, indent=2, sort_keys=True).encode('UTF-8'))
+
+    return manifest
+
+
+def manifest():
+    """The current app's asset manifest ({} if assets aren't built)."""
+
+    app = current_app._get_current_object()
+    loaded = app.extensions.get('asset_manifest')
+
+    if loaded is None:
+        path = os.path.join(app.static_folder, DIST, MANIFEST)
+        try:
+            with open(path) as manifest_file:
+                loaded = json.load(manifest_file)
+        except FileNotFoundError:
+            loaded = {}
+        app.extensions['asset_manifest'] = loaded
+
+    return loaded
+
+
+def asset_url(filename):
+    """URL for static file `filename`, fingerprinted if assets are built."""
+
+    hashed = manifest().get(filename)
+    if hashed is None:
+        return url_for('static', filename=filename)
+
+    return url_for('asset', filename=hashed)
+
+
+def serve_asset(filename):
+    """A fingerprinted file, precompressed if the client accepts it."""
+
+    dist = os.path.join(current_app.static_folder, DIST)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    for encoding, suffix in ENCODINGS:
+        if (encoding in request.accept_encodings
+                and os.path.isfile(os.path.join(dist, filename + suffix))):
+            response = send_from_directory(dist, filename + suffix,
+                                           mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(dist, filename, mimetype=mimetype)
+
+    response.headers['Cache-Control'] = IMMUTABLE
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def init_app(app):
+    """Serve static/dist and make `asset_url` available to templates."""
+
+    app.add_url_rule(f'{app.static_url_path}/{DIST}/<path:filename>',
+                     'asset', serve_asset)
+    app.add_template_global(asset_url)
@@ -0,0 +1,114 @@
+"""Measure login throughput and latency at different bcrypt costs.
+
+Each login's cost is dominated by one bcrypt check, so this runs password
+checks through the same bounded PasswordHasher the app uses, from a number
+of concurrent "clients", for each candidate cost. Latency includes time
+spent waiting for a hashing slot, as a user would see it.
+
+Run from the repo root:
+
+    python -m benchmarks.bcrypt_cost --costs 10 11 12 13 --clients 16 \\
+        --workers 4 --budget-ms 250
+
+Prints one JSON document: per-cost p50/p95/p99 latency and logins/second,
+plus the highest cost whose p95 fits in the budget (set BCRYPT_LOG_ROUNDS
+to it). A cost that finished no logins in the time has null percentiles.
+"""
+
+import argparse
+import json
+import os
+import sys
+from threading import Thread
+from time import monotonic
+
+from passwords import PasswordHasher, bcrypt
+
+PASSWORD = "correct horse battery staple"
+
+
+def percentile(samples, pct):
+    """The `pct`th percentile of sorted `samples` (nearest rank)."""
+
+    if not samples:
+        return None
+    rank = max(0, min(len(samples) - 1, round(pct / 100 * len(samples)) - 1))
+    return samples[rank]
+
+
+def rounded_percentile(samples, pct):
+    """`percentile` to 0.1, or None if there are no samples."""
+
+    value = percentile(samples, pct)
+    return None if value is None else round(value, 1)
+
+
+def run_cost(cost, clients, workers, seconds):
+    """Check passwords at `cost` for `seconds`; return the measurements."""
+
+    hashed = bcrypt.generate_password_hash(PASSWORD, rounds=cost)
+    hasher = PasswordHasher(max_concurrency=workers, max_queued=clients,
+                            queue_timeout=None)
+    latencies = [[] for _ in range(clients)]
+    deadline = monotonic() + seconds
+
+    def client(samples):
+        while monotonic() < deadline:
+            start = monotonic()
+            hasher.run(bcrypt.check_password_hash, hashed, PASSWORD)
+            samples.append(monotonic() - start)
+
+    started = monotonic()
+    threads = [Thread(target=client, args=(samples,)) for samples in latencies]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = monotonic() - started
+    hasher.shutdown()
+
+    samples = sorted(latency * 1000 for per_client in latencies
+                     for latency in per_client)
+
+    return {
+        'cost': cost,
+        'logins': len(samples),
+        'logins_per_second': round(len(samples) / elapsed, 1),
+        'p50_ms': rounded_percentile(samples, 50),
+        'p95_ms': rounded_percentile(samples, 95),
+        'p99_ms': rounded_percentile(samples, 99),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--costs', type=int, nargs='+',
+                        default=[10, 11, 12, 13])
+    parser.add_argument('--clients', type=int, default=16,
+                        help="concurrent logins in flight")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="hashing threads (BCRYPT_MAX_CONCURRENCY)")
+    parser.add_argument('--seconds', type=float, default=5,
+                        help="how long to run each cost")
+    parser.add_argument('--budget-ms', type=float, default=250,
+                        help="p95 login latency we can afford")
+    args = parser.parse_args(argv)
+
+    results = [run_cost(cost, args.clients, args.workers, args.seconds)
+               for cost in sorted(args.costs)]
+    # a cost that finished no logins in time doesn't fit
+    fitting = [r['cost'] for r in results
+               if r['p95_ms'] is not None and r['p95_ms'] <= args.budget_ms]
+
+    json.dump({
+        'clients': args.clients,
+        'workers': args.workers,
+        'budget_ms': args.budget_ms,
+        'results': results,
+        'recommended_cost': max(fitting) if fitting else None,
+    }, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,303 @@
+"""Drive Warbler with a request workload and report latency per route.
+
+Requests go through the Flask test client in-process, so the numbers cover
+the app and database but not the network or a WSGI server. The workload is
+either a generated mix of the hot routes (home timeline, profiles, user
+search, likes, posting and following) or a recorded trace: a JSON-lines
+file with one request per line, e.g.
+
+    {"method": "GET", "path": "/users/42", "user_id": 7}
+    {"method": "POST", "path": "/messages/new", "user_id": 7,
+     "form": {"text": "hello"}}
+
+`user_id` is who the request is logged in as (omit for anonymous).
+
+Point DATABASE_URL (or --database-url) at a scratch database. Optionally
+load it first, either from CSVs (--dataset) or from a freshly generated
+synthetic dataset of a given size (--scale). Then, for example:
+
+    python -m benchmarks.load_replay --scale 100000 --requests 20000 \\
+        --concurrency 8 --output before.json
+
+The JSON report has p50/p95/p99 latency, throughput, error counts and SQL
+queries per request for each route, plus the connection pool's checkout
+and wait totals (see db_pool.py), so two runs can be diffed.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+from collections import defaultdict
+from random import Random
+from time import monotonic
+
+from werkzeug.exceptions import HTTPException
+
+DEFAULT_MIX = {
+    'homepage': 50,
+    'users_show': 20,
+    'list_users': 10,
+    'add_like': 10,
+    'messages_add': 5,
+    'add_follow': 5,
+}
+
+
+def percentile(samples, pct):
+    """The `pct`th percentile of sorted `samples` (nearest rank)."""
+
+    if not samples:
+        return None
+    rank = max(0, min(len(samples) - 1, round(pct / 100 * len(samples)) - 1))
+    return samples[rank]
+
+
+def prepare_database(args):
+    """Load --dataset, or a generated dataset of --scale users."""
+
+    from bulk_load import load_csvs
+    from generator import synthetic
+
+    directory = args.dataset
+    if args.scale:
+        directory = tempfile.mkdtemp(prefix='warbler-')
+        synthetic.main(['--out', directory, '--seed', str(args.seed),
+                        '--users', str(args.scale),
+                        '--messages', str(args.scale * 10)])
+
+    if directory:
+        load_csvs(directory, reset=True,
+                  report=lambda line: print(line, file=sys.stderr))
+
+
+def synthetic_requests(rng, count, mix):
+    """`count` requests drawn from the route weights in `mix`."""
+
+    from models import db, User, Message
+
+    max_user = db.session.query(db.func.max(User.id)).scalar() or 0
+    max_message = db.session.query(db.func.max(Message.id)).scalar() or 0
+    usernames = [username for (username,) in
+                 db.session.query(User.username).limit(1000)]
+    db.session.remove()
+
+    if not max_user:
+        raise SystemExit("No users to log in as; use --dataset or --scale.")
+
+    routes = list(mix)
+    weights = [mix[route] for route in routes]
+
+    for _ in range(count):
+        route = rng.choices(routes, weights)[0]
+        user_id = rng.randint(1, max_user)
+
+        if route == 'homepage':
+            yield {'method': 'GET', 'path': '/', 'user_id': user_id}
+        elif route == 'users_show':
+            yield {'method': 'GET', 'user_id': user_id,
+                   'path': f"/users/{rng.randint(1, max_user)}"}
+        elif route == 'list_users':
+            yield {'method': 'GET', 'user_id': user_id,
+                   'path': f"/users?q={rng.choice(usernames)[:3]}"}
+        elif route == 'add_like' and max_message:
+            yield {'method': 'POST', 'user_id': user_id,
+                   'path': f"/messages/add_like/{rng.randint(1, max_message)}"}
+        elif route == 'messages_add':
+            yield {'method': 'POST', 'path': '/messages/new',
+                   'user_id': user_id,
+                   'form': {'text': f"benchmark warble {rng.random()}"}}
+        elif route == 'add_follow':
+            yield {'method': 'POST', 'user_id': user_id,
+                   'path': f"/users/follow/{rng.randint(1, max_user)}"}
+
+
+def read_trace(path):
+    with open(path) as trace:
+        for line in trace:
+            if line.strip():
+                yield json.loads(line)
+
+
+class LoggedQueries(logging.Handler):
+    """Each thread's last request's query count, from its `warbler.sql` line.
+
+    sql_stats.py counts the statements of a request on every engine,
+    replicas included, and logs them once the response has been sent.
+    """
+
+    def __init__(self):
+        super().__init__(logging.INFO)
+        self.local = threading.local()
+
+    def emit(self, record):
+        self.local.count = json.loads(record.getMessage())['queries']
+
+    def reset(self):
+        self.local.count = 0
+
+    @property
+    def count(self):
+        return getattr(self.local, 'count', 0)
+
+
+def replay(app, requests, concurrency, queries):
+    """Send `requests` from `concurrency` threads; returns (results, secs).
+
+    Each result is (route, latency in seconds, status, queries).
+    """
+
+    from app import CURR_USER_KEY
+
+    adapter = app.url_map.bind('localhost')
+    results = []
+    lock = threading.Lock()
+    requests = iter(requests)
+
+    def worker():
+        client = app.test_client()
+        while True:
+            with lock:
+                request = next(requests, None)
+            if request is None:
+                return
+
+            method = request.get('method', 'GET')
+            path = request['path']
+            try:
+                route = adapter.match(path.split('?')[0], method)[0]
+            except HTTPException:
+                route = 'unknown'
+
+            with client.session_transaction() as session:
+                session.clear()
+                if request.get('user_id'):
+                    session[CURR_USER_KEY] = request['user_id']
+
+            queries.reset()
+            start = monotonic()
+            response = client.open(path, method=method,
+                                   data=request.get('form'))
+            # a streamed page runs queries as its body is read, and is
+            # logged when it's closed
+            response.get_data()
+            response.close()
+            latency = monotonic() - start
+
+            with lock:
+                results.append((route, latency, response.status_code,
+                                queries.count))
+
+    started = monotonic()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results, monotonic() - started
+
+
+def summarize(results, elapsed):
+    by_route = defaultdict(list)
+    for result in results:
+        by_route[result[0]].append(result)
+
+    def stats(rows):
+        latencies = sorted(latency * 1000 for (_, latency, _, _) in rows)
+        counts = [count for (_, _, _, count) in rows]
+        return {
+            'requests': len(rows),
+            'errors': sum(1 for (_, _, status, _) in rows if status >= 500),
+            'requests_per_second': round(len(rows) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 50), 2),
+            'p95_ms': round(percentile(latencies, 95), 2),
+            'p99_ms': round(percentile(latencies, 99), 2),
+            'queries_mean': round(sum(counts) / len(counts), 2),
+            'queries_max': max(counts),
+        }
+
+    return {
+        'seconds': round(elapsed, 2),
+        'total': stats(results) if results else None,
+        'routes': {route: stats(rows)
+                   for route, rows in sorted(by_route.items())},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--database-url',
+                        help="database to run against (else DATABASE_URL)")
+    parser.add_argument('--dataset', help="load these CSVs first (resets)")
+    parser.add_argument('--scale', type=int,
+                        help="generate and load this many users first "
+                             "(ten messages each; resets)")
+    parser.add_argument('--trace', help="replay this JSON-lines trace")
+    parser.add_argument('--record',
+                        help="also write the generated requests as a trace")
+    parser.add_argument('--requests', type=int, default=1000,
+                        help="number of generated requests")
+    parser.add_argument('--mix', type=json.loads, default=DEFAULT_MIX,
+                        help="route weights as JSON, e.g. "
+                             "'{\"homepage\": 3, \"users_show\": 1}'")
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the JSON report here")
+    args = parser.parse_args(argv)
+
+    # app.py reads DATABASE_URL when it's imported
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+
+    from app import app
+    from models import db
+    from db_pool import pool_stats
+
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    with app.app_context():
+        prepare_database(args)
+
+        if args.trace:
+            requests = list(read_trace(args.trace))
+        else:
+            requests = list(synthetic_requests(Random(args.seed),
+                                               args.requests, args.mix))
+
+    if args.record:
+        with open(args.record, 'w') as trace:
+            for request in requests:
+                trace.write(json.dumps(request) + '\n')
+
+    app.config['SQL_STATS'] = True
+    queries = LoggedQueries()
+    sql_log = logging.getLogger('warbler.sql')
+    sql_log.addHandler(queries)
+    sql_log.setLevel(logging.INFO)
+    sql_log.propagate = False
+
+    results, elapsed = replay(app, requests, args.concurrency, queries)
+
+    report = summarize(results, elapsed)
+    report['pool'] = pool_stats(db.get_engine(app))
+    report['config'] = {
+        'trace': args.trace,
+        'scale': args.scale,
+        'concurrency': args.concurrency,
+        'seed': args.seed,
+        'mix': None if args.trace else args.mix,
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            report_file.write(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
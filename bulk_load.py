@@ -0,0 +1,308 @@
+"""Bulk-load Warbler data from CSV files.
+
+Loading everything in one transaction is fine for the sample CSVs but not
+for staging-sized datasets (see generator/synthetic.py). This loader streams
+each CSV in chunks: through COPY on Postgres, or batched executemany inserts
+on other databases. Each chunk commits together with a
+row in `bulk_load_progress`, so an interrupted load picks up where it
+stopped when run again.
+
+Users, messages and likes get their id from their row number in the CSV,
+not from the sequence. That keeps the ids that messages.csv and follows.csv
+refer to the same across retries.
+
+Secondary indexes are dropped while loading. The messages and follows
+indexes are rebuilt straight after, since recomputing counters and
+timelines from the loaded rows reads through them; the rest are rebuilt at
+the end. All of that takes locks a database in use can't afford, and the
+row-number ids would collide with the ids already there, so the loader only
+loads into an empty database (or one it is part way through loading, or
+with `reset`); anything else raises BulkLoadError.
+
+Run it with `flask bulk-load [DIRECTORY]`.
+"""
+
+import csv
+import io
+import os
+from datetime import datetime
+from itertools import islice
+from time import monotonic
+
+from alembic.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from sqlalchemy import BigInteger, Column, MetaData, String, Table
+
+from counters import repair_counters
+from models import db, USERS_SEARCH_INDEXES, MESSAGES_SEARCH_INDEX
+from timelines import rebuild_timelines
+
+DEFAULT_CHUNK_SIZE = 50000
+
+# (table, CSV file, whether ids come from row numbers), in load order;
+# likes.csv is optional
+LOAD_ORDER = [
+    ('users', 'users.csv', True),
+    ('messages', 'messages.csv', True),
+    ('follows', 'follows.csv', False),
+    ('likes', 'likes.csv', True),
+]
+
+# Tables whose indexes the counter and timeline recompute reads
+RECOMPUTE_TABLES = {'messages', 'follows'}
+
+# Postgres-only indexes created by DDL in models.py, rebuilt after loading
+SEARCH_INDEXES = [
+    ('users', USERS_SEARCH_INDEXES,
+     ['ix_users_username_trgm', 'ix_users_username_prefix']),
+    ('messages', MESSAGES_SEARCH_INDEX, ['ix_messages_text_search']),
+]
+
+
+class BulkLoadError(Exception):
+    """The database has data the loader didn't put there."""
+
+
+progress = Table(
+    'bulk_load_progress',
+    MetaData(),
+    Column('table_name', String, primary_key=True),
+    Column('rows_loaded', BigInteger, nullable=False),
+)
+
+
+def _is_postgres():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def _rows_loaded(conn, table_name):
+    loaded = conn.execute(
+        db.select([progress.c.rows_loaded])
+        .where(progress.c.table_name == table_name)).scalar()
+
+    if loaded is None:
+        conn.execute(progress.insert(), table_name=table_name, rows_loaded=0)
+        return 0
+
+    return loaded
+
+
+def _copy_chunk(conn, table, columns, rows):
+    """Stream `rows` into `table` with COPY."""
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    cursor = conn.connection.cursor()
+    cursor.copy_expert(
+        f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH CSV",
+        buffer)
+
+
+def _parse(value, column):
+    """CSV text to the Python value `column` expects ('' is NULL)."""
+
+    if value == '':
+        return None
+
+    python_type = column.type.python_type
+    if python_type is datetime:
+        return datetime.fromisoformat(value)
+    if python_type is int:
+        return int(value)
+
+    return value
+
+
+def _insert_chunk(conn, table, columns, rows):
+    """Insert `rows` into `table` in one executemany."""
+
+    table_columns = [table.c[name] for name in columns]
+    conn.execute(table.insert(), [
+        {column.key: _parse(value, column)
+         for column, value in zip(table_columns, row)}
+        for row in rows
+    ])
+
+
+def load_csv(path, table, numbered, chunk_size=DEFAULT_CHUNK_SIZE,
+             report=print):
+    """Load the rows of `path` into `table` not already loaded.
+
+    Returns the total number of rows loaded.
+    """
+
+    write_chunk = _copy_chunk if _is_postgres() else _insert_chunk
+
+    with db.engine.connect() as conn:
+        loaded = _rows_loaded(conn, table.name)
+
+        with open(path, newline='') as csv_file:
+            reader = csv.reader(csv_file)
+            columns = next(reader)
+            if numbered:
+                columns = ['id'] + columns
+
+            rows = islice(reader, loaded, None)
+            started = monotonic()
+            resumed_at = loaded
+
+            while True:
+                chunk = list(islice(rows, chunk_size))
+                if not chunk:
+                    break
+
+                if numbered:
+                    chunk = [[loaded + i + 1] + row
+                             for i, row in enumerate(chunk)]
+
+                with conn.begin():
+                    write_chunk(conn, table, columns, chunk)
+                    loaded += len(chunk)
+                    conn.execute(
+                        progress.update()
+                        .where(progress.c.table_name == table.name)
+                        .values(rows_loaded=loaded))
+
+                rate = (loaded - resumed_at) / (monotonic() - started)
+                report(f"{table.name}: {loaded:,} rows ({rate:,.0f} rows/s)")
+
+    return loaded
+
+
+def _metadata_indexes(read_by_recompute):
+    """Secondary indexes on `db.metadata` tables, which we rebuild.
+
+    The counter and timeline recompute reads messages and follows through
+    their indexes, so those (`read_by_recompute`) are built before it; the
+    rest can wait until the end.
+    """
+
+    return [index for table in db.metadata.sorted_tables
+            for index in table.indexes
+            if (table.name in RECOMPUTE_TABLES) == read_by_recompute]
+
+
+def drop_indexes():
+    """Drop secondary indexes so they aren't maintained row by row."""
+
+    names = [index.name for index in
+             _metadata_indexes(True) + _metadata_indexes(False)]
+    if _is_postgres():
+        names += [name for (_, _, ddl_names) in SEARCH_INDEXES
+                  for name in ddl_names]
+
+    with db.engine.begin() as conn:
+        for name in names:
+            conn.execute(f"DROP INDEX IF EXISTS {name}")
+
+
+def create_recompute_indexes():
+    """Build the messages and follows indexes `drop_indexes` dropped."""
+
+    with db.engine.begin() as conn:
+        for index in _metadata_indexes(True):
+            index.create(bind=conn)
+
+
+def create_indexes():
+    """Build the rest of the indexes `drop_indexes` dropped."""
+
+    with db.engine.begin() as conn:
+        for index in _metadata_indexes(False):
+            index.create(bind=conn)
+
+        for table_name, ddl, _ in SEARCH_INDEXES:
+            ddl.execute(bind=conn, target=db.metadata.tables[table_name])
+
+
+def _reset_sequences():
+    """Point id sequences past the ids we loaded (Postgres only)."""
+
+    with db.engine.begin() as conn:
+        for table_name, _, numbered in LOAD_ORDER:
+            if numbered:
+                conn.execute(
+                    f"SELECT setval(pg_get_serial_sequence('{table_name}', "
+                    f"'id'), coalesce(max(id), 0) + 1, false) "
+                    f"FROM {table_name}")
+
+
+def _stamp_head():
+    """Record that the schema create_all() just built is the latest."""
+
+    migrate = db.get_app().extensions['migrate']
+    script = ScriptDirectory(migrate.directory)
+    with db.engine.begin() as conn:
+        MigrationContext.configure(conn).stamp(script, 'head')
+
+
+def _check_loadable():
+    """Raise BulkLoadError unless the loaded tables are empty."""
+
+    with db.engine.connect() as conn:
+        for table_name, _, _ in LOAD_ORDER:
+            table = db.metadata.tables[table_name]
+            if conn.execute(db.select([1]).select_from(table)
+                            .limit(1)).first():
+                raise BulkLoadError(
+                    f"{table_name} already has rows; bulk-load only loads "
+                    f"into an empty database (use --reset to empty it)")
+
+
+def load_csvs(directory, chunk_size=DEFAULT_CHUNK_SIZE, reset=False,
+              report=print):
+    """Load every Warbler CSV in `directory`, resuming a previous run.
+
+    With `reset`, drops all tables and starts from scratch. Raises
+    BulkLoadError if the database has rows from anywhere else. Returns
+    {table name: rows loaded}.
+    """
+
+    if reset:
+        db.drop_all()
+        progress.drop(bind=db.engine, checkfirst=True)
+
+    fresh = not db.engine.has_table('users')
+    if not fresh and not db.engine.has_table(progress.name):
+        _check_loadable()
+
+    db.create_all()
+    if fresh and 'migrate' in db.get_app().extensions:
+        _stamp_head()
+    progress.create(bind=db.engine, checkfirst=True)
+    drop_indexes()
+
+    counts = {}
+    for table_name, file_name, numbered in LOAD_ORDER:
+        path = os.path.join(directory, file_name)
+        if os.path.exists(path):
+            counts[table_name] = load_csv(
+                path, db.metadata.tables[table_name], numbered,
+                chunk_size=chunk_size, report=report)
+
+    if _is_postgres():
+        _reset_sequences()
+
+    report("Building message and follow indexes...")
+    create_recompute_indexes()
+
+    report("Recomputing counters...")
+    repair_counters()
+
+    report("Rebuilding timelines...")
+    rebuild_timelines()
+    db.session.commit()
+
+    report("Building remaining indexes...")
+    create_indexes()
+
+    if _is_postgres():
+        with db.engine.begin() as conn:
+            conn.execute("ANALYZE")
+
+    # finished: from now on the database is in use, not ours to reload
+    progress.drop(bind=db.engine)
+
+    return counts
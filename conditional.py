@@ -0,0 +1,122 @@
+"""Conditional GETs for pages built from users' rows.
+
+A profile, a message or a follower list only changes when one of a few
+users' rows changes. Anything that affects them updates `User.updated_at`:
+profile edits, posts, deletes, follows and likes (through the counters).
+The logged-in viewer's own row is included too, because pages show the
+viewer's follow and like state.
+
+So a page's validator is the latest `updated_at` among those users. It is
+one aggregate query, and on a match we answer 304 without loading or
+rendering anything else. ETags also cover the viewer and the templates, so
+they change on logout or deploy.
+
+Last-Modified and If-Modified-Since only have whole seconds, so both sides
+of the comparison are truncated to the second. A second edit in the same
+second would share the first one's Last-Modified, so none is sent until
+that second is over; the ETag still tells the edits apart.
+
+Pages rendered while flash messages are pending are never validated: a 304
+would leave the flash unshown, and a cached copy would show it again.
+"""
+
+import hashlib
+import os
+from datetime import datetime, timedelta
+
+from flask import current_app, make_response, request, session
+from sqlalchemy import func, or_
+
+from models import db, User
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def template_version():
+    """Hash of the app's templates, so ETags change when they do."""
+
+    app = current_app._get_current_object()
+    version = app.extensions.get('template_version')
+
+    if version is None:
+        digest = hashlib.sha1()
+        folder = os.path.join(app.root_path, app.template_folder)
+        for root, dirs, files in sorted(os.walk(folder)):
+            for name in sorted(files):
+                with open(os.path.join(root, name), 'rb') as template:
+                    digest.update(template.read())
+        version = app.extensions['template_version'] = digest.hexdigest()
+
+    return version
+
+
+def users_modified(user_ids, related=None):
+    """Latest `updated_at` of `user_ids` and the ids `related` selects."""
+
+    criterion = User.id.in_(user_ids)
+    if related is not None:
+        criterion = or_(criterion, User.id.in_(related))
+
+    modified = (db.session.query(func.max(User.updated_at))
+                .filter(criterion)
+                .scalar())
+
+    return modified or EPOCH
+
+
+def _last_modified(modified):
+    """`modified` to the second, or None while that second isn't over."""
+
+    last_modified = modified.replace(microsecond=0)
+    if last_modified + timedelta(seconds=1) > datetime.utcnow():
+        return None
+
+    return last_modified
+
+
+def _is_current(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+
+    since = request.if_modified_since
+    if since is not None and last_modified is not None:
+        return last_modified <= since.replace(tzinfo=None)
+
+    return False
+
+
+def conditional(render, viewer, user_ids, related=None, key=None):
+    """Response for a page showing `user_ids`' (and `related`'s) rows.
+
+    `viewer` is the logged-in user or None, and `key` anything else the page
+    depends on. Returns 304 if the client's copy is current; otherwise calls
+    `render()` and adds validators to its response.
+    """
+
+    if '_flashes' in session:
+        return render()
+
+    viewer_id = viewer.id if viewer else None
+    user_ids = set(user_ids)
+    if viewer_id:
+        user_ids.add(viewer_id)
+
+    modified = users_modified(user_ids, related)
+    etag = hashlib.sha1(repr(
+        (template_version(), viewer_id, key, modified.isoformat())
+    ).encode('UTF-8')).hexdigest()
+
+    last_modified = _last_modified(modified)
+
+    if _is_current(etag, last_modified):
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(render())
+
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+
+    return response
@@ -0,0 +1,209 @@
+"""Denormalized per-user counters for Warbler.
+
+`User.message_count`, `following_count`, `follower_count` and `like_count`
+let profile and home pages show totals without loading whole relationship
+collections. They are kept up to date by session flush hooks, so every ORM
+write (a route adding a message, a follow appended to `user.following`, a
+like deleted, a user deleted) adjusts them in the same transaction as the
+rows it counts.
+
+Bulk inserts skip the ORM; run `flask repair-counters` after them.
+"""
+
+from collections import Counter
+
+from flask.signals import Namespace
+from sqlalchemy import event, func
+from sqlalchemy.orm import attributes
+from sqlalchemy.orm.util import identity_key
+from flask_sqlalchemy import SignallingSession
+
+from models import db, Follows, Likes, Message, User
+
+COUNTER_COLUMNS = ['message_count', 'following_count',
+                   'follower_count', 'like_count']
+
+# Sent with the ids of users whose counters a flush changed.
+counters_changed = Namespace().signal('counters-changed')
+
+USERS = User.__table__
+FOLLOWS = Follows.__table__
+LIKES = Likes.__table__
+MESSAGES = Message.__table__
+
+
+def _row_deltas(obj, sign, deltas):
+    """Count one inserted (sign=1) or deleted (sign=-1) row."""
+
+    if isinstance(obj, Message):
+        deltas[obj.user_id, 'message_count'] += sign
+
+    elif isinstance(obj, Likes):
+        deltas[obj.user_id, 'like_count'] += sign
+
+    elif isinstance(obj, Follows):
+        deltas[obj.user_following_id, 'following_count'] += sign
+        deltas[obj.user_being_followed_id, 'follower_count'] += sign
+
+
+def _collection_deltas(user, deltas):
+    """Count follows and likes written through `user`'s collections."""
+
+    following = attributes.get_history(user, 'following')
+    for other in following.added:
+        deltas[user.id, 'following_count'] += 1
+        deltas[other.id, 'follower_count'] += 1
+    for other in following.deleted:
+        deltas[user.id, 'following_count'] -= 1
+        deltas[other.id, 'follower_count'] -= 1
+
+    followers = attributes.get_history(user, 'followers')
+    for other in followers.added:
+        deltas[user.id, 'follower_count'] += 1
+        deltas[other.id, 'following_count'] += 1
+    for other in followers.deleted:
+        deltas[user.id, 'follower_count'] -= 1
+        deltas[other.id, 'following_count'] -= 1
+
+    likes = attributes.get_history(user, 'likes')
+    deltas[user.id, 'like_count'] += len(likes.added) - len(likes.deleted)
+
+
+def _discount_cascades(session, messages, users):
+    """Adjust counters for rows the database will cascade-delete.
+
+    Likes of deleted messages, and the follows and likes of deleted users,
+    vanish without passing through the ORM, so they are accounted for
+    before the DELETEs run.
+    """
+
+    message_ids = [msg.id for msg in messages]
+    if message_ids:
+        likers = (db.select([LIKES.c.user_id])
+                  .where(LIKES.c.message_id.in_(message_ids)))
+        session.execute(_decrement_in('like_count', likers, message_ids))
+
+    for user in users:
+        followed = (db.select([FOLLOWS.c.user_being_followed_id])
+                    .where(FOLLOWS.c.user_following_id == user.id))
+        session.execute(
+            USERS.update()
+            .where(USERS.c.id.in_(followed))
+            .values(follower_count=USERS.c.follower_count - 1))
+
+        followers = (db.select([FOLLOWS.c.user_following_id])
+                     .where(FOLLOWS.c.user_being_followed_id == user.id))
+        session.execute(
+            USERS.update()
+            .where(USERS.c.id.in_(followers))
+            .values(following_count=USERS.c.following_count - 1))
+
+        authored = db.select([MESSAGES.c.id]).where(
+            MESSAGES.c.user_id == user.id)
+        likers = (db.select([LIKES.c.user_id])
+                  .where(LIKES.c.message_id.in_(authored)))
+        session.execute(_decrement_in('like_count', likers, authored))
+
+
+def _decrement_in(column, likers, message_ids):
+    """UPDATE each liker's `column` by their likes of `message_ids`."""
+
+    liked = (db.select([func.count()])
+             .where(LIKES.c.user_id == USERS.c.id)
+             .where(LIKES.c.message_id.in_(message_ids))
+             .as_scalar())
+
+    return (USERS.update()
+            .where(USERS.c.id.in_(likers))
+            .values({column: USERS.c[column] - liked}))
+
+
+@event.listens_for(SignallingSession, 'before_flush')
+def _before_flush(session, flush_context, instances):
+    users = [obj for obj in session.deleted if isinstance(obj, User)]
+    user_ids = {user.id for user in users}
+
+    # a deleted user's own messages are accounted for with the user
+    messages = [obj for obj in session.deleted
+                if isinstance(obj, Message) and obj.user_id not in user_ids]
+
+    if messages or users:
+        _discount_cascades(session, messages, users)
+
+
+@event.listens_for(SignallingSession, 'after_flush')
+def _after_flush(session, flush_context):
+    deltas = Counter()
+
+    for obj in session.new:
+        _row_deltas(obj, 1, deltas)
+
+    for obj in session.deleted:
+        _row_deltas(obj, -1, deltas)
+
+    for obj in session.new | session.dirty:
+        if isinstance(obj, User):
+            _collection_deltas(obj, deltas)
+
+    for (user_id, column), delta in deltas.items():
+        if delta:
+            session.execute(
+                USERS.update()
+                .where(USERS.c.id == user_id)
+                .values({column: USERS.c[column] + delta}))
+
+    session.info.setdefault('recounted_user_ids', set()).update(
+        user_id for (user_id, _), delta in deltas.items() if delta)
+
+
+@event.listens_for(SignallingSession, 'after_flush_postexec')
+def _expire_counters(session, flush_context):
+    """Make loaded users re-read counters the flush just changed."""
+
+    user_ids = session.info.pop('recounted_user_ids', set())
+
+    for user_id in user_ids:
+        user = session.identity_map.get(identity_key(User, user_id))
+        if user is not None:
+            session.expire(user, COUNTER_COLUMNS)
+
+    if user_ids:
+        counters_changed.send(session, user_ids=user_ids)
+
+
+def repair_counters(batch_size=10000):
+    """Recompute every user's counters from the rows they count.
+
+    Works through users in id ranges of `batch_size`, committing each range
+    so a large table isn't locked in one transaction. Returns the number of
+    users recomputed.
+    """
+
+    counts = {
+        'message_count': (MESSAGES, MESSAGES.c.user_id),
+        'following_count': (FOLLOWS, FOLLOWS.c.user_following_id),
+        'follower_count': (FOLLOWS, FOLLOWS.c.user_being_followed_id),
+        'like_count': (LIKES, LIKES.c.user_id),
+    }
+    values = {
+        column: (db.select([func.count()])
+                 .select_from(table)
+                 .where(owner == USERS.c.id)
+                 .as_scalar())
+        for column, (table, owner) in counts.items()
+    }
+
+    low, high = db.session.query(func.min(User.id), func.max(User.id)).one()
+    if low is None:
+        return 0
+
+    repaired = 0
+    for start in range(low, high + 1, batch_size):
+        result = db.session.execute(
+            USERS.update()
+            .where(USERS.c.id.between(start, start + batch_size - 1))
+            .values(values))
+        db.session.commit()
+        repaired += result.rowcount
+
+    return repaired
@@ -0,0 +1,209 @@
+"""Database connection pool settings and metrics.
+
+Engines for PostgreSQL get their pool settings from the app config, which
+app.py fills from the environment:
+
+    DB_POOL_SIZE       connections each worker process keeps open
+    DB_MAX_OVERFLOW    extra connections it may open under load
+    DB_POOL_TIMEOUT    seconds a request waits for a connection
+    DB_POOL_RECYCLE    seconds after which a connection is replaced
+    DB_POOL_PRE_PING   check each connection is alive before using it
+    DB_PGBOUNCER       connect through PgBouncer in transaction mode
+
+PgBouncer mode drops the app-side pool (each checkout is a new, cheap
+connection to PgBouncer, closed when the transaction ends), so a server
+connection is held only for the length of a transaction. psycopg2 never
+uses server-side prepared statements, which transaction pooling can't
+carry between transactions. Session state doesn't survive either, so
+LIVE_BROKER 'postgres' needs its own session-mode PgBouncer or a direct
+URL. Keep transactions short in PgBouncer itself with
+`idle_transaction_timeout`.
+
+The pools record checkouts, the time spent waiting for a connection,
+timeouts, peak use including overflow, new connections and the time spent
+opening them, and invalidations (`pool_stats(engine)`). Opening a
+connection is timed from the pool's `connect` event and not counted as
+waiting: a long wait means the pool is too small, a long connect means the
+database (or PgBouncer) is slow to accept. Each request's wait and connect
+times are added to its SQL stats (see sql_stats.py), which puts them in the
+Server-Timing header and the `warbler.sql` log. That is the data for sizing
+pools and worker counts.
+"""
+
+from threading import Lock, local
+from time import perf_counter, time
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, exc
+from sqlalchemy.pool import NullPool, QueuePool
+
+from sql_stats import current_stats
+
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_OVERFLOW = 10
+DEFAULT_POOL_TIMEOUT = 30
+DEFAULT_POOL_RECYCLE = 1800
+
+# seconds this thread spent opening connections during its current checkout
+_connecting = local()
+
+
+class PoolStats:
+    """Running totals for one engine's pool."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.checkouts = 0
+        self.checked_out = 0
+        self.peak_checked_out = 0
+        self.wait_seconds = 0
+        self.max_wait_seconds = 0
+        self.timeouts = 0
+        self.connects = 0
+        self.connect_seconds = 0
+        self.invalidations = 0
+
+    def checked_out_one(self, waited):
+        with self.lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.peak_checked_out = max(self.peak_checked_out,
+                                        self.checked_out)
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+    def returned_one(self):
+        with self.lock:
+            self.checked_out -= 1
+
+    def timed_out(self):
+        with self.lock:
+            self.timeouts += 1
+
+    def connected(self, seconds):
+        with self.lock:
+            self.connects += 1
+            self.connect_seconds += seconds
+
+    def invalidated(self, *args):
+        with self.lock:
+            self.invalidations += 1
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'checkouts': self.checkouts,
+                'checked_out': self.checked_out,
+                'peak_checked_out': self.peak_checked_out,
+                'wait_ms': round(self.wait_seconds * 1000, 2),
+                'max_wait_ms': round(self.max_wait_seconds * 1000, 2),
+                'timeouts': self.timeouts,
+                'connects': self.connects,
+                'connect_ms': round(self.connect_seconds * 1000, 2),
+                'invalidations': self.invalidations,
+            }
+
+
+class InstrumentedPool:
+    """Mixin recording a pool's activity in `pool.stats` (a PoolStats)."""
+
+    def __init__(self, creator, **kw):
+        super().__init__(creator, **kw)
+        self.stats = PoolStats()
+
+        # a recreated pool (after dispose) keeps the old one's listeners
+        if '_dispatch' not in kw:
+            event.listen(self, 'connect', self._record_connect)
+            event.listen(self, 'invalidate', self.stats.invalidated)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+    def _record_connect(self, dbapi_connection, connection_record):
+        # the record notes when it started connecting
+        seconds = time() - connection_record.starttime
+        # self.stats is shared with pools recreated from this one
+        self.stats.connected(seconds)
+        _connecting.seconds = getattr(_connecting, 'seconds', 0) + seconds
+
+        request_stats = current_stats()
+        if request_stats is not None:
+            request_stats.opened_connection(seconds)
+
+    def _do_get(self):
+        _connecting.seconds = 0
+        started = perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.stats.timed_out()
+            raise
+
+        waited = max(0, perf_counter() - started - _connecting.seconds)
+        self.stats.checked_out_one(waited)
+
+        request_stats = current_stats()
+        if request_stats is not None:
+            request_stats.waited_for_connection(waited)
+
+        return connection
+
+    def _do_return_conn(self, connection):
+        self.stats.returned_one()
+        super()._do_return_conn(connection)
+
+
+class InstrumentedQueuePool(InstrumentedPool, QueuePool):
+    """QueuePool with stats."""
+
+
+class InstrumentedNullPool(InstrumentedPool, NullPool):
+    """NullPool (a new connection per checkout) with stats."""
+
+
+def engine_options(config):
+    """create_engine() pool options for a PostgreSQL engine."""
+
+    if config.get('DB_PGBOUNCER'):
+        return {'poolclass': InstrumentedNullPool}
+
+    return {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': config.get('DB_POOL_SIZE', DEFAULT_POOL_SIZE),
+        'max_overflow': config.get('DB_MAX_OVERFLOW', DEFAULT_MAX_OVERFLOW),
+        'pool_timeout': config.get('DB_POOL_TIMEOUT', DEFAULT_POOL_TIMEOUT),
+        'pool_recycle': config.get('DB_POOL_RECYCLE', DEFAULT_POOL_RECYCLE),
+        'pool_pre_ping': config.get('DB_POOL_PRE_PING', True),
+    }
+
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy giving PostgreSQL engines the configured pool."""
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        result = super().apply_driver_hacks(app, sa_url, options)
+        if result is not None:
+            # Flask-SQLAlchemy 2.5 returns them, possibly changed
+            sa_url, options = result
+
+        if sa_url.drivername.startswith('postgres'):
+            options.update(engine_options(app.config))
+
+        return sa_url, options
+
+
+def pool_stats(engine):
+    """`engine`'s pool totals, with its configured size; None if unknown."""
+
+    pool = engine.pool
+    if not isinstance(pool, InstrumentedPool):
+        return None
+
+    stats = pool.stats.as_dict()
+    if isinstance(pool, QueuePool):
+        stats['size'] = pool.size()
+        stats['max_overflow'] = pool._max_overflow
+
+    return stats
@@ -0,0 +1,123 @@
+"""Cache of rendered message list items.
+
+Every timeline, profile and search page renders the same markup for each
+message it lists: the author's avatar and name, the timestamp and the text.
+None of that changes once the message exists, except when its author
+changes their username or avatar, which bumps `User.profile_version`. So
+the markup is rendered once from messages/_message.html and cached under
+(message id and timestamp, author's profile version, template version).
+Everything that depends on who is looking, like the like button, is
+rendered per request around it.
+
+The cache is an in-process LRU of FRAGMENT_CACHE_SIZE entries. Set
+FRAGMENT_CACHE to a shared cache to also share fragments between processes.
+Anything with cachelib's `get_many(*keys)` / `set_many(mapping)` interface
+works, e.g. a MemcachedCache or RedisCache. A new profile version means
+new keys, so stale fragments are never served and simply age out.
+
+Templates fetch a page's fragments in one batch:
+
+    {% set fragments = message_fragments(messages) %}
+    ... {{ fragments[msg.id] }} ...
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+from flask import current_app, render_template
+from markupsafe import Markup
+
+from conditional import template_version
+
+DEFAULT_SIZE = 10000
+FRAGMENT_TEMPLATE = 'messages/_message.html'
+
+
+class LRUFragmentCache:
+    """Bounded in-process cache, least recently used entries dropped first.
+
+    Has the `get_many`/`set_many` half of cachelib's interface, so it can
+    stand in for (or in front of) a shared cache.
+    """
+
+    def __init__(self, max_entries=DEFAULT_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get_many(self, *keys):
+        values = []
+        with self.lock:
+            for key in keys:
+                value = self.entries.get(key)
+                if value is not None:
+                    self.entries.move_to_end(key)
+                values.append(value)
+        return values
+
+    def set_many(self, mapping, timeout=None):
+        with self.lock:
+            for key, value in mapping.items():
+                self.entries[key] = value
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return True
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def _local_cache():
+    app = current_app._get_current_object()
+    cache = app.extensions.get('message_fragments')
+
+    if cache is None:
+        cache = LRUFragmentCache(app.config.get('FRAGMENT_CACHE_SIZE',
+                                                DEFAULT_SIZE))
+        app.extensions['message_fragments'] = cache
+
+    return cache
+
+
+def fragment_key(msg):
+    # The timestamp guards against ids reused after the table is rebuilt.
+    return (f"message:{template_version()[:12]}:{msg.id}:"
+            f"{msg.timestamp.timestamp()}:{msg.user.profile_version}")
+
+
+def message_fragments(messages):
+    """{message id: rendered markup} for `messages`, rendering misses."""
+
+    local = _local_cache()
+    shared = current_app.config.get('FRAGMENT_CACHE')
+
+    keys = [fragment_key(msg) for msg in messages]
+    found = dict(zip(keys, local.get_many(*keys)))
+
+    missing = [key for key in keys if found[key] is None]
+    if missing and shared is not None:
+        from_shared = {key: html for key, html
+                       in zip(missing, shared.get_many(*missing)) if html}
+        local.set_many(from_shared)
+        found.update(from_shared)
+
+    rendered = {}
+    for key, msg in zip(keys, messages):
+        if found[key] is None:
+            rendered[key] = render_template(FRAGMENT_TEMPLATE, msg=msg)
+            found[key] = rendered[key]
+
+    if rendered:
+        local.set_many(rendered)
+        if shared is not None:
+            shared.set_many(rendered)
+
+    return {msg.id: Markup(found[key]) for key, msg in zip(keys, messages)}
+
+
+def init_app(app):
+    """Make `message_fragments` available to templates."""
+
+    app.add_template_global(message_fragments)
@@ -2,7 +2,8 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows. For large datasets (or
+without network access) use synthetic.py instead.
 """
 
 import csv
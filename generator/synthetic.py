@@ -0,0 +1,253 @@
+"""Generate large synthetic Warbler datasets, offline and in bounded memory.
+
+create_csvs.py makes the small sample dataset. It needs the network and
+builds every follower pair in memory. This script writes users.csv,
+messages.csv, follows.csv and likes.csv for production-sized datasets
+instead, one row at a time:
+
+- Who gets followed is drawn from a power law over "popularity ranks", so
+  a few users have huge follower counts and most have a handful. Message
+  authorship is drawn the same way, from a different ranking.
+- Messages come in bursts: an author posts several in quick succession, and
+  bursts are spread over the whole time span.
+- Each follower's (or liker's) picks are de-duplicated with a set of their
+  own picks, so memory doesn't grow with the dataset.
+- The same --seed always produces the same files.
+- Images point at files in static/images, and all text comes from a
+  built-in word list, so nothing is fetched.
+
+Run from the repo root, then load the output with `flask bulk-load`:
+
+    python generator/synthetic.py --users 10000000 --messages 100000000 \\
+        --out generator/synthetic
+"""
+
+import argparse
+import csv
+import os
+from datetime import datetime, timedelta
+from math import gcd, log
+from random import Random
+
+USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio',
+                     'header_image_url', 'location']
+MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
+FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
+
+MAX_WARBLER_LENGTH = 140
+
+# bcrypt hash of "password", as in create_csvs.py
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+IMAGE_URL = '/static/images/default-pic.png'
+HEADER_IMAGE_URL = '/static/images/warbler-hero.jpg'
+
+WORDS = """
+    able about after again air all almost also always among animal answer
+    area around back bank beat bird black blue boat book both bright bring
+    build busy call calm care carry case catch center chance change city
+    class clear close cloud cold color come common cook cool copy corner
+    country course cover cross crowd dance dark deep door down draw dream
+    drive early earth east easy edge even event every face fact fall family
+    farm fast field fight fill final find fine fire first fish floor flower
+    follow food force forest form free fresh friend front fruit full game
+    garden glass gold good great green ground group grow half hand happy
+    hard heart heavy high hill hold home hope horse hour house idea island
+    just keep kind king land large last late laugh learn leave letter light
+    line listen little live long look machine main make mark market matter
+    mean meet middle mind minute moment money moon morning mountain move
+    music name near never next night noise north note number ocean office
+    open order paper party pass peace people piece place plan plant play
+    point power press pretty quick quiet rain reach read ready real river
+    road rock room round rule run safe sail school science season seat
+    second sense ship short show side sign simple sing sleep slow small
+    smile snow song sound south space speak spring square stand star start
+    state station stay step stone stop store story street strong study
+    summer sun sure table tall teach team thing think through time today
+    together town track train travel tree true turn under until village
+    voice wait walk warm watch water wave weather week west while white
+    whole wild wind window winter wonder wood word work world write year
+    young
+""".split()
+
+PLACES = """
+    Ashford Bayview Brookfield Cedar Clearwater Eastwood Fairview Glenwood
+    Greenville Harbor Highland Kingsport Lakeside Maplewood Millbrook
+    Northgate Oakridge Pinecrest Riverside Rosewood Springfield Stonebridge
+    Westfield Willowdale
+""".split()
+
+
+class PowerLaw:
+    """Draws ids (of users or messages) whose popularity follows a power law.
+
+    Ranks 1..n are sampled from a continuous Pareto-like distribution with
+    exponent `alpha` by inverting its CDF, then mapped to ids through an
+    affine permutation `(a * rank + b) mod n`. That way the most popular
+    ids are scattered over the id range without storing a shuffle.
+    """
+
+    def __init__(self, rng, n, alpha):
+        self.rng = rng
+        self.n = n
+        self.alpha = alpha
+
+        self.a = rng.randrange(1, n + 1) if n > 1 else 1
+        while gcd(self.a, n) != 1:
+            self.a += 1
+        self.b = rng.randrange(n)
+
+    def rank(self):
+        u = self.rng.random()
+        if self.alpha == 1:
+            x = (self.n + 1) ** u
+        else:
+            power = 1 - self.alpha
+            x = (((self.n + 1) ** power - 1) * u + 1) ** (1 / power)
+        return min(int(x), self.n)
+
+    def __call__(self):
+        return (self.a * (self.rank() - 1) + self.b) % self.n + 1
+
+
+def geometric(rng, mean):
+    """A count >= 0 with the given mean, mostly small with a long tail."""
+
+    if mean <= 0:
+        return 0
+    p = 1 / (mean + 1)
+    return int(log(1 - rng.random()) / log(1 - p))
+
+
+def sentence(rng, min_words, max_words):
+    words = [rng.choice(WORDS)
+             for _ in range(rng.randint(min_words, max_words))]
+    return (' '.join(words).capitalize() + '.')[:MAX_WARBLER_LENGTH]
+
+
+def write_users(path, rng, num_users):
+    with open(path, 'w', newline='') as users_csv:
+        writer = csv.writer(users_csv)
+        writer.writerow(USERS_CSV_HEADERS)
+
+        for user_id in range(1, num_users + 1):
+            username = f"{rng.choice(WORDS)}{rng.choice(WORDS)}{user_id}"
+            writer.writerow([
+                f"{username}@example.com",
+                username,
+                IMAGE_URL,
+                PASSWORD,
+                sentence(rng, 4, 12),
+                HEADER_IMAGE_URL,
+                rng.choice(PLACES),
+            ])
+
+
+def write_messages(path, rng, num_users, num_messages, alpha, end, days,
+                   burst_size, burst_gap_minutes):
+    """Write messages in bursts by power-law-chosen authors."""
+
+    authors = PowerLaw(rng, num_users, alpha)
+    span = days * 24 * 60 * 60
+    written = 0
+
+    with open(path, 'w', newline='') as messages_csv:
+        writer = csv.writer(messages_csv)
+        writer.writerow(MESSAGES_CSV_HEADERS)
+
+        while written < num_messages:
+            author = authors()
+            timestamp = end - timedelta(seconds=rng.uniform(0, span))
+            burst = min(1 + geometric(rng, burst_size - 1),
+                        num_messages - written)
+
+            for _ in range(burst):
+                writer.writerow([sentence(rng, 3, 20), timestamp, author])
+                timestamp += timedelta(
+                    minutes=rng.expovariate(1 / burst_gap_minutes))
+
+            written += burst
+
+
+def write_pairs(path, headers, rng, num_users, mean, pick, pick_limit,
+                row, exclude_self=False):
+    """Write ~`mean` distinct picks per user as `row(user_id, picked)`.
+
+    Used for follows (picks are followed users) and likes (picks are
+    messages). Returns the number of rows written.
+    """
+
+    written = 0
+
+    with open(path, 'w', newline='') as pairs_csv:
+        writer = csv.writer(pairs_csv)
+        writer.writerow(headers)
+
+        for user_id in range(1, num_users + 1):
+            wanted = min(geometric(rng, mean), pick_limit)
+            picked = set()
+            attempts = 0
+
+            # popular picks repeat often; give up rather than spin
+            while len(picked) < wanted and attempts < wanted * 10:
+                attempts += 1
+                choice = pick()
+                if not (exclude_self and choice == user_id):
+                    picked.add(choice)
+
+            writer.writerows(row(user_id, choice) for choice in sorted(picked))
+            written += len(picked)
+
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--out', default='generator/synthetic',
+                        help="directory to write the CSVs to")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--follows-per-user', type=float, default=20,
+                        help="mean number of users each user follows")
+    parser.add_argument('--likes-per-user', type=float, default=5,
+                        help="mean number of messages each user likes")
+    parser.add_argument('--alpha', type=float, default=1.1,
+                        help="power-law exponent for popularity")
+    parser.add_argument('--burst-size', type=float, default=4,
+                        help="mean messages per posting burst")
+    parser.add_argument('--burst-gap', type=float, default=3,
+                        help="mean minutes between messages in a burst")
+    parser.add_argument('--days', type=float, default=730,
+                        help="time span the messages cover")
+    parser.add_argument('--end', type=datetime.fromisoformat,
+                        default=datetime(2020, 1, 1),
+                        help="timestamp of the latest burst start")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.out, exist_ok=True)
+    rng = Random(args.seed)
+
+    write_users(os.path.join(args.out, 'users.csv'), rng, args.users)
+
+    write_messages(os.path.join(args.out, 'messages.csv'), rng, args.users,
+                   args.messages, args.alpha, args.end, args.days,
+                   args.burst_size, args.burst_gap)
+
+    followed = PowerLaw(rng, args.users, args.alpha)
+    write_pairs(os.path.join(args.out, 'follows.csv'), FOLLOWS_CSV_HEADERS,
+                rng, args.users, args.follows_per_user, followed,
+                args.users - 1,
+                row=lambda follower, followee: [followee, follower],
+                exclude_self=True)
+
+    if args.messages:
+        liked = PowerLaw(rng, args.messages, args.alpha)
+        write_pairs(os.path.join(args.out, 'likes.csv'), LIKES_CSV_HEADERS,
+                    rng, args.users, args.likes_per_user, liked,
+                    args.messages,
+                    row=lambda user_id, message_id: [user_id, message_id])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""Background jobs, queued in the database.
+
+Work too slow for a request (purging a deleted account, see accounts.py)
+is queued as a row in `jobs`, in the same transaction as the change that
+needs it, so the job exists exactly when the change does:
+
+    enqueue('purge-user', user_id=user.id)
+    db.session.commit()
+
+Worker processes run the jobs as they come due:
+
+    flask worker
+
+Start as many as the queue needs. Each claims one job at a time with
+SELECT ... FOR UPDATE SKIP LOCKED, so workers neither wait on each other
+nor run the same job. A job that raises is retried up to JOB_MAX_ATTEMPTS
+times, JOB_RETRY_DELAY seconds later, doubling after each failure; after
+that it is marked failed and its error kept in `last_error`. A job still
+running JOB_LOCK_TIMEOUT seconds after it was claimed is taken to belong
+to a worker that died, and is claimed again. Jobs can therefore run more
+than once, so each must be safe to repeat.
+"""
+
+import json
+import logging
+from datetime import datetime, timedelta
+from time import sleep
+
+from sqlalchemy import and_, or_
+
+from models import db, Job
+
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_RETRY_DELAY = 30
+DEFAULT_LOCK_TIMEOUT = 600
+DEFAULT_POLL_INTERVAL = 1
+
+logger = logging.getLogger('warbler.jobs')
+
+# job kind: the function that runs it (see `job`)
+JOBS = {}
+
+
+def _config(key, default):
+    return db.get_app().config.get(key, default)
+
+
+def job(kind):
+    """Register the decorated function to run jobs of `kind`."""
+
+    def register(func):
+        JOBS[kind] = func
+        return func
+
+    return register
+
+
+def enqueue(kind, **args):
+    """Add a `kind` job, to be called with `args`; the caller commits.
+
+    `args` must be JSON-serializable.
+    """
+
+    if kind not in JOBS:
+        raise ValueError(f"Unknown job kind {kind!r}")
+
+    queued = Job(kind=kind, args=json.dumps(args))
+    db.session.add(queued)
+    return queued
+
+
+def claim():
+    """The next due job, now marked running; None if no job is due."""
+
+    max_attempts = _config('JOB_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS)
+    lock_timeout = _config('JOB_LOCK_TIMEOUT', DEFAULT_LOCK_TIMEOUT)
+
+    while True:
+        now = datetime.utcnow()
+        stale = now - timedelta(seconds=lock_timeout)
+
+        claimed = (Job.query
+                   .filter(or_(and_(Job.status == 'queued',
+                                    Job.run_at <= now),
+                               and_(Job.status == 'running',
+                                    Job.locked_at < stale)))
+                   .order_by(Job.run_at)
+                   .with_for_update(skip_locked=True)
+                   .first())
+
+        if claimed is None:
+            db.session.rollback()
+            return None
+
+        if claimed.status == 'running' and claimed.attempts >= max_attempts:
+            # its worker died on the last attempt
+            claimed.status = 'failed'
+            claimed.last_error = "Worker stopped while running it"
+            claimed.finished_at = now
+            db.session.commit()
+            logger.error("%r failed: its worker stopped", claimed)
+            continue
+
+        claimed.status = 'running'
+        claimed.locked_at = now
+        claimed.attempts += 1
+        db.session.commit()
+        return claimed
+
+
+def run(claimed):
+    """Run a `claimed` job; mark it done, or queued to retry, or failed.
+
+    Returns whether it succeeded.
+    """
+
+    try:
+        JOBS[claimed.kind](**json.loads(claimed.args))
+
+    except Exception as e:
+        db.session.rollback()
+
+        claimed.locked_at = None
+        claimed.last_error = f"{type(e).__name__}: {e}"
+
+        if claimed.attempts >= _config('JOB_MAX_ATTEMPTS',
+                                       DEFAULT_MAX_ATTEMPTS):
+            claimed.status = 'failed'
+            claimed.finished_at = datetime.utcnow()
+            logger.exception("%r failed", claimed)
+        else:
+            delay = (_config('JOB_RETRY_DELAY', DEFAULT_RETRY_DELAY)
+                     * 2 ** (claimed.attempts - 1))
+            claimed.status = 'queued'
+            claimed.run_at = datetime.utcnow() + timedelta(seconds=delay)
+            logger.warning("%r failed, retrying in %ss", claimed, delay,
+                           exc_info=True)
+
+        db.session.commit()
+        return False
+
+    claimed.status = 'done'
+    claimed.locked_at = None
+    claimed.finished_at = datetime.utcnow()
+    db.session.commit()
+    return True
+
+
+def work(burst=False, poll_interval=None):
+    """Run jobs as they come due.
+
+    Runs forever, checking for due jobs every `poll_interval` seconds when
+    the queue is empty; with `burst`, returns once no job is due. Returns
+    the number of jobs run.
+    """
+
+    poll_interval = poll_interval or _config('JOB_POLL_INTERVAL',
+                                             DEFAULT_POLL_INTERVAL)
+    ran = 0
+
+    while True:
+        claimed = claim()
+        if claimed is None:
+            if burst:
+                return ran
+            sleep(poll_interval)
+            continue
+
+        run(claimed)
+        ran += 1
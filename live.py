@@ -0,0 +1,338 @@
+"""Live home timeline updates over Server-Sent Events.
+
+A logged-in client opens /api/timeline/events and is sent each new message
+from the users it follows, and its own, as soon as `messages_add` commits
+it:
+
+    id: 2024-01-01T12:00:00.000000_1234
+    event: message
+    data: {"id":1234,"text":"...","username":"...",...}
+
+The data has the JSON API's message fields (see api.py), and the id is the
+message's timeline cursor. Clients add the deltas to the page they already
+have, rather than reloading `/`. A client that reconnects with a
+Last-Event-ID header (as EventSource does by itself) is first sent the
+timeline messages newer than that cursor, so nothing posted while it was
+away is lost; if it missed more than LIVE_QUEUE_SIZE it is sent `reset`.
+
+Messages reach a worker's connections through a broker. LIVE_BROKER
+'local' (the default) delivers them within the process, which is enough
+for a single worker. 'postgres' sends them through LISTEN/NOTIFY on
+NOTIFY_CHANNEL, so every worker hears about messages posted to any of them.
+It needs a session-level connection to LISTEN on, so it can't be used
+with DB_PGBOUNCER (transaction pooling).
+Either way, a worker looks up which of its connected users follow the
+author and loads the message once for all of them.
+
+Each connection has a bounded queue of LIVE_QUEUE_SIZE events. A client
+that falls that far behind is sent a `reset` event and disconnected, since
+reloading its page is cheaper than buffering without limit. Idle
+connections get a comment every LIVE_HEARTBEAT seconds, which keeps
+proxies from closing them and notices clients that left. A worker serves
+at most LIVE_MAX_CONNECTIONS streams and answers 503 past that. Each
+stream holds a thread, so run workers with enough threads (or gevent).
+"""
+
+import logging
+import select
+import threading
+from collections import defaultdict
+from queue import Empty, Full, Queue
+
+from flask import Response, current_app, request
+from sqlalchemy import text
+
+import api
+from models import db, Follows, Message
+from timelines import decode_cursor, encode_cursor, home_timeline_since
+
+logger = logging.getLogger('warbler.live')
+
+DEFAULT_MAX_CONNECTIONS = 100
+DEFAULT_QUEUE_SIZE = 100
+DEFAULT_HEARTBEAT = 15
+
+# how long browsers wait before reconnecting a dropped stream
+RETRY_MILLISECONDS = 5000
+
+NOTIFY_CHANNEL = 'warbler_messages'
+
+
+class TooManyConnections(Exception):
+    """This worker already serves LIVE_MAX_CONNECTIONS streams."""
+
+
+def _event(row, fields):
+    """The (id, data) of the event for message `row`."""
+
+    return (encode_cursor(row),
+            api.dumps({field: getattr(row, field) for field in fields})
+            .decode('UTF-8'))
+
+
+class Subscription:
+    """One open stream: the user it's for and its pending events."""
+
+    def __init__(self, user_id, queue_size):
+        self.user_id = user_id
+        self.events = Queue(maxsize=queue_size)
+        self.overflowed = False
+
+    def put(self, event):
+        try:
+            self.events.put_nowait(event)
+        except Full:
+            self.overflowed = True
+
+
+class Hub:
+    """A worker's open streams, and delivery of new messages to them."""
+
+    def __init__(self, app, max_connections, queue_size):
+        self.app = app
+        self.max_connections = max_connections
+        self.queue_size = queue_size
+        self.subscriptions = defaultdict(set)
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    def connect(self, user_id):
+        """Subscribe `user_id`; raises TooManyConnections if full."""
+
+        with self.lock:
+            if self.connections >= self.max_connections:
+                raise TooManyConnections()
+            subscription = Subscription(user_id, self.queue_size)
+            self.subscriptions[user_id].add(subscription)
+            self.connections += 1
+
+        return subscription
+
+    def disconnect(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.user_id, ())
+            if subscription not in subscriptions:
+                return
+            subscriptions.remove(subscription)
+            if not subscriptions:
+                del self.subscriptions[subscription.user_id]
+            self.connections -= 1
+
+    def deliver(self, author_id, message_id):
+        """Send message `message_id` to connected followers of its author.
+
+        Needs an app context; costs two queries if anyone is connected.
+        """
+
+        with self.lock:
+            connected = set(self.subscriptions)
+        if not connected:
+            return
+
+        recipients = {author_id} & connected
+        others = connected - recipients
+        if others:
+            recipients.update(
+                user_id for (user_id,) in
+                db.session.query(Follows.user_following_id)
+                .filter(Follows.user_being_followed_id == author_id,
+                        Follows.user_following_id.in_(others)))
+        if not recipients:
+            return
+
+        fields = list(api.MESSAGE_FIELDS)
+        row = (api.message_query(fields)
+               .filter(Message.id == message_id)
+               .first())
+        if row is None:
+            return
+
+        event = _event(row, fields)
+
+        with self.lock:
+            for user_id in recipients:
+                for subscription in self.subscriptions.get(user_id, ()):
+                    subscription.put(event)
+
+
+class LocalBroker:
+    """Delivers messages to this process's hub only."""
+
+    def __init__(self, hub):
+        self.hub = hub
+
+    def start(self):
+        pass
+
+    def publish(self, author_id, message_id):
+        self.hub.deliver(author_id, message_id)
+
+
+class PostgresBroker:
+    """Delivers messages to every worker's hub with LISTEN/NOTIFY.
+
+    Each worker keeps one of its pool's connections LISTENing, in a
+    background thread started with the worker's first stream.
+    """
+
+    def __init__(self, hub):
+        self.hub = hub
+        self.heartbeat = hub.app.config.get('LIVE_HEARTBEAT',
+                                            DEFAULT_HEARTBEAT)
+        self.started = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if not self.started:
+                threading.Thread(target=self.listen, daemon=True,
+                                 name='warbler-live-listener').start()
+                self.started = True
+
+    def publish(self, author_id, message_id):
+        db.session.execute(text("SELECT pg_notify(:channel, :payload)"),
+                           {'channel': NOTIFY_CHANNEL,
+                            'payload': f"{author_id}:{message_id}"})
+        db.session.commit()
+
+    def listen(self):
+        while True:
+            try:
+                self._listen_once()
+            except Exception:
+                logger.exception("Live update listener failed; restarting")
+                threading.Event().wait(RETRY_MILLISECONDS / 1000)
+
+    def _listen_once(self):
+        with self.hub.app.app_context():
+            pooled = db.engine.raw_connection()
+
+        # psycopg2's own connection, for poll() and notifies
+        connection = pooled.connection
+        try:
+            connection.set_session(autocommit=True)
+            connection.cursor().execute(f"LISTEN {NOTIFY_CHANNEL}")
+
+            while True:
+                select.select([connection], [], [], self.heartbeat)
+                connection.poll()
+                while connection.notifies:
+                    notify = connection.notifies.pop(0)
+                    author_id, message_id = map(int,
+                                                notify.payload.split(':'))
+                    with self.hub.app.app_context():
+                        self.hub.deliver(author_id, message_id)
+        finally:
+            # autocommit and LISTENing: not fit to go back to the pool
+            pooled.invalidate()
+
+
+BROKERS = {
+    'local': LocalBroker,
+    'postgres': PostgresBroker,
+}
+
+
+def _live():
+    return current_app.extensions['live']
+
+
+def publish(msg):
+    """Tell connected followers about `msg`; call once it's committed."""
+
+    hub, broker = _live()
+    try:
+        broker.publish(msg.user_id, msg.id)
+    except Exception:
+        # the message is saved; followers will see it when they reload
+        logger.exception("Couldn't publish message %s", msg.id)
+
+
+def _missed_events(subscription, after):
+    """Events for `subscription`'s timeline messages newer than `after`.
+
+    Sets `subscription.overflowed` instead if there are more than would
+    fit in its queue.
+    """
+
+    fields = list(api.MESSAGE_FIELDS)
+    size = subscription.events.maxsize
+    rows = home_timeline_since(subscription.user_id, after, size,
+                               api.message_query(fields))
+    if len(rows) > size:
+        subscription.overflowed = True
+        return []
+
+    return [_event(row, fields) for row in rows]
+
+
+def event_stream(user_id):
+    """The SSE response streaming new timeline messages to `user_id`.
+
+    Messages newer than the request's Last-Event-ID are sent first. Raises
+    TooManyConnections if this worker has no stream to spare.
+    """
+
+    last_event_id = request.headers.get('Last-Event-ID')
+    try:
+        after = decode_cursor(last_event_id) if last_event_id else None
+    except ValueError:
+        raise api.APIError(400, "Invalid Last-Event-ID")
+
+    hub, broker = _live()
+    broker.start()
+    subscription = hub.connect(user_id)
+    heartbeat = current_app.config.get('LIVE_HEARTBEAT', DEFAULT_HEARTBEAT)
+
+    # subscribed first, so a message posted during the catch-up read is
+    # queued too; it is skipped below if the read already had it
+    missed = []
+    if after:
+        try:
+            missed = _missed_events(subscription, after)
+        except Exception:
+            hub.disconnect(subscription)
+            raise
+    replayed = {event_id for event_id, data in missed}
+
+    def generate():
+        yield f"retry: {RETRY_MILLISECONDS}\n\n"
+
+        for event_id, data in missed:
+            yield f"id: {event_id}\nevent: message\ndata: {data}\n\n"
+
+        while not subscription.overflowed:
+            try:
+                event_id, data = subscription.events.get(timeout=heartbeat)
+            except Empty:
+                yield ": heartbeat\n\n"
+                continue
+
+            if event_id in replayed:
+                continue
+            yield f"id: {event_id}\nevent: message\ndata: {data}\n\n"
+
+        yield "event: reset\ndata: {}\n\n"
+
+    response = Response(generate(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache',
+                                 'X-Accel-Buffering': 'no'})
+    # runs when the client goes away, even if nothing was sent yet
+    response.call_on_close(lambda: hub.disconnect(subscription))
+    return response
+
+
+def init_app(app):
+    """Set up `app`'s hub and the broker named by LIVE_BROKER."""
+
+    if (app.config.get('LIVE_BROKER') == 'postgres'
+            and app.config.get('DB_PGBOUNCER')):
+        raise ValueError("LIVE_BROKER 'postgres' needs LISTEN, which "
+                         "PgBouncer's transaction pooling doesn't support; "
+                         "use a direct database connection")
+
+    hub = Hub(app,
+              app.config.get('LIVE_MAX_CONNECTIONS', DEFAULT_MAX_CONNECTIONS),
+              app.config.get('LIVE_QUEUE_SIZE', DEFAULT_QUEUE_SIZE))
+    broker = BROKERS[app.config.get('LIVE_BROKER', 'local')](hub)
+    app.extensions['live'] = (hub, broker)
@@ -0,0 +1,81 @@
+"""baseline schema
+
+The tables as `db.create_all()` built them before the timeline, counter and
+search work: no counters, no timeline entries, and likes unique on
+message_id alone. Databases created that way are at this revision:
+
+    flask db stamp 126b7f5e783f
+
+Revision ID: 126b7f5e783f
+Revises:
+Create Date: 2026-10-18 21:14:33.080311
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '126b7f5e783f'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'users',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('email', sa.Text(), nullable=False),
+        sa.Column('username', sa.Text(), nullable=False),
+        sa.Column('image_url', sa.Text(), nullable=True),
+        sa.Column('header_image_url', sa.Text(), nullable=True),
+        sa.Column('bio', sa.Text(), nullable=True),
+        sa.Column('location', sa.Text(), nullable=True),
+        sa.Column('password', sa.Text(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('email'),
+        sa.UniqueConstraint('username'),
+    )
+    op.create_table(
+        'follows',
+        sa.Column('user_being_followed_id', sa.Integer(), nullable=False),
+        sa.Column('user_following_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['user_being_followed_id'], ['users.id'],
+                                ondelete='cascade'),
+        sa.ForeignKeyConstraint(['user_following_id'], ['users.id'],
+                                ondelete='cascade'),
+        sa.PrimaryKeyConstraint('user_being_followed_id',
+                                'user_following_id'),
+    )
+    op.create_table(
+        'messages',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('text', sa.String(length=140), nullable=False),
+        sa.Column('timestamp', sa.DateTime(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'],
+                                ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    # the unique constraint is named as Postgres names it, so the next
+    # revision can drop it on any database
+    op.create_table(
+        'likes',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('message_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['message_id'], ['messages.id'],
+                                ondelete='cascade'),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'],
+                                ondelete='cascade'),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('message_id', name='likes_message_id_key'),
+    )
+
+
+def downgrade():
+    op.drop_table('likes')
+    op.drop_table('messages')
+    op.drop_table('follows')
+    op.drop_table('users')
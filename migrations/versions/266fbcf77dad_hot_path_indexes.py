@@ -0,0 +1,74 @@
+"""hot path indexes
+
+Composite indexes for the lookups every page makes:
+
+- messages (user_id, timestamp, id): a user's messages newest first, for
+  profiles and popular authors' timelines, matching the keyset cursor
+- follows (user_following_id, user_being_followed_id): who a user
+  follows; the primary key already answers who follows a user
+
+likes(user_id) is already served by the (user_id, message_id) unique
+constraint.
+
+On Postgres the indexes are built CONCURRENTLY, outside a transaction, so
+the tables stay writable during the build. An index left INVALID by an
+interrupted build is dropped and built again.
+
+Revision ID: 266fbcf77dad
+Revises: d8e41b7c2a90
+Create Date: 2026-10-18 21:14:33.888549
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '266fbcf77dad'
+down_revision = 'd8e41b7c2a90'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_messages_user_timestamp', 'messages',
+     ['user_id', 'timestamp', 'id']),
+    ('ix_follows_following_followed', 'follows',
+     ['user_following_id', 'user_being_followed_id']),
+]
+
+
+def _is_postgres():
+    return op.get_bind().dialect.name == 'postgresql'
+
+
+def _invalid(name):
+    """Is there an index `name` left unusable by a failed build?"""
+
+    return op.get_bind().execute(sa.text(
+        "SELECT NOT indisvalid FROM pg_index "
+        "WHERE indexrelid = to_regclass(:name)"), name=name).scalar()
+
+
+def upgrade():
+    if not _is_postgres():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns)
+        return
+
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            if _invalid(name):
+                op.execute(f"DROP INDEX CONCURRENTLY {name}")
+            op.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} "
+                       f"ON {table} ({', '.join(columns)})")
+
+
+def downgrade():
+    if not _is_postgres():
+        for name, table, columns in INDEXES:
+            op.drop_index(name, table)
+        return
+
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
@@ -0,0 +1,47 @@
+"""jobs and disabled users
+
+The background job queue (see jobs.py) and users.disabled_at, set when an
+account is deleted and its rows are queued for purging (see accounts.py).
+Adding a nullable column without a default doesn't rewrite the table.
+
+Revision ID: 4c1d2a9b7e35
+Revises: 266fbcf77dad
+Create Date: 2026-10-18 23:02:51.417206
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4c1d2a9b7e35'
+down_revision = '266fbcf77dad'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'jobs',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('kind', sa.Text(), nullable=False),
+        sa.Column('args', sa.Text(), nullable=False),
+        sa.Column('status', sa.Text(), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('run_at', sa.DateTime(), nullable=False),
+        sa.Column('locked_at', sa.DateTime(), nullable=True),
+        sa.Column('last_error', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_jobs_status_run_at', 'jobs', ['status', 'run_at'])
+    op.add_column('users', sa.Column('disabled_at', sa.DateTime(),
+                                     nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('disabled_at')
+    op.drop_index('ix_jobs_status_run_at', 'jobs')
+    op.drop_table('jobs')
@@ -0,0 +1,61 @@
+"""message pushed
+
+messages.pushed records whether a message was copied into its author's
+followers' timelines when posted; home timelines pull the ones that
+weren't (see timelines.py). Until now that was decided again at read time
+from the author's follower count, so it isn't recorded for existing
+messages: they are marked by the counts now, as reads treated them.
+
+The partial index covers just the unpushed messages, and is built
+CONCURRENTLY on Postgres.
+
+Revision ID: 7a3f0c5d9e21
+Revises: 4c1d2a9b7e35
+Create Date: 2026-10-19 10:41:07.532918
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from flask import current_app
+
+
+# revision identifiers, used by Alembic.
+revision = '7a3f0c5d9e21'
+down_revision = '4c1d2a9b7e35'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('messages') as batch_op:
+        batch_op.add_column(sa.Column('pushed', sa.Boolean(),
+                                      server_default=sa.true(),
+                                      nullable=False))
+
+    limit = current_app.config.get('TIMELINE_FANOUT_LIMIT', 10000)
+    op.execute(sa.text(
+        "UPDATE messages SET pushed = :unpushed WHERE user_id IN "
+        "(SELECT id FROM users WHERE follower_count >= :limit)")
+        .bindparams(unpushed=False, limit=limit))
+
+    if op.get_bind().dialect.name != 'postgresql':
+        op.create_index('ix_messages_unpushed', 'messages',
+                        ['user_id', 'timestamp', 'id'])
+        return
+
+    with op.get_context().autocommit_block():
+        op.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS "
+                   "ix_messages_unpushed ON messages "
+                   "(user_id, timestamp, id) WHERE NOT pushed")
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.execute("DROP INDEX CONCURRENTLY IF EXISTS "
+                       "ix_messages_unpushed")
+    else:
+        op.drop_index('ix_messages_unpushed', 'messages')
+
+    with op.batch_alter_table('messages') as batch_op:
+        batch_op.drop_column('pushed')
@@ -0,0 +1,55 @@
+"""user pulled
+
+users.pulled flags authors with messages that weren't pushed, so a home
+timeline finds the followed authors to pull from with one join instead of
+a probe of the unpushed messages index per followed user (see
+timelines.py). It's filled from the messages already unpushed.
+
+The partial index covers just the pulled users, and is built CONCURRENTLY
+on Postgres.
+
+Revision ID: b5e2f8a41c67
+Revises: 7a3f0c5d9e21
+Create Date: 2026-10-20 09:12:51.204117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5e2f8a41c67'
+down_revision = '7a3f0c5d9e21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.add_column(sa.Column('pulled', sa.Boolean(),
+                                      server_default=sa.false(),
+                                      nullable=False))
+
+    op.execute(sa.text(
+        "UPDATE users SET pulled = :pulled WHERE id IN "
+        "(SELECT user_id FROM messages WHERE NOT pushed)")
+        .bindparams(pulled=True))
+
+    if op.get_bind().dialect.name != 'postgresql':
+        op.create_index('ix_users_pulled', 'users', ['id'])
+        return
+
+    with op.get_context().autocommit_block():
+        op.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS "
+                   "ix_users_pulled ON users (id) WHERE pulled")
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_users_pulled")
+    else:
+        op.drop_index('ix_users_pulled', 'users')
+
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('pulled')
@@ -0,0 +1,168 @@
+"""counters, timelines and search
+
+Brings a baseline database up to the schema the app had when migrations
+were added:
+
+- users: message/following/follower/like counters, updated_at and
+  profile_version
+- timeline_entries, the materialized home timelines
+- likes unique on (user_id, message_id) instead of message_id alone, after
+  dropping duplicate likes
+- the Postgres username and message search indexes
+
+The new counters and timelines are filled from the existing rows, as
+`repair_counters` and `rebuild_timelines` would. That is done in SQL on
+the migration's connection rather than by calling them, since they use
+the app's session and models, which describe the latest schema, not this
+one.
+
+Each step is skipped when its column, table or index is already there, so
+a database created by `db.create_all()` at any point before migrations
+were added can be stamped at the baseline and upgraded.
+
+Revision ID: d8e41b7c2a90
+Revises: 126b7f5e783f
+Create Date: 2026-10-19 11:20:44.106385
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from flask import current_app
+
+
+# revision identifiers, used by Alembic.
+revision = 'd8e41b7c2a90'
+down_revision = '126b7f5e783f'
+branch_labels = None
+depends_on = None
+
+COUNTERS = {
+    'message_count': "SELECT count(*) FROM messages "
+                     "WHERE messages.user_id = users.id",
+    'following_count': "SELECT count(*) FROM follows "
+                       "WHERE follows.user_following_id = users.id",
+    'follower_count': "SELECT count(*) FROM follows "
+                      "WHERE follows.user_being_followed_id = users.id",
+    'like_count': "SELECT count(*) FROM likes "
+                  "WHERE likes.user_id = users.id",
+}
+
+SEARCH_INDEXES = {
+    'ix_users_username_trgm':
+        "ON users USING gin (lower(username) gin_trgm_ops)",
+    'ix_users_username_prefix':
+        "ON users (lower(username) text_pattern_ops)",
+    'ix_messages_text_search':
+        "ON messages USING gin (to_tsvector('english'::regconfig, text))",
+}
+
+
+def _is_postgres():
+    return op.get_bind().dialect.name == 'postgresql'
+
+
+def _add_counters(inspector):
+    existing = {column['name'] for column in inspector.get_columns('users')}
+    added = [name for name in COUNTERS if name not in existing]
+
+    with op.batch_alter_table('users') as batch_op:
+        for name in added:
+            batch_op.add_column(sa.Column(name, sa.Integer(),
+                                          server_default='0',
+                                          nullable=False))
+        if 'updated_at' not in existing:
+            batch_op.add_column(sa.Column('updated_at', sa.DateTime(),
+                                          nullable=True))
+        if 'profile_version' not in existing:
+            batch_op.add_column(sa.Column('profile_version', sa.Integer(),
+                                          server_default='1',
+                                          nullable=False))
+
+    if added:
+        op.execute("UPDATE users SET " + ", ".join(
+            f"{name} = ({COUNTERS[name]})" for name in added))
+
+
+def _add_timelines(inspector):
+    if 'timeline_entries' in inspector.get_table_names():
+        return
+
+    op.create_table(
+        'timeline_entries',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('message_id', sa.Integer(), nullable=False),
+        sa.Column('timestamp', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['message_id'], ['messages.id'],
+                                ondelete='cascade'),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'],
+                                ondelete='cascade'),
+        sa.PrimaryKeyConstraint('user_id', 'message_id'),
+    )
+
+    # each author's own messages, then their followers' copies, except for
+    # authors too popular to fan out to (see timelines.py)
+    op.execute(
+        "INSERT INTO timeline_entries (user_id, message_id, timestamp) "
+        "SELECT user_id, id, timestamp FROM messages")
+    op.execute(sa.text(
+        "INSERT INTO timeline_entries (user_id, message_id, timestamp) "
+        "SELECT follows.user_following_id, messages.id, messages.timestamp "
+        "FROM follows JOIN messages "
+        "ON follows.user_being_followed_id = messages.user_id "
+        "WHERE follows.user_following_id != messages.user_id "
+        "AND messages.user_id NOT IN "
+        "(SELECT id FROM users WHERE follower_count >= :limit)")
+        .bindparams(limit=current_app.config.get('TIMELINE_FANOUT_LIMIT',
+                                                 10000)))
+
+    op.create_index('ix_timeline_entries_user_timestamp', 'timeline_entries',
+                    ['user_id', 'timestamp', 'message_id'])
+
+
+def _unique_per_user_likes(inspector):
+    constraints = {constraint['name'] for constraint
+                   in inspector.get_unique_constraints('likes')}
+    if 'likes_user_id_message_id_key' in constraints:
+        return
+
+    op.execute(
+        "DELETE FROM likes WHERE id NOT IN "
+        "(SELECT min(id) FROM likes GROUP BY user_id, message_id)")
+
+    with op.batch_alter_table('likes') as batch_op:
+        if 'likes_message_id_key' in constraints:
+            batch_op.drop_constraint('likes_message_id_key', type_='unique')
+        batch_op.create_unique_constraint('likes_user_id_message_id_key',
+                                          ['user_id', 'message_id'])
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+
+    _add_counters(inspector)
+    _add_timelines(inspector)
+    _unique_per_user_likes(inspector)
+
+    if _is_postgres():
+        op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        for name, definition in SEARCH_INDEXES.items():
+            op.execute(f"CREATE INDEX IF NOT EXISTS {name} {definition}")
+
+
+def downgrade():
+    if _is_postgres():
+        for name in SEARCH_INDEXES:
+            op.execute(f"DROP INDEX IF EXISTS {name}")
+
+    with op.batch_alter_table('likes') as batch_op:
+        batch_op.drop_constraint('likes_user_id_message_id_key',
+                                 type_='unique')
+        batch_op.create_unique_constraint('likes_message_id_key',
+                                          ['message_id'])
+
+    op.drop_index('ix_timeline_entries_user_timestamp', 'timeline_entries')
+    op.drop_table('timeline_entries')
+
+    with op.batch_alter_table('users') as batch_op:
+        for name in ['profile_version', 'updated_at', *COUNTERS]:
+            batch_op.drop_column(name)
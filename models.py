@@ -2,11 +2,18 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+import passwords
+from db_pool import PooledSQLAlchemy
+from replicas import RoutingSQLAlchemy
+
+
+class WarblerSQLAlchemy(RoutingSQLAlchemy, PooledSQLAlchemy):
+    """Flask-SQLAlchemy with replica routing and a configured pool."""
+
+
+db = WarblerSQLAlchemy()
 
 
 class Follows(db.Model):
@@ -26,6 +33,13 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # the primary key serves "followers of"; this serves "followed by"
+    # (timelines, following pages, counters)
+    __table_args__ = (
+        db.Index('ix_follows_following_followed',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
@@ -45,9 +59,30 @@ class Likes(db.Model):
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
     )
 
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id'),
+    )
+
+    @classmethod
+    def liked_message_ids(cls, user, message_ids):
+        """Which of `message_ids` has `user` liked?
+
+        Returns a set so templates can test `message.id in likes` cheaply.
+        Answered from the (user_id, message_id) index in one query; an
+        anonymous `user` (None) has liked nothing.
+        """
+
+        if not user or not message_ids:
+            return set()
+
+        rows = (db.session.query(cls.message_id)
+                .filter(cls.user_id == user.id,
+                        cls.message_id.in_(message_ids)))
+
+        return {message_id for (message_id,) in rows}
+
 
 class User(db.Model):
     """User in the system."""
@@ -94,7 +129,74 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message')
+    # Denormalized totals, maintained by counters.py
+    message_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    follower_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Set on every UPDATE of the row, counter updates included; pages
+    # validate conditional GETs against it (see conditional.py). NULL for
+    # rows bulk-loaded and never changed since.
+    updated_at = db.Column(
+        db.DateTime,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+    )
+
+    # Bumped when what messages show of their author (username, avatar)
+    # changes; keys cached message fragments (see fragments.py)
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default='1',
+    )
+
+    # Set when the account is deleted; the user can no longer log in or be
+    # seen, and a job purges their rows (see accounts.py)
+    disabled_at = db.Column(
+        db.DateTime,
+    )
+
+    # True once any of their messages wasn't pushed (see Message.pushed), so
+    # home timelines find the authors to pull from without probing each
+    # followed user's messages
+    pulled = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default=db.false(),
+    )
+
+    messages = db.relationship(
+        'Message',
+        cascade="all",
+        passive_deletes=True,
+    )
 
     followers = db.relationship(
         "User",
@@ -115,20 +217,61 @@ class User(db.Model):
         secondary="likes"
     )
 
+    # the few pulled authors, for joining with a user's follows
+    __table_args__ = (
+        db.Index('ix_users_pulled', 'id',
+                 postgresql_where=db.text('pulled')),
+    )
+
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    def following_ids(self, user_ids):
+        """Which of `user_ids` is this user following?
+
+        Answered with one query on the follows primary key. Answers are
+        remembered on this instance (which lives for one request), so a
+        route can look up every user on a page at once and later
+        `is_following` calls from the template don't query again.
+        """
+
+        return self._follow_status('_following_cache',
+                                   Follows.user_following_id,
+                                   Follows.user_being_followed_id,
+                                   user_ids)
+
+    def follower_ids(self, user_ids):
+        """Which of `user_ids` is following this user?"""
+
+        return self._follow_status('_followers_cache',
+                                   Follows.user_being_followed_id,
+                                   Follows.user_following_id,
+                                   user_ids)
+
+    def _follow_status(self, cache_name, own_column, other_column, user_ids):
+        """Look up and cache which of `user_ids` match `other_column`."""
+
+        cache = self.__dict__.setdefault(cache_name, {})
+        missing = {user_id for user_id in user_ids if user_id not in cache}
+
+        if missing:
+            rows = (db.session.query(other_column)
+                    .filter(own_column == self.id,
+                            other_column.in_(missing)))
+            found = {user_id for (user_id,) in rows}
+            cache.update((user_id, user_id in found) for user_id in missing)
+
+        return {user_id for user_id in user_ids if cache[user_id]}
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.id in self.follower_ids([other_user.id])
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.id in self.following_ids([other_user.id])
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -137,7 +280,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = passwords.hash_password(password)
 
         user = User(
             username=username,
@@ -158,17 +301,57 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        A hash made at an old bcrypt cost is replaced with one at the
+        current cost; the caller commits it.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username=username,
+                                   disabled_at=None).first()
 
-        if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            if is_auth:
-                return user
+        if user and user.check_password(password):
+            if passwords.needs_rehash(user.password):
+                user.password = passwords.hash_password(password)
+            return user
 
         return False
 
+    def check_password(self, password):
+        """Is `password` this user's password?"""
+
+        return passwords.check_password(self.password, password)
+
+
+# Username search indexes (see search.py). Postgres-only: the trigram index
+# needs the pg_trgm extension, and other backends can't use either.
+USERS_SEARCH_INDEXES = DDL("""
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    CREATE INDEX ix_users_username_trgm
+        ON users USING gin (lower(username) gin_trgm_ops);
+    CREATE INDEX ix_users_username_prefix
+        ON users (lower(username) text_pattern_ops);
+""").execute_if(dialect='postgresql')
+
+event.listen(User.__table__, 'after_create', USERS_SEARCH_INDEXES)
+
+
+@event.listens_for(User.following, 'append')
+@event.listens_for(User.following, 'remove')
+def _forget_following(user, other_user, initiator):
+    """Drop cached follow status when `user.following` changes."""
+
+    user.__dict__.pop('_following_cache', None)
+    other_user.__dict__.pop('_followers_cache', None)
+
+
+@event.listens_for(User.followers, 'append')
+@event.listens_for(User.followers, 'remove')
+def _forget_followers(user, other_user, initiator):
+    """Drop cached follow status when `user.followers` changes."""
+
+    user.__dict__.pop('_followers_cache', None)
+    other_user.__dict__.pop('_following_cache', None)
+
 
 class Message(db.Model):
     """An individual message ("warble")."""
@@ -188,7 +371,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -197,8 +380,136 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # False if it wasn't copied into followers' timelines when posted (its
+    # author was popular); timelines pull these when read (see timelines.py)
+    pushed = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=True,
+        server_default=db.true(),
+    )
+
     user = db.relationship('User')
 
+    # a user's messages, newest first (profiles); the unpushed ones alone,
+    # for timelines
+    __table_args__ = (
+        db.Index('ix_messages_user_timestamp', 'user_id', 'timestamp', 'id'),
+        db.Index('ix_messages_unpushed', 'user_id', 'timestamp', 'id',
+                 postgresql_where=db.text('NOT pushed')),
+    )
+
+
+# Full-text message search index (see search.py); other backends fall back
+# to an in-process index.
+MESSAGES_SEARCH_INDEX = DDL("""
+    CREATE INDEX ix_messages_text_search
+        ON messages USING gin (to_tsvector('english'::regconfig, text));
+""").execute_if(dialect='postgresql')
+
+event.listen(Message.__table__, 'after_create', MESSAGES_SEARCH_INDEX)
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into a user's home timeline."""
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # copied from the message so a page is a range read on this table alone
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timeline_entries_user_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+    )
+
+
+class Job(db.Model):
+    """A unit of background work, run by `flask worker` (see jobs.py)."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # name of the registered function that runs it
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # its keyword arguments, as JSON
+    args = db.Column(
+        db.Text,
+        nullable=False,
+        default='{}',
+    )
+
+    # queued -> running -> done, or back to queued to retry, or failed
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default='queued',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    # when it may next run
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    # when a worker claimed it; a running job whose worker died is claimed
+    # again after JOB_LOCK_TIMEOUT
+    locked_at = db.Column(
+        db.DateTime,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    # workers look for the next due job of a status
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+    def __repr__(self):
+        return f"<Job #{self.id}: {self.kind} {self.status}>"
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -208,3 +519,4 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+    passwords.init_app(app)
@@ -0,0 +1,121 @@
+"""Password hashing for Warbler.
+
+bcrypt is deliberately slow, so hashing can run on a small bounded thread
+pool instead of on whichever request thread asked for it. At most
+BCRYPT_MAX_CONCURRENCY hashes run at once (bcrypt releases the GIL while it
+works); up to BCRYPT_MAX_QUEUED more wait at most BCRYPT_QUEUE_TIMEOUT
+seconds, and anything beyond that raises HashingBusy, so a login spike sheds
+load instead of pinning every worker on CPU. Set BCRYPT_MAX_CONCURRENCY to 0
+to hash inline on the calling thread.
+
+The cost is BCRYPT_LOG_ROUNDS (Flask-Bcrypt's setting). Hashes made at a
+different cost are upgraded the next time their owner logs in; see
+`needs_rehash` and User.authenticate. Use benchmarks/bcrypt_cost.py to pick
+a cost that fits the login latency budget.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+
+from flask_bcrypt import Bcrypt
+
+DEFAULT_LOG_ROUNDS = 12
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_MAX_QUEUED = 16
+DEFAULT_QUEUE_TIMEOUT = 5
+
+bcrypt = Bcrypt()
+
+
+class HashingBusy(Exception):
+    """Too many password hashes are already running or waiting."""
+
+
+class PasswordHasher:
+    """Runs bcrypt calls on a bounded executor with an admission limit."""
+
+    def __init__(self, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 max_queued=DEFAULT_MAX_QUEUED,
+                 queue_timeout=DEFAULT_QUEUE_TIMEOUT,
+                 log_rounds=DEFAULT_LOG_ROUNDS):
+        self.configure(max_concurrency, max_queued, queue_timeout,
+                       log_rounds)
+
+    def configure(self, max_concurrency, max_queued, queue_timeout,
+                  log_rounds=DEFAULT_LOG_ROUNDS):
+        # hashes already running on the old pool finish there
+        self.shutdown(wait=False)
+
+        self.executor = None
+        self.slots = None
+        self.queue_timeout = queue_timeout
+        self.log_rounds = log_rounds
+
+        if max_concurrency:
+            self.executor = ThreadPoolExecutor(max_workers=max_concurrency,
+                                               thread_name_prefix='bcrypt')
+            self.slots = BoundedSemaphore(max_concurrency + max_queued)
+
+    def shutdown(self, wait=True):
+        """Stop the pool's threads, if there is a pool."""
+
+        executor = getattr(self, 'executor', None)
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def init_app(self, app):
+        self.configure(
+            app.config.get('BCRYPT_MAX_CONCURRENCY', DEFAULT_MAX_CONCURRENCY),
+            app.config.get('BCRYPT_MAX_QUEUED', DEFAULT_MAX_QUEUED),
+            app.config.get('BCRYPT_QUEUE_TIMEOUT', DEFAULT_QUEUE_TIMEOUT),
+            app.config.get('BCRYPT_LOG_ROUNDS', DEFAULT_LOG_ROUNDS))
+
+    def run(self, fn, *args):
+        """Run `fn(*args)` on the pool and wait for its result."""
+
+        if self.executor is None:
+            return fn(*args)
+
+        if not self.slots.acquire(timeout=self.queue_timeout):
+            raise HashingBusy()
+
+        try:
+            return self.executor.submit(fn, *args).result()
+        finally:
+            self.slots.release()
+
+
+hasher = PasswordHasher()
+
+
+def init_app(app):
+    """Read the BCRYPT_* settings from `app`'s config."""
+
+    bcrypt.init_app(app)
+    hasher.init_app(app)
+
+
+def hash_password(password):
+    """bcrypt hash of `password` at the configured cost, as text."""
+
+    hashed = hasher.run(bcrypt.generate_password_hash, password,
+                        hasher.log_rounds)
+    return hashed.decode('UTF-8')
+
+
+def check_password(hashed, password):
+    """Does `password` match the bcrypt hash `hashed`?"""
+
+    return hasher.run(bcrypt.check_password_hash, hashed, password)
+
+
+def hash_cost(hashed):
+    """The cost (log2 rounds) `hashed` was made with."""
+
+    return int(hashed.split('$')[2])
+
+
+def needs_rehash(hashed):
+    """Was `hashed` made at a cost other than the configured one?"""
+
+    return hash_cost(hashed) != hasher.log_rounds
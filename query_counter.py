@@ -0,0 +1,37 @@
+"""Count the SQL statements Warbler sends to the database.
+
+Used by the tests to pin how many queries a route issues, so an N+1
+regression (one query per rendered message or user card) fails the build:
+
+    with QueryCounter() as queries:
+        client.get("/")
+
+    self.assertLessEqual(queries.count, 6, queries.statements)
+"""
+
+from sqlalchemy import event
+
+from models import db
+
+
+class QueryCounter:
+    """Context manager recording every statement run on an engine."""
+
+    def __init__(self, engine=None):
+        self.engine = engine or db.engine
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def _record(self, conn, cursor, statement, parameters, context,
+                executemany):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
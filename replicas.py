@@ -0,0 +1,98 @@
+"""Read replica routing.
+
+Most requests only read. Views decorated with `@reads_from_replica` run
+their SELECTs against one of the REPLICA_BINDS (entries of
+SQLALCHEMY_BINDS, picked at random per request) instead of the primary
+database. Everything else stays on the primary:
+
+- requests other than GET/HEAD, and undecorated views;
+- any statement once the session has flushed in the current transaction,
+  INSERT/UPDATE/DELETE statements, and SELECT ... FOR UPDATE;
+- every request from a client that wrote something in the last
+  REPLICA_STICKY_SECONDS, so users see their own posts, follows and edits
+  even while replicas lag behind.
+
+Without REPLICA_BINDS every query goes to the primary. To try it out
+locally, point a bind at a second database file or schema that holds a
+copy of the tables.
+"""
+
+import random
+import time
+from functools import wraps
+
+from flask import current_app, g, has_app_context, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import event, orm
+from sqlalchemy.sql.dml import UpdateBase
+
+DEFAULT_STICKY_SECONDS = 10
+
+# session key: until when (epoch seconds) this client reads the primary
+PRIMARY_UNTIL_KEY = 'primary_until'
+
+SAFE_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+
+class RoutingSession(SignallingSession):
+    """Session that reads from the request's replica, if it has one."""
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = g.get('replica_bind') if has_app_context() else None
+
+        if replica is None or self._writes(clause):
+            return super().get_bind(mapper, clause)
+
+        return self.app.extensions['sqlalchemy'].db.get_engine(
+            self.app, bind=replica)
+
+    def _writes(self, clause):
+        return (self._flushing
+                or self.info.get('wrote')
+                or isinstance(clause, UpdateBase)
+                or getattr(clause, '_for_update_arg', None) is not None)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy whose sessions are RoutingSessions."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _wrote(session, flush_context):
+    session.info['wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'after_transaction_end')
+def _transaction_ended(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('wrote', None)
+
+
+def reads_from_replica(view):
+    """Let `view` read from a replica, unless this client just wrote."""
+
+    @wraps(view)
+    def routed(*args, **kwargs):
+        replicas = current_app.config.get('REPLICA_BINDS')
+        if (replicas and request.method in SAFE_METHODS
+                and session.get(PRIMARY_UNTIL_KEY, 0) < time.time()):
+            g.replica_bind = random.choice(replicas)
+
+        return view(*args, **kwargs)
+
+    return routed
+
+
+def init_app(app):
+    """Keep clients on the primary for a while after they write."""
+
+    @app.after_request
+    def stick_writers_to_primary(response):
+        if request.method not in SAFE_METHODS:
+            window = app.config.get('REPLICA_STICKY_SECONDS',
+                                    DEFAULT_STICKY_SECONDS)
+            session[PRIMARY_UNTIL_KEY] = time.time() + window
+        return response
@@ -0,0 +1,305 @@
+"""Search backends for Warbler.
+
+User search ranks exact username matches first, then prefix matches, then
+substring matches. On Postgres every branch is served by indexes created
+with the users table (see models.py): a trigram GIN index on
+lower(username) answers `LIKE '%q%'` and a `text_pattern_ops` index on it
+answers prefixes. Queries shorter than a trigram only do the prefix search,
+since a one- or two-letter substring match would have to scan every user.
+Results are paged with a (rank, lower(username), id) cursor.
+
+Message search is full-text. On Postgres it uses a GIN index on
+to_tsvector('english', text), ranked with ts_rank; elsewhere (local SQLite
+runs) an in-process inverted index built from the messages table on first
+use and updated by `messages_add` and `messages_destroy`. Both backends
+rank results with an integer score and page them with a (score, id) cursor.
+Matches whose message is gone or whose author is disabled are skipped, and
+more are fetched until the page is full.
+"""
+
+import re
+from collections import Counter, defaultdict
+from threading import Lock
+
+from sqlalchemy import Integer, case, cast, func, literal_column, tuple_
+
+from models import db, Message, User
+from timelines import timeline_query
+
+DEFAULT_USERS_PER_PAGE = 24
+DEFAULT_MESSAGES_PER_PAGE = 20
+TRIGRAM = 3
+
+# ts_rank is a small float; scaled to an integer so cursors compare exactly
+RANK_SCALE = 1000000
+
+# must match the expression of the messages GIN index in models.py
+ENGLISH = literal_column("'english'::regconfig")
+
+WORD = re.compile(r"\w+")
+
+
+def users_per_page():
+    """Number of user cards on one directory or search page."""
+
+    return db.get_app().config.get('USERS_PER_PAGE', DEFAULT_USERS_PER_PAGE)
+
+
+def escape_like(text):
+    """Escape LIKE wildcards in user input (used with escape='\\\\')."""
+
+    return (text.replace('\\', '\\\\')
+                .replace('%', '\\%')
+                .replace('_', '\\_'))
+
+
+def encode_user_cursor(rank, username, user_id):
+    """Cursor pointing just past a user search result, for `?after=`."""
+
+    return f"{rank}_{user_id}_{username}"
+
+
+def decode_user_cursor(cursor):
+    """Parse an `?after=` cursor into (rank, lower username, id).
+
+    Raises ValueError if `cursor` is malformed.
+    """
+
+    rank, user_id, username = cursor.split('_', 2)
+    return int(rank), username, int(user_id)
+
+
+def search_users(q, after=None, per_page=None):
+    """A page of users whose username matches `q`, best matches first.
+
+    `after` is a decoded cursor from a previous page. Returns (users,
+    cursor for the next page or None).
+    """
+
+    per_page = per_page or users_per_page()
+    q = q.strip().lower()
+    pattern = escape_like(q)
+    username = func.lower(User.username)
+
+    if len(q) < TRIGRAM:
+        matches = username.like(f"{pattern}%", escape='\\')
+    else:
+        matches = username.like(f"%{pattern}%", escape='\\')
+
+    rank = case([(username == q, 0),
+                 (username.like(f"{pattern}%", escape='\\'), 1)],
+                else_=2)
+
+    query = (db.session.query(User, rank, username)
+             .filter(matches, User.disabled_at.is_(None)))
+
+    if after:
+        query = query.filter(tuple_(rank, username, User.id) >
+                             tuple_(*after))
+
+    rows = (query
+            .order_by(rank, username, User.id)
+            .limit(per_page + 1)
+            .all())
+    users = [user for (user, _, _) in rows[:per_page]]
+
+    if len(rows) > per_page:
+        user, user_rank, lower_username = rows[per_page - 1]
+        return users, encode_user_cursor(user_rank, lower_username, user.id)
+
+    return users, None
+
+
+def directory_page(after=None, per_page=None):
+    """A page of all users in username order, after username `after`.
+
+    Keyset-paged on the unique username index so deep pages stay cheap.
+    Returns (users, username to continue after or None).
+    """
+
+    per_page = per_page or users_per_page()
+    query = User.query.filter(User.disabled_at.is_(None))
+
+    if after:
+        query = query.filter(User.username > after)
+
+    users = query.order_by(User.username).limit(per_page + 1).all()
+
+    if len(users) > per_page:
+        return users[:per_page], users[per_page - 1].username
+
+    return users, None
+
+
+def messages_per_page():
+    """Number of results on one page of message search."""
+
+    return db.get_app().config.get('MESSAGES_PER_PAGE',
+                                   DEFAULT_MESSAGES_PER_PAGE)
+
+
+def encode_search_cursor(rank, message_id):
+    """Cursor pointing just past a result, for `?after=`."""
+
+    return f"{rank}_{message_id}"
+
+
+def decode_search_cursor(cursor):
+    """Parse an `?after=` cursor into (rank, id); ValueError if malformed."""
+
+    rank, _, message_id = cursor.partition('_')
+    return int(rank), int(message_id)
+
+
+class PostgresMessageSearch:
+    """Full-text search on the messages GIN index; Postgres maintains it."""
+
+    def matches(self, q, after, limit):
+        query = func.plainto_tsquery(ENGLISH, q)
+        document = func.to_tsvector(ENGLISH, Message.text)
+        rank = cast(func.ts_rank(document, query) * RANK_SCALE, Integer)
+
+        rows = (db.session.query(rank, Message.id)
+                .filter(document.op('@@')(query)))
+
+        if after:
+            rows = rows.filter(tuple_(rank, Message.id) < tuple_(*after))
+
+        return (rows
+                .order_by(rank.desc(), Message.id.desc())
+                .limit(limit)
+                .all())
+
+    def add(self, msg):
+        pass
+
+    def remove(self, message_id):
+        pass
+
+
+class InvertedIndexMessageSearch:
+    """Full-text search on an in-process inverted index.
+
+    Meant for local runs without Postgres. The index is built from the
+    messages table the first time it's searched; messages written by other
+    processes after that aren't seen until restart. Messages they delete
+    (such as a purged account's, see accounts.py) are dropped from the
+    index when a search turns them up.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.postings = defaultdict(dict)
+        self.documents = {}
+        self.built = False
+
+    def _index(self, message_id, text):
+        terms = Counter(WORD.findall(text.lower()))
+        self.documents[message_id] = terms
+        for term, count in terms.items():
+            self.postings[term][message_id] = count
+
+    def _build(self):
+        messages = db.session.query(Message.id, Message.text).yield_per(1000)
+        for message_id, text in messages:
+            self._index(message_id, text)
+        self.built = True
+
+    def matches(self, q, after, limit):
+        terms = set(WORD.findall(q.lower()))
+        if not terms:
+            return []
+
+        with self.lock:
+            if not self.built:
+                self._build()
+
+            postings = sorted((self.postings.get(term, {}) for term in terms),
+                              key=len)
+            candidates = set(postings[0]).intersection(*postings[1:])
+            results = [(sum(p[message_id] for p in postings), message_id)
+                       for message_id in candidates]
+
+        if after:
+            results = [result for result in results if result < after]
+
+        results.sort(reverse=True)
+        return results[:limit]
+
+    def add(self, msg):
+        with self.lock:
+            if self.built:
+                self._index(msg.id, msg.text)
+
+    def remove(self, message_id):
+        with self.lock:
+            for term in self.documents.pop(message_id, ()):
+                self.postings[term].pop(message_id, None)
+
+
+def message_search():
+    """The message search backend for the current app.
+
+    MESSAGE_SEARCH_BACKEND picks 'postgres' or 'memory'; by default
+    Postgres databases use 'postgres' and everything else 'memory'.
+    """
+
+    app = db.get_app()
+    backend = app.extensions.get('message_search')
+
+    if backend is None:
+        kind = app.config.get('MESSAGE_SEARCH_BACKEND')
+        if kind is None:
+            is_postgres = db.get_engine(app).dialect.name == 'postgresql'
+            kind = 'postgres' if is_postgres else 'memory'
+
+        if kind == 'postgres':
+            backend = PostgresMessageSearch()
+        else:
+            backend = InvertedIndexMessageSearch()
+        app.extensions['message_search'] = backend
+
+    return backend
+
+
+def search_messages(q, after=None, limit=None):
+    """A page of messages matching `q`, most relevant first.
+
+    Returns (messages, cursor for the next page or None).
+    """
+
+    limit = limit or messages_per_page()
+    backend = message_search()
+    found = []
+    exhausted = False
+
+    # (match, message) pairs, until there's one more than fits on the page
+    while len(found) <= limit and not exhausted:
+        wanted = limit + 1 - len(found)
+        matches = backend.matches(q, after, wanted)
+        exhausted = len(matches) < wanted
+        if not matches:
+            break
+        after = matches[-1]
+
+        ids = [message_id for (_, message_id) in matches]
+        rows = (timeline_query()
+                .join(User, User.id == Message.user_id)
+                .filter(Message.id.in_(ids))
+                .with_entities(Message, User.disabled_at))
+        by_id = {msg.id: (msg, disabled_at) for msg, disabled_at in rows}
+
+        for match in matches:
+            msg, disabled_at = by_id.get(match[1], (None, None))
+            if msg is None:
+                backend.remove(match[1])
+            elif disabled_at is None:
+                found.append((match, msg))
+
+    page = found[:limit]
+    messages = [msg for (_, msg) in page]
+
+    if len(found) > limit:
+        return messages, encode_search_cursor(*page[-1][0])
+
+    return messages, None
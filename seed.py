@@ -1,20 +1,12 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+For big datasets, or to resume an interrupted load, use
+`flask bulk-load` instead (see bulk_load.py).
+"""
 
+from app import app
+from bulk_load import load_csvs
 
-db.drop_all()
-db.create_all()
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
-
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
-
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
-
-db.session.commit()
+with app.app_context():
+    load_csvs('generator', reset=True)
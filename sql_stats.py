@@ -0,0 +1,187 @@
+"""Per-request SQL statistics and an N+1 detector.
+
+Engine events time every statement run while a request is being handled.
+When the response goes out, the query count and total database time are
+added as `X-DB-Query-Count` and `Server-Timing: db;dur=...` headers, and a
+JSON line with those and the slowest statement is logged to the
+`warbler.sql` logger at INFO. A streamed response's headers go out before
+its body runs the rest of its queries, so it gets no headers; its line is
+logged once the body has been sent. Time spent waiting for a pooled
+connection and opening new ones is reported too, as `db-wait` and
+`db-connect` (see db_pool.py).
+
+Set SQL_REPEAT_LIMIT to make a request fail with RepeatedQueryError as soon
+as one statement shape runs more than that many times. A statement's shape
+is its SQL with IN lists collapsed, so the same query for different ids
+counts as a repeat. That is the signature of an N+1 loop. This is meant for
+development and tests; it's off (None) by default.
+"""
+
+import json
+import logging
+import re
+from collections import Counter
+from time import perf_counter
+
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('warbler.sql')
+
+# a parenthesized list of bind parameters, in any DBAPI paramstyle
+PARAM_LIST = re.compile(
+    r"\(\s*(?:%\(\w+\)s|%s|\?|:\w+)(?:\s*,\s*(?:%\(\w+\)s|%s|\?|:\w+))*\s*\)")
+
+
+class RepeatedQueryError(Exception):
+    """One statement shape ran more than SQL_REPEAT_LIMIT times."""
+
+    def __init__(self, shape, count):
+        super().__init__(
+            f"Statement ran {count} times in one request: {shape}")
+        self.shape = shape
+        self.count = count
+
+
+def statement_shape(statement):
+    """`statement` with IN lists collapsed, so repeats compare equal."""
+
+    return PARAM_LIST.sub('(?)', ' '.join(statement.split()))
+
+
+class RequestSQLStats:
+    """Statements run while handling one request."""
+
+    def __init__(self, repeat_limit=None):
+        self.repeat_limit = repeat_limit
+        self.count = 0
+        self.seconds = 0
+        self.slowest = (0, None)
+        self.shapes = Counter()
+        self.connection_waits = 0
+        self.connection_wait_seconds = 0
+        self.connects = 0
+        self.connect_seconds = 0
+
+    def started(self, statement):
+        self.count += 1
+
+        if self.repeat_limit is not None:
+            shape = statement_shape(statement)
+            self.shapes[shape] += 1
+            if self.shapes[shape] > self.repeat_limit:
+                raise RepeatedQueryError(shape, self.shapes[shape])
+
+    def finished(self, statement, seconds):
+        self.seconds += seconds
+        if seconds > self.slowest[0]:
+            self.slowest = (seconds, statement)
+
+    def waited_for_connection(self, seconds):
+        """Count a pool checkout that took `seconds` (see db_pool.py)."""
+
+        self.connection_waits += 1
+        self.connection_wait_seconds += seconds
+
+    def opened_connection(self, seconds):
+        """Count a new connection that took `seconds` to open."""
+
+        self.connects += 1
+        self.connect_seconds += seconds
+
+    def headers(self):
+        milliseconds = self.seconds * 1000
+        timing = f'db;dur={milliseconds:.1f};desc="{self.count} queries"'
+        if self.connection_waits:
+            timing += (f', db-wait;dur='
+                       f'{self.connection_wait_seconds * 1000:.1f}')
+        if self.connects:
+            timing += f', db-connect;dur={self.connect_seconds * 1000:.1f}'
+
+        return {
+            'X-DB-Query-Count': str(self.count),
+            'Server-Timing': timing,
+        }
+
+    def log_record(self, fields):
+        """`fields` describing the request, with these statistics."""
+
+        seconds, statement = self.slowest
+        return {
+            **fields,
+            'queries': self.count,
+            'db_ms': round(self.seconds * 1000, 2),
+            'connection_wait_ms':
+                round(self.connection_wait_seconds * 1000, 2),
+            'connect_ms': round(self.connect_seconds * 1000, 2),
+            'slowest_ms': round(seconds * 1000, 2),
+            'slowest': statement and ' '.join(statement.split()),
+        }
+
+
+def _request_fields(response):
+    """What the log line says about the request `response` answers."""
+
+    return {
+        'method': request.method,
+        'path': request.path,
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+    }
+
+
+def _log(stats, fields):
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps(stats.log_record(fields)))
+
+
+def current_stats():
+    """The RequestSQLStats being collected, if we're in a request."""
+
+    if has_app_context():
+        return g.get('sql_stats')
+    return None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _statement_started(conn, cursor, statement, parameters, context,
+                       executemany):
+    stats = current_stats()
+    if stats is not None:
+        stats.started(statement)
+        context._sql_stats_start = perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _statement_finished(conn, cursor, statement, parameters, context,
+                        executemany):
+    stats = current_stats()
+    start = getattr(context, '_sql_stats_start', None)
+    if stats is not None and start is not None:
+        stats.finished(statement, perf_counter() - start)
+
+
+def init_app(app):
+    """Collect SQL statistics for each of `app`'s requests."""
+
+    @app.before_request
+    def start_sql_stats():
+        if app.config.get('SQL_STATS', True):
+            g.sql_stats = RequestSQLStats(app.config.get('SQL_REPEAT_LIMIT'))
+
+    @app.after_request
+    def report_sql_stats(response):
+        stats = g.get('sql_stats')
+        if stats is None:
+            return response
+
+        fields = _request_fields(response)
+        if response.is_streamed:
+            # the body still has queries to run
+            response.call_on_close(lambda: _log(stats, fields))
+        else:
+            response.headers.extend(stats.headers())
+            _log(stats, fields)
+
+        return response
@@ -0,0 +1,84 @@
+"""Streamed rendering of long list pages.
+
+`render_template` builds a whole page before sending any of it, so the time
+to first byte and the memory a request needs grow with the list. The user
+directory and following/followers pages use `stream_template` instead: the
+page goes out in STREAM_FLUSH_BYTES pieces as the template produces it, so
+the browser can paint the header and first cards while the rest of the list
+is still being read.
+
+To keep memory flat too, those pages list `in_chunks(query, ...)`: the query
+is read with `yield_per`, STREAM_CHUNK_SIZE rows at a time, and each chunk
+can be prepared in one go before the template renders it (e.g. looking up
+which of the users shown the viewer follows).
+"""
+
+from itertools import chain, islice
+
+from flask import (Response, current_app, get_flashed_messages,
+                   stream_with_context)
+
+DEFAULT_FLUSH_BYTES = 8192
+DEFAULT_CHUNK_SIZE = 100
+
+
+def in_chunks(query, prepare=None):
+    """Iterate `query` a chunk at a time, calling `prepare(chunk)` first.
+
+    The first chunk is read and prepared right away, before the page starts
+    rendering, so `prepare` can also cover rows shown above the list and a
+    short list costs one query of each kind.
+    """
+
+    size = current_app.config.get('STREAM_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+    rows = iter(query.yield_per(size))
+
+    def chunks():
+        while True:
+            chunk = list(islice(rows, size))
+            if not chunk:
+                return
+            if prepare is not None:
+                prepare(chunk)
+            yield chunk
+
+    chunked = chunks()
+    first = next(chunked, [])
+    return chain(first, chain.from_iterable(chunked))
+
+
+def _buffered(pieces, flush_bytes):
+    """Join small template output `pieces` into roughly `flush_bytes`."""
+
+    buffer = []
+    buffered = 0
+
+    for piece in pieces:
+        buffer.append(piece)
+        buffered += len(piece)
+        if buffered >= flush_bytes:
+            yield ''.join(buffer)
+            buffer = []
+            buffered = 0
+
+    if buffer:
+        yield ''.join(buffer)
+
+
+def stream_template(template_name, **context):
+    """Like `render_template`, but a Response sent as it's rendered.
+
+    The session cookie is saved before the body is rendered, so pending
+    flashes are taken from it now; the template's `get_flashed_messages()`
+    gets them from the request.
+    """
+
+    get_flashed_messages()
+
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    flush_bytes = app.config.get('STREAM_FLUSH_BYTES', DEFAULT_FLUSH_BYTES)
+
+    return Response(stream_with_context(
+        _buffered(template.generate(context), flush_bytes)))
@@ -0,0 +1,74 @@
+"""Static asset pipeline tests."""
+
+
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test2"
+
+
+# Now we can import app
+from app import app
+import assets
+
+
+class AssetsTestCase(TestCase):
+    """Test fingerprinting and serving static files."""
+
+    def setUp(self):
+        self.static_folder = app.static_folder
+        app.static_folder = tempfile.mkdtemp()
+        os.makedirs(os.path.join(app.static_folder, 'images'))
+        os.makedirs(os.path.join(app.static_folder, 'stylesheets'))
+
+        with open(os.path.join(app.static_folder, 'images', 'a.png'),
+                  'wb') as image:
+            image.write(b"not really a png")
+        with open(os.path.join(app.static_folder, 'stylesheets', 's.css'),
+                  'w') as stylesheet:
+            stylesheet.write(
+                'body { background: url("/static/images/a.png"); }')
+
+        app.extensions.pop('asset_manifest', None)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(app.static_folder)
+        app.static_folder = self.static_folder
+        app.extensions.pop('asset_manifest', None)
+
+    def test_unbuilt_assets_use_static_urls(self):
+        with app.test_request_context():
+            self.assertEqual(assets.asset_url('stylesheets/s.css'),
+                             "/static/stylesheets/s.css")
+
+    def test_build_and_serve(self):
+        manifest = assets.build(app.static_folder)
+        image = manifest['images/a.png']
+        stylesheet = manifest['stylesheets/s.css']
+        self.assertRegex(stylesheet, r"^stylesheets/s\.[0-9a-f]{12}\.css$")
+
+        with app.test_request_context():
+            self.assertEqual(assets.asset_url('stylesheets/s.css'),
+                             f"/static/dist/{stylesheet}")
+
+        resp = self.client.get(f"/static/dist/{stylesheet}",
+                               headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn("immutable", resp.headers['Cache-Control'])
+        self.assertIn(f"/static/dist/{image}",
+                      gzip.decompress(resp.data).decode())
+        resp.close()
+
+        resp = self.client.get(f"/static/dist/{stylesheet}")
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.mimetype, "text/css")
+        resp.close()
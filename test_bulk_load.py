@@ -0,0 +1,151 @@
+"""Bulk loader tests."""
+
+
+import csv
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User, Message, Follows, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test2"
+
+
+# Now we can import app
+from app import app
+from bulk_load import load_csvs, progress, BulkLoadError
+from generator import synthetic
+
+db.create_all()
+
+
+def write_csv(directory, name, header, rows):
+    with open(os.path.join(directory, name), 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+class BulkLoadTestCase(TestCase):
+    """Test loading CSVs in chunks."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        write_csv(self.directory, 'users.csv',
+                  ['email', 'username', 'image_url', 'password', 'bio',
+                   'header_image_url', 'location'],
+                  [[f"user{i}@test.com", f"user{i}", "/static/images/a.png",
+                    "hash", "", "/static/images/b.png", ""]
+                   for i in range(5)])
+        write_csv(self.directory, 'messages.csv',
+                  ['text', 'timestamp', 'user_id'],
+                  [[f"message {i}", f"2017-01-0{i + 1} 10:00:00.000000",
+                    i % 2 + 1] for i in range(7)])
+        write_csv(self.directory, 'follows.csv',
+                  ['user_being_followed_id', 'user_following_id'],
+                  [[1, 3], [2, 3], [1, 4]])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        db.session.rollback()
+
+    def test_load(self):
+        counts = load_csvs(self.directory, chunk_size=2, reset=True,
+                           report=lambda line: None)
+
+        self.assertEqual(counts, {'users': 5, 'messages': 7, 'follows': 3})
+        self.assertEqual(User.query.count(), 5)
+        self.assertEqual(Follows.query.count(), 3)
+
+        user1 = User.query.get(1)
+        self.assertEqual(user1.username, "user0")
+        self.assertEqual(user1.message_count, 4)
+        self.assertEqual(user1.follower_count, 2)
+        self.assertEqual(User.query.get(3).following_count, 2)
+
+        # 7 own entries, user3 sees all 7 and user4 sees user1's 4
+        self.assertEqual(TimelineEntry.query.count(), 18)
+
+        # the schema it created is the latest migration
+        self.assertEqual(
+            db.session.execute("SELECT version_num FROM alembic_version")
+            .scalar(), 'b5e2f8a41c67')
+
+    def test_load_synthetic(self):
+        generated = os.path.join(self.directory, 'synthetic')
+        synthetic.main(['--out', generated, '--users', '40',
+                        '--messages', '200'])
+
+        counts = load_csvs(generated, chunk_size=50, reset=True,
+                           report=lambda line: None)
+
+        self.assertEqual(counts['users'], 40)
+        self.assertEqual(counts['messages'], 200)
+        self.assertEqual(Follows.query.count(), counts['follows'])
+        self.assertEqual(sum(user.message_count for user in User.query),
+                         200)
+
+    def test_resume(self):
+        class Interrupted(Exception):
+            pass
+
+        def report(line):
+            if line.startswith("messages: 4 "):
+                raise Interrupted()
+
+        with self.assertRaises(Interrupted):
+            load_csvs(self.directory, chunk_size=2, reset=True,
+                      report=report)
+        self.assertEqual(Message.query.count(), 4)
+
+        counts = load_csvs(self.directory, chunk_size=2,
+                           report=lambda line: None)
+
+        self.assertEqual(counts['messages'], 7)
+        self.assertEqual(Message.query.count(), 7)
+        self.assertEqual(User.query.count(), 5)
+        self.assertEqual(Message.query.get(7).text, "message 6")
+        self.assertFalse(db.engine.has_table(progress.name))
+
+    def test_refuses_database_in_use(self):
+        db.drop_all()
+        progress.drop(bind=db.engine, checkfirst=True)
+        db.create_all()
+        user = User.signup("existing", "existing@test.com", "password", None)
+        db.session.add(Message(text="already here", user=user))
+        db.session.commit()
+
+        statements = []
+
+        def listener(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            with self.assertRaises(BulkLoadError):
+                load_csvs(self.directory, report=lambda line: None)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+
+        # refused before changing anything
+        writes = ("CREATE", "DROP", "INSERT", "UPDATE", "DELETE")
+        self.assertFalse([statement for statement in statements
+                          if statement.lstrip().upper().startswith(writes)])
+        self.assertEqual(User.query.count(), 1)
+        self.assertEqual(Message.query.count(), 1)
+
+    def test_refuses_reload(self):
+        load_csvs(self.directory, reset=True, report=lambda line: None)
+
+        # finished loads are in use too
+        with self.assertRaises(BulkLoadError):
+            load_csvs(self.directory, report=lambda line: None)
@@ -0,0 +1,70 @@
+"""Connection pool tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_db_pool.py
+
+
+import sqlite3
+from time import sleep
+from unittest import TestCase
+
+from sqlalchemy import create_engine, exc
+
+from db_pool import (engine_options, pool_stats, InstrumentedNullPool,
+                     InstrumentedQueuePool)
+
+
+class PoolTestCase(TestCase):
+    """Pool settings and stats."""
+
+    def test_engine_options(self):
+        options = engine_options({'DB_POOL_SIZE': 20, 'DB_MAX_OVERFLOW': 0})
+        self.assertIs(options['poolclass'], InstrumentedQueuePool)
+        self.assertEqual(options['pool_size'], 20)
+        self.assertEqual(options['max_overflow'], 0)
+        self.assertTrue(options['pool_pre_ping'])
+
+        options = engine_options({'DB_PGBOUNCER': True, 'DB_POOL_SIZE': 20})
+        self.assertEqual(options, {'poolclass': InstrumentedNullPool})
+
+    def test_pool_stats(self):
+        engine = create_engine('sqlite://', poolclass=InstrumentedQueuePool,
+                               pool_size=1, max_overflow=1, pool_timeout=0.01)
+
+        first = engine.connect()
+        second = engine.connect()
+        with self.assertRaises(exc.TimeoutError):
+            engine.connect()
+
+        second.invalidate()
+        second.close()
+        first.close()
+        engine.connect().close()
+
+        stats = pool_stats(engine)
+        self.assertEqual(stats['checkouts'], 3)
+        self.assertEqual(stats['checked_out'], 0)
+        self.assertEqual(stats['peak_checked_out'], 2)
+        self.assertEqual(stats['timeouts'], 1)
+        # the invalidated connection is replaced on its next checkout
+        self.assertEqual(stats['connects'], 3)
+        self.assertEqual(stats['invalidations'], 1)
+        self.assertEqual(stats['size'], 1)
+
+        engine.dispose()
+        engine.connect().close()
+        self.assertEqual(pool_stats(engine)['checkouts'], 4)
+
+    def test_connect_time_is_not_wait(self):
+        def slow_connect():
+            sleep(0.05)
+            return sqlite3.connect(':memory:')
+
+        engine = create_engine('sqlite://', creator=slow_connect,
+                               poolclass=InstrumentedNullPool)
+        engine.connect().close()
+
+        stats = pool_stats(engine)
+        self.assertGreaterEqual(stats['connect_ms'], 50)
+        self.assertLess(stats['wait_ms'], 50)
@@ -0,0 +1,93 @@
+"""Synthetic dataset generator tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_generator.py
+
+
+import csv
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from generator import synthetic
+
+USERS = 50
+MESSAGES = 300
+
+
+def generate(directory, seed=0):
+    synthetic.main(['--out', directory, '--seed', str(seed),
+                    '--users', str(USERS), '--messages', str(MESSAGES),
+                    '--follows-per-user', '5', '--likes-per-user', '3'])
+
+
+def read_rows(directory, name):
+    with open(os.path.join(directory, name), newline='') as csv_file:
+        return list(csv.reader(csv_file))[1:]
+
+
+class SyntheticGeneratorTestCase(TestCase):
+    """Test the generated CSVs."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        generate(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_same_seed_same_files(self):
+        again = os.path.join(self.directory, 'again')
+        other = os.path.join(self.directory, 'other')
+        generate(again)
+        generate(other, seed=1)
+
+        for name in ['users.csv', 'messages.csv', 'follows.csv',
+                     'likes.csv']:
+            with open(os.path.join(self.directory, name), 'rb') as first:
+                data = first.read()
+            with open(os.path.join(again, name), 'rb') as second:
+                self.assertEqual(second.read(), data, name)
+
+        with open(os.path.join(other, 'messages.csv'), 'rb') as different:
+            with open(os.path.join(self.directory, 'messages.csv'),
+                      'rb') as first:
+                self.assertNotEqual(different.read(), first.read())
+
+    def test_row_counts(self):
+        users = read_rows(self.directory, 'users.csv')
+        self.assertEqual(len(users), USERS)
+        self.assertEqual(len({row[1] for row in users}), USERS)
+        self.assertEqual(len(read_rows(self.directory, 'messages.csv')),
+                         MESSAGES)
+
+        self.assertTrue(read_rows(self.directory, 'follows.csv'))
+        self.assertTrue(read_rows(self.directory, 'likes.csv'))
+
+    def test_pairs_are_distinct(self):
+        follows = [tuple(row) for row
+                   in read_rows(self.directory, 'follows.csv')]
+        likes = [tuple(row) for row in read_rows(self.directory, 'likes.csv')]
+
+        self.assertEqual(len(set(follows)), len(follows))
+        self.assertEqual(len(set(likes)), len(likes))
+        self.assertFalse([pair for pair in follows if pair[0] == pair[1]])
+
+    def test_foreign_keys(self):
+        # ids are row numbers, as bulk_load.py assigns them
+        user_ids = set(range(1, USERS + 1))
+        message_ids = set(range(1, MESSAGES + 1))
+
+        for text, timestamp, user_id in read_rows(self.directory,
+                                                  'messages.csv'):
+            self.assertIn(int(user_id), user_ids)
+
+        for followed, follower in read_rows(self.directory, 'follows.csv'):
+            self.assertIn(int(followed), user_ids)
+            self.assertIn(int(follower), user_ids)
+
+        for user_id, message_id in read_rows(self.directory, 'likes.csv'):
+            self.assertIn(int(user_id), user_ids)
+            self.assertIn(int(message_id), message_ids)
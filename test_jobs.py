@@ -0,0 +1,162 @@
+"""Background job and account purge tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, Job, TimelineEntry
+from jobs import claim, enqueue, job, run, work
+from accounts import disable_user
+from timelines import rebuild_timelines
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test2"
+
+
+# Now we can import app
+from app import app
+
+db.create_all()
+
+FLAKY_CALLS = []
+
+
+@job('test-flaky')
+def flaky(fail_times):
+    FLAKY_CALLS.append(fail_times)
+    if len(FLAKY_CALLS) <= fail_times:
+        raise RuntimeError("not yet")
+
+
+class JobsTestCase(TestCase):
+    """Claiming, running and retrying jobs."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        FLAKY_CALLS.clear()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_retries_then_fails(self):
+        enqueue('test-flaky', fail_times=10)
+        db.session.commit()
+
+        for attempt in range(1, app.config['JOB_MAX_ATTEMPTS'] + 1):
+            queued = claim()
+            self.assertEqual(queued.attempts, attempt)
+            self.assertFalse(run(queued))
+
+            # waits before its retry, longer each time
+            self.assertIsNone(claim())
+            if queued.status == 'queued':
+                self.assertGreater(queued.run_at, datetime.utcnow())
+                queued.run_at = datetime.utcnow()
+                db.session.commit()
+
+        self.assertEqual(queued.status, 'failed')
+        self.assertEqual(queued.last_error, "RuntimeError: not yet")
+        self.assertEqual(len(FLAKY_CALLS), 5)
+
+    def test_retry_succeeds(self):
+        queued = enqueue('test-flaky', fail_times=1)
+        db.session.commit()
+
+        self.assertEqual(work(burst=True), 1)
+        self.assertEqual(queued.status, 'queued')
+
+        queued.run_at = datetime.utcnow()
+        db.session.commit()
+        self.assertEqual(work(burst=True), 1)
+        self.assertEqual(queued.status, 'done')
+        self.assertEqual(queued.attempts, 2)
+
+    def test_reclaims_stale_jobs(self):
+        queued = enqueue('test-flaky', fail_times=0)
+        db.session.commit()
+        self.assertEqual(claim(), queued)
+
+        # still running, as far as anyone knows
+        self.assertIsNone(claim())
+
+        queued.locked_at = datetime.utcnow() - timedelta(hours=1)
+        db.session.commit()
+        self.assertEqual(work(burst=True), 1)
+        self.assertEqual(queued.status, 'done')
+
+    def test_unknown_kind(self):
+        with self.assertRaises(ValueError):
+            enqueue('no-such-job')
+
+
+class PurgeUserTestCase(TestCase):
+    """Disabling a user and purging their rows in batches."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.users = [User.signup(f"user{i}", f"{i}@test.com", "password",
+                                  None) for i in range(4)]
+        db.session.commit()
+        self.gone, *self.others = self.users
+
+        messages = [Message(text=f"warble {i}", user_id=self.gone.id)
+                    for i in range(5)]
+        db.session.add_all(messages)
+        db.session.add(Message(text="other warble",
+                               user_id=self.others[0].id))
+        db.session.commit()
+
+        for other in self.others:
+            db.session.add(Follows(user_being_followed_id=self.gone.id,
+                                   user_following_id=other.id))
+            for msg in messages[:3]:
+                db.session.add(Likes(user_id=other.id, message_id=msg.id))
+        db.session.add(Follows(user_being_followed_id=self.others[0].id,
+                               user_following_id=self.gone.id))
+        db.session.commit()
+        rebuild_timelines()
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_purge(self):
+        gone_id = self.gone.id
+        disable_user(self.gone)
+        db.session.commit()
+
+        # disabled at once: no login, no profile
+        self.assertFalse(User.authenticate("user0", "password"))
+        with app.test_client() as client:
+            self.assertEqual(client.get(f"/users/{gone_id}").status_code,
+                             404)
+
+        app.config['PURGE_BATCH_SIZE'] = 2
+        try:
+            self.assertEqual(work(burst=True), 1)
+        finally:
+            app.config['PURGE_BATCH_SIZE'] = 1000
+
+        self.assertEqual(Job.query.one().status, 'done')
+        self.assertIsNone(User.query.get(gone_id))
+        self.assertEqual(Message.query.count(), 1)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(TimelineEntry.query.count(), 1)
+
+        for other in User.query:
+            self.assertEqual(other.like_count, 0)
+            self.assertEqual(other.following_count, 0)
+            self.assertEqual(other.follower_count, 0)
@@ -89,3 +89,21 @@ class UserModelTestCase(TestCase):
         like = Likes.query.filter(Likes.user_id == user2id).all()
         self.assertEqual(len(like), 1)
 
+
+    def test_liked_message_ids(self):
+        msg1 = Message(id=1, text="a warble", user_id=self.userid)
+        msg2 = Message(id=2, text="another warble", user_id=self.userid)
+
+        user2 = User.signup(
+            username="message2", email="test@email.com", password="password", image_url=None)
+        user2.id = 50
+        db.session.add_all([msg1, msg2, user2])
+        db.session.commit()
+
+        user2.likes.append(msg1)
+        self.user.likes.append(msg2)
+        db.session.commit()
+
+        likes = Likes.liked_message_ids(user2, [1, 2])
+        self.assertEqual(likes, {1})
+        self.assertEqual(Likes.liked_message_ids(None, [1, 2]), set())
@@ -7,9 +7,12 @@
 
 
 import os
+from datetime import datetime
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from models import db, connect_db, Message, User, Follows, TimelineEntry
+from bs4 import BeautifulSoup
+from flask import Flask
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -21,6 +24,10 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test2"
 
 # Now we can import app
 from app import app, CURR_USER_KEY
+import live
+from accounts import disable_user
+from search import message_search
+from timelines import encode_cursor
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -41,6 +48,7 @@ class MessageViewTestCase(TestCase):
 
         db.drop_all()
         db.create_all()
+        app.extensions.pop('message_fragments', None)
 
         self.testuser = User.signup(username="testuser",
                                     email="test@test.com",
@@ -113,6 +121,35 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn(msg.text, str(resp.data))
 
+    def test_message_show_conditional_get(self):
+        msg = Message(id=1234, text="a test message", user_id=self.testuserid)
+        db.session.add(msg)
+        db.session.commit()
+
+        # Last-Modified is only sent once its second is over
+        User.query.filter_by(id=self.testuserid).update(
+            {'updated_at': datetime(2020, 1, 1)})
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get("/messages/1234")
+            etag = resp.headers['ETag']
+            last_modified = resp.headers['Last-Modified']
+
+            resp = c.get("/messages/1234", headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+
+            resp = c.get("/messages/1234",
+                         headers={'If-Modified-Since': last_modified})
+            self.assertEqual(resp.status_code, 304)
+
+            # a logged-in viewer gets their own validators
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuserid
+
+            resp = c.get("/messages/1234", headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+
     def test_invalid_message_show(self):
         with self.client as c:
             with c.session_transaction() as sess:
@@ -170,3 +207,235 @@ class MessageViewTestCase(TestCase):
 
             msg = Message.query.get(500)
             self.assertIsNotNone(msg)
+
+    def test_add_message_fans_out(self):
+        follower = User.signup(username="follower",
+                               email="follower@test.com",
+                               password="password",
+                               image_url=None)
+        follower.id = 60
+        db.session.add(Follows(user_being_followed_id=self.testuserid,
+                               user_following_id=60))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuserid
+
+            c.post("/messages/new", data={"text": "Hello"})
+
+            msg = Message.query.one()
+            entries = TimelineEntry.query.filter_by(message_id=msg.id).all()
+            self.assertEqual({e.user_id for e in entries},
+                             {self.testuserid, 60})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 60
+
+            resp = c.get("/")
+            self.assertIn("Hello", str(resp.data))
+
+    def test_message_delete_removes_timeline_entries(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuserid
+
+            c.post("/messages/new", data={"text": "Hello"})
+            msg = Message.query.one()
+            self.assertEqual(TimelineEntry.query.count(), 1)
+
+            c.post(f"/messages/{msg.id}/delete")
+            self.assertEqual(TimelineEntry.query.count(), 0)
+
+    def test_message_search(self):
+        app.extensions.pop('message_search', None)
+
+        db.session.add_all([
+            Message(id=1, text="birds sing", user_id=self.testuserid),
+            Message(id=2, text="birds birds birds", user_id=self.testuserid),
+            Message(id=3, text="cats sleep", user_id=self.testuserid),
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuserid
+
+            resp = c.get("/messages/search?q=Birds")
+            html = str(resp.data)
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn("cats sleep", html)
+
+            # more occurrences of the term rank higher
+            self.assertLess(html.index("birds birds birds"),
+                            html.index("birds sing"))
+
+            c.post("/messages/new", data={"text": "the birds are back"})
+            c.post("/messages/2/delete")
+
+            resp = c.get("/messages/search?q=birds")
+            self.assertIn("the birds are back", str(resp.data))
+            self.assertNotIn("birds birds birds", str(resp.data))
+
+    def test_message_search_pagination(self):
+        app.extensions.pop('message_search', None)
+        app.config['MESSAGES_PER_PAGE'] = 2
+
+        try:
+            for i in range(1, 6):
+                db.session.add(Message(id=i, text=f"warble number {i}",
+                                       user_id=self.testuserid))
+            db.session.commit()
+
+            seen = []
+            url = "/messages/search?q=warble"
+            with self.client as c:
+                while url:
+                    resp = c.get(url)
+                    soup = BeautifulSoup(resp.data, 'html.parser')
+                    seen += [p.text for p in soup.select(".message-area p")]
+                    more = soup.select_one("a.older-link")
+                    url = more["href"] if more else None
+
+                resp = c.get("/messages/search?q=warble&after=nope")
+                self.assertEqual(resp.status_code, 400)
+
+            self.assertEqual(sorted(seen),
+                             [f"warble number {i}" for i in range(1, 6)])
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 20
+
+    def test_message_search_skips_gone_messages(self):
+        app.extensions.pop('message_search', None)
+        app.config['MESSAGES_PER_PAGE'] = 2
+
+        try:
+            other = User.signup("other", "other@test.com", "password", None)
+            for i in range(1, 7):
+                author = other if i % 2 else self.testuser
+                db.session.add(Message(id=i, text=f"warble number {i}",
+                                       user=author))
+            db.session.commit()
+
+            with self.client as c:
+                c.get("/messages/search?q=warble")
+
+                # deleted behind the index's back, as another process would
+                Message.query.filter_by(id=6).delete()
+                disable_user(other)
+                db.session.commit()
+
+                resp = c.get("/messages/search?q=warble")
+                soup = BeautifulSoup(resp.data, 'html.parser')
+                found = [p.text for p in soup.select(".message-area p")]
+
+            self.assertEqual(found, ["warble number 4", "warble number 2"])
+            self.assertNotIn(6, message_search().documents)
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 20
+
+    def open_live_stream(self, user_id, headers=None):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        resp = client.get("/api/timeline/events", buffered=False,
+                          headers=headers)
+        return resp, iter(resp.response)
+
+    def post_message(self, text):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.testuserid
+        client.post("/messages/new", data={"text": text})
+
+    def test_live_events(self):
+        for user_id in [60, 70]:
+            user = User.signup(username=f"user{user_id}",
+                               email=f"user{user_id}@test.com",
+                               password="password",
+                               image_url=None)
+            user.id = user_id
+        db.session.add(Follows(user_being_followed_id=self.testuserid,
+                               user_following_id=60))
+        db.session.commit()
+
+        hub, broker = app.extensions['live']
+        app.config['LIVE_HEARTBEAT'] = 0.01
+
+        try:
+            follower, follower_events = self.open_live_stream(60)
+            stranger, stranger_events = self.open_live_stream(70)
+            self.assertEqual(follower.mimetype, "text/event-stream")
+            self.assertEqual(hub.connections, 2)
+            self.assertIn(b"retry:", next(follower_events))
+            self.assertIn(b"retry:", next(stranger_events))
+
+            self.post_message("live warble")
+
+            event = next(follower_events).decode()
+            self.assertIn("event: message", event)
+            self.assertIn('"text":"live warble"', event)
+            self.assertIn('"username":"testuser"', event)
+            self.assertEqual(next(stranger_events), b": heartbeat\n\n")
+
+            follower.close()
+            stranger.close()
+            self.assertEqual(hub.connections, 0)
+        finally:
+            app.config['LIVE_HEARTBEAT'] = 15
+
+    def test_live_events_resume(self):
+        for text in ["seen", "missed one", "missed two"]:
+            self.post_message(text)
+        seen = Message.query.filter_by(text="seen").one()
+
+        resp, events = self.open_live_stream(
+            self.testuserid, headers={"Last-Event-ID": encode_cursor(seen)})
+        next(events)
+        self.assertIn('"text":"missed one"', next(events).decode())
+        self.assertIn('"text":"missed two"', next(events).decode())
+
+        self.post_message("live")
+        self.assertIn('"text":"live"', next(events).decode())
+        resp.close()
+
+        bad, _ = self.open_live_stream(self.testuserid,
+                                       headers={"Last-Event-ID": "nope"})
+        self.assertEqual(bad.status_code, 400)
+
+    def test_live_postgres_broker_refuses_pgbouncer(self):
+        other = Flask(__name__)
+        other.config.update(LIVE_BROKER='postgres', DB_PGBOUNCER=True)
+
+        with self.assertRaises(ValueError):
+            live.init_app(other)
+
+    def test_live_postgres_broker_heartbeat(self):
+        other = Flask(__name__)
+        other.config.update(LIVE_BROKER='postgres', LIVE_HEARTBEAT=2)
+        live.init_app(other)
+
+        hub, broker = other.extensions['live']
+        self.assertEqual(broker.heartbeat, 2)
+
+    def test_live_events_limits(self):
+        hub, broker = app.extensions['live']
+        hub.max_connections, hub.queue_size = 1, 1
+
+        try:
+            resp, events = self.open_live_stream(self.testuserid)
+            full, _ = self.open_live_stream(self.testuserid)
+            self.assertEqual(full.status_code, 503)
+            self.assertIn("Retry-After", full.headers)
+
+            # a client this far behind is told to reload instead
+            next(events)
+            self.post_message("one")
+            self.post_message("two")
+            self.assertIn(b"event: reset", next(events))
+            with self.assertRaises(StopIteration):
+                next(events)
+            resp.close()
+        finally:
+            hub.max_connections, hub.queue_size = 100, 100
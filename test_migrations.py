@@ -0,0 +1,104 @@
+"""Schema migration tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrations.py
+
+
+import os
+from unittest import TestCase
+
+from alembic.autogenerate import compare_metadata
+from alembic.migration import MigrationContext
+from flask_migrate import downgrade, upgrade
+from sqlalchemy import inspect
+
+from models import db, Likes, TimelineEntry, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test2"
+
+
+# Now we can import app
+from app import app
+from bulk_load import progress
+
+
+def drop_everything():
+    db.drop_all()
+    progress.drop(bind=db.engine, checkfirst=True)
+    db.engine.execute("DROP TABLE IF EXISTS alembic_version")
+
+
+class MigrationsTestCase(TestCase):
+    """Upgrading an empty database."""
+
+    def setUp(self):
+        drop_everything()
+
+    def tearDown(self):
+        drop_everything()
+        db.create_all()
+
+    def test_upgrade_matches_models(self):
+        with app.app_context():
+            upgrade()
+
+        with db.engine.connect() as conn:
+            context = MigrationContext.configure(conn)
+            self.assertEqual(context.get_current_revision(), 'b5e2f8a41c67')
+            self.assertEqual(compare_metadata(context, db.metadata), [])
+
+        indexes = {index['name']
+                   for index in inspect(db.engine).get_indexes('messages')}
+        self.assertIn('ix_messages_user_timestamp', indexes)
+
+    def test_downgrade_drops_indexes(self):
+        with app.app_context():
+            upgrade()
+            downgrade(revision='d8e41b7c2a90')
+
+        inspector = inspect(db.engine)
+        self.assertNotIn('ix_messages_user_timestamp',
+                         {index['name']
+                          for index in inspector.get_indexes('messages')})
+        self.assertNotIn('ix_follows_following_followed',
+                         {index['name']
+                          for index in inspector.get_indexes('follows')})
+
+    def test_upgrade_from_baseline(self):
+        with app.app_context():
+            upgrade(revision='126b7f5e783f')
+
+        # rows written by the app before migrations existed
+        db.engine.execute(
+            "INSERT INTO users (id, email, username, password) VALUES "
+            "(1, 'a@test.com', 'a', 'x'), (2, 'b@test.com', 'b', 'x')")
+        db.engine.execute(
+            "INSERT INTO messages (id, text, timestamp, user_id) VALUES "
+            "(1, 'first', '2017-01-01 10:00:00', 1), "
+            "(2, 'second', '2017-01-02 10:00:00', 1)")
+        db.engine.execute(
+            "INSERT INTO follows (user_being_followed_id, user_following_id) "
+            "VALUES (1, 2)")
+        db.engine.execute(
+            "INSERT INTO likes (id, user_id, message_id) VALUES (1, 2, 1)")
+
+        with app.app_context():
+            upgrade()
+
+        user1 = User.query.get(1)
+        self.assertEqual(user1.message_count, 2)
+        self.assertEqual(user1.follower_count, 1)
+        self.assertEqual(User.query.get(2).like_count, 1)
+
+        # both messages, for their author and their follower
+        self.assertEqual(TimelineEntry.query.count(), 4)
+
+        # a message can now be liked by more than one user
+        db.session.add(Likes(user_id=1, message_id=1))
+        db.session.commit()
@@ -0,0 +1,119 @@
+"""Thumbnail proxy tests."""
+
+
+import io
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from PIL import Image
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test2"
+
+
+# Now we can import app
+from app import app
+from thumbnails import fetch, thumbnail, ThumbnailCache, ThumbnailError
+
+IMAGE_URL = "http://example.com/big.jpg"
+
+
+def make_image(width, height, color='red'):
+    out = io.BytesIO()
+    Image.new('RGB', (width, height), color).save(out, 'JPEG')
+    return out.getvalue()
+
+
+class ThumbnailTestCase(TestCase):
+    """Test fetching, resizing and caching images."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fetched = []
+
+        def fetcher(url):
+            self.fetched.append(url)
+            return make_image(1000, 500)
+
+        app.config['THUMBNAIL_CACHE_DIR'] = self.directory
+        app.config['THUMBNAIL_FETCHER'] = fetcher
+        app.extensions.pop('thumbnails', None)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        app.config['THUMBNAIL_CACHE_DIR'] = None
+        app.config['THUMBNAIL_FETCHER'] = None
+        app.extensions.pop('thumbnails', None)
+
+    def thumbnail_url(self, size):
+        with app.test_request_context():
+            return thumbnail(IMAGE_URL, size)
+
+    def test_fetched_once_for_all_sizes(self):
+        resp = self.client.get(self.thumbnail_url('avatar'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("max-age", resp.headers['Cache-Control'])
+        self.assertEqual(Image.open(io.BytesIO(resp.data)).size, (96, 96))
+        resp.close()
+
+        resp = self.client.get(self.thumbnail_url('hero'))
+        self.assertEqual(Image.open(io.BytesIO(resp.data)).size, (600, 300))
+        resp.close()
+
+        self.assertEqual(self.fetched, [IMAGE_URL])
+
+    def test_forged_token(self):
+        url = self.thumbnail_url('avatar')
+        resp = self.client.get(url[:-2] + "xx")
+
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(self.fetched, [])
+
+    def test_eviction(self):
+        cache = ThumbnailCache(self.directory, max_bytes=1)
+
+        cache.store(IMAGE_URL, make_image(100, 100))
+        self.assertIsNone(cache.lookup('avatar', IMAGE_URL))
+        self.assertLessEqual(cache.total_bytes, 1)
+
+    def test_eviction_counts_refs(self):
+        cache = ThumbnailCache(self.directory, max_bytes=10 ** 9)
+        image = make_image(100, 100, 'blue')
+        cache.store(IMAGE_URL, image)
+        cache.store("http://example.com/same.jpg", image)
+
+        on_disk = sum(os.path.getsize(os.path.join(root, name))
+                      for root, dirs, files in os.walk(self.directory)
+                      for name in files)
+        self.assertEqual(cache.total_bytes, on_disk)
+
+    def test_fetch_refuses_private_addresses(self):
+        with app.app_context():
+            for url in ["http://127.0.0.1:1/big.jpg",
+                        "https://[::1]/big.jpg",
+                        "ftp://example.com/big.jpg"]:
+                with self.assertRaises(ThumbnailError):
+                    fetch(url)
+
+    def test_served_when_evicted_at_once(self):
+        app.config['THUMBNAIL_CACHE_MAX_BYTES'] = 1
+
+        try:
+            resp = self.client.get(self.thumbnail_url('avatar'))
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(Image.open(io.BytesIO(resp.data)).size, (96, 96))
+            etag = resp.headers['ETag']
+            resp.close()
+
+            resp = self.client.get(self.thumbnail_url('avatar'),
+                                   headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+        finally:
+            app.config['THUMBNAIL_CACHE_MAX_BYTES'] = 512 * 1024 * 1024
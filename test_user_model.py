@@ -2,10 +2,13 @@
 
 
 import os
+from threading import Event, Thread
 from unittest import TestCase
 from sqlalchemy import exc
 
 from models import db, User, Message, Follows, Likes
+from counters import repair_counters
+from passwords import PasswordHasher, HashingBusy, hash_cost, init_app
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -78,6 +81,55 @@ class UserModelTestCase(TestCase):
         self.assertEqual(len(u.messages), 0)
         self.assertEqual(len(u.followers), 0)
 
+    def test_counters(self):
+        msg = Message(text="a warble", user_id=self.user2id)
+        db.session.add(msg)
+        self.user1.following.append(self.user2)
+        self.user1.likes.append(msg)
+        db.session.commit()
+
+        user1 = User.query.get(self.user1id)
+        user2 = User.query.get(self.user2id)
+        self.assertEqual(user1.following_count, 1)
+        self.assertEqual(user1.like_count, 1)
+        self.assertEqual(user2.follower_count, 1)
+        self.assertEqual(user2.message_count, 1)
+
+        Follows.query.filter_by(user_following_id=self.user1id).delete()
+        db.session.delete(msg)
+        db.session.commit()
+
+        # the like went with the message; the follow was deleted in bulk
+        user1 = User.query.get(self.user1id)
+        user2 = User.query.get(self.user2id)
+        self.assertEqual(user1.like_count, 0)
+        self.assertEqual(user2.message_count, 0)
+        self.assertEqual(user2.follower_count, 1)
+
+        self.assertEqual(repair_counters(batch_size=1), 2)
+        user1 = User.query.get(self.user1id)
+        user2 = User.query.get(self.user2id)
+        self.assertEqual(user1.following_count, 0)
+        self.assertEqual(user2.follower_count, 0)
+
+    def test_counters_after_user_delete(self):
+        msg = Message(text="a warble", user_id=self.user1id)
+        db.session.add(msg)
+        db.session.add(Follows(user_being_followed_id=self.user1id,
+                               user_following_id=self.user2id))
+        db.session.add(Follows(user_being_followed_id=self.user2id,
+                               user_following_id=self.user1id))
+        self.user2.likes.append(msg)
+        db.session.commit()
+
+        db.session.delete(User.query.get(self.user1id))
+        db.session.commit()
+
+        user2 = User.query.get(self.user2id)
+        self.assertEqual(user2.follower_count, 0)
+        self.assertEqual(user2.following_count, 0)
+        self.assertEqual(user2.like_count, 0)
+
     def test_user_follows(self):
         self.user1.following.append(self.user2)
         db.session.commit()
@@ -103,6 +155,23 @@ class UserModelTestCase(TestCase):
 
         self.assertTrue(self.user2.is_followed_by(self.user1))
 
+    def test_following_ids(self):
+        user3 = User.signup(username='user3', password='password',
+                            email="3@gmail.com", image_url=None)
+        user3.id = 40
+        self.user1.following.append(self.user2)
+        db.session.commit()
+
+        user1 = User.query.get(self.user1id)
+        self.assertEqual(user1.following_ids([self.user2id, 40]),
+                         {self.user2id})
+        self.assertEqual(user1.follower_ids([self.user2id, 40]), set())
+
+        # answered from the cache, then refreshed when following changes
+        self.assertFalse(user1.is_following(user3))
+        user1.following.append(user3)
+        self.assertTrue(user1.is_following(user3))
+
     ####
     #
     # Signup Tests
@@ -149,3 +218,63 @@ class UserModelTestCase(TestCase):
 
     def test_wrong_password(self):
         self.assertFalse(User.authenticate(username=self.user1.username, password="badpassword"))
+
+    def test_authenticate_rehashes_old_cost(self):
+        old_rounds = app.config['BCRYPT_LOG_ROUNDS']
+        self.assertEqual(hash_cost(self.user1.password), old_rounds)
+
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        init_app(app)
+        try:
+            user = User.authenticate(username="user1", password="password")
+            db.session.commit()
+
+            self.assertEqual(hash_cost(user.password), 4)
+            self.assertTrue(User.authenticate(username="user1",
+                                              password="password"))
+        finally:
+            app.config['BCRYPT_LOG_ROUNDS'] = old_rounds
+            init_app(app)
+
+    def test_authenticate_keeps_current_cost(self):
+        old_hash = self.user1.password
+        User.authenticate(username="user1", password="password")
+
+        self.assertEqual(self.user1.password, old_hash)
+
+    def test_hasher_sheds_excess_load(self):
+        hasher = PasswordHasher(max_concurrency=1, max_queued=0,
+                                queue_timeout=0)
+        started = Event()
+        release = Event()
+
+        def slow():
+            started.set()
+            release.wait()
+
+        worker = Thread(target=hasher.run, args=(slow,))
+        worker.start()
+        started.wait()
+
+        try:
+            with self.assertRaises(HashingBusy):
+                hasher.run(lambda: None)
+        finally:
+            release.set()
+            worker.join()
+
+        self.assertEqual(hasher.run(lambda: 42), 42)
+
+    def test_hasher_reconfigure_shuts_down_old_pool(self):
+        hasher = PasswordHasher(max_concurrency=1)
+        old_executor = hasher.executor
+
+        hasher.configure(2, 0, 0)
+        try:
+            with self.assertRaises(RuntimeError):
+                old_executor.submit(lambda: None)
+            self.assertEqual(hasher.run(lambda: 'ok'), 'ok')
+        finally:
+            hasher.shutdown()
+
+        PasswordHasher(max_concurrency=0).shutdown()
@@ -6,11 +6,22 @@
 
 
 
+import json
+import logging
 import os
+from datetime import datetime
 from unittest import TestCase
 
-from models import db, connect_db, Message, User, Likes, Follows
+from models import db, connect_db, Message, User, Likes, Follows, TimelineEntry
+from query_counter import QueryCounter
+from sql_stats import RequestSQLStats, RepeatedQueryError
+from user_cache import current_users
+from fragments import LRUFragmentCache
+from timelines import rebuild_timelines, followed_pulled_authors
+from jobs import work
+from accounts import disable_user
 from bs4 import BeautifulSoup
+from flask import g, session
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -19,6 +30,9 @@ from bs4 import BeautifulSoup
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test2"
 
+# a second database standing in for a read replica
+REPLICA_URL = "postgresql:///warbler-test2-replica"
+
 
 # Now we can import app
 from app import app, CURR_USER_KEY
@@ -42,6 +56,7 @@ class MessageViewTestCase(TestCase):
 
         db.drop_all()
         db.create_all()
+        app.extensions.pop('message_fragments', None)
 
         self.testuser = User.signup(username="test",
                                     email="test@gmail.com",
@@ -84,6 +99,66 @@ class MessageViewTestCase(TestCase):
 
             self.assertNotIn("@abc", str(resp.data))
 
+    def test_users_search_ranking(self):
+        for i, username in enumerate(["xtest", "testing", "tes"]):
+            user = User.signup(username, f"rank{i}@test.com", "password", None)
+            user.id = 400 + i
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get("/users?q=TEST")
+            soup = BeautifulSoup(resp.data, 'html.parser')
+            found = [p.text for p in soup.select(".card-link p")]
+
+            # exact, then prefix, then substring; "tes" doesn't match
+            self.assertEqual(found, ["@test", "@testing", "@xtest"])
+
+    def test_users_search_pagination(self):
+        for i, username in enumerate(["tester", "Tester", "xtest"]):
+            user = User.signup(username, f"page{i}@test.com", "password", None)
+            user.id = 500 + i
+        db.session.commit()
+        app.config['USERS_PER_PAGE'] = 2
+
+        try:
+            found = []
+            url = "/users?q=test"
+            with self.client as c:
+                while url:
+                    resp = c.get(url)
+                    soup = BeautifulSoup(resp.data, 'html.parser')
+                    found += [p.text for p in soup.select(".card-link p")]
+                    next_link = soup.find("a", string="Next")
+                    url = next_link["href"] if next_link else None
+
+                resp = c.get("/users?q=test&after=nope")
+                self.assertEqual(resp.status_code, 400)
+
+            # names equal but for case are in id order
+            self.assertEqual(found,
+                             ["@test", "@tester", "@Tester", "@xtest"])
+        finally:
+            app.config['USERS_PER_PAGE'] = 24
+
+    def test_users_pagination(self):
+        app.config['USERS_PER_PAGE'] = 2
+
+        try:
+            with self.client as c:
+                resp = c.get("/users")
+                soup = BeautifulSoup(resp.data, 'html.parser')
+                found = [p.text for p in soup.select(".card-link p")]
+                self.assertEqual(found, ["@abc", "@efg"])
+
+                next_link = soup.find("a", string="Next")
+                resp = c.get(next_link["href"])
+                soup = BeautifulSoup(resp.data, 'html.parser')
+                found = [p.text for p in soup.select(".card-link p")]
+                self.assertEqual(found, ["@test"])
+                self.assertIsNone(soup.find("a", string="Next"))
+        finally:
+            app.config['USERS_PER_PAGE'] = 24
+
     def test_user_show(self):
         with self.client as c:
             resp = c.get(f"/users/{self.testuser_id}")
@@ -144,6 +219,20 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(len(likes), 1)
             self.assertEqual(likes[0].user_id, self.testuser_id)
 
+    def test_like_disabled_authors_message(self):
+        msg = Message(id=10, text="he warbles", user_id=self.user1_id)
+        db.session.add(msg)
+        disable_user(User.query.get(self.user1_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.post("/messages/add_like/10")
+            self.assertEqual(resp.status_code, 404)
+            self.assertEqual(Likes.query.count(), 0)
+
     def test_remove_like(self):
         self.setup_likes()
 
@@ -169,6 +258,20 @@ class MessageViewTestCase(TestCase):
             # the like has been deleted
             self.assertEqual(len(likes), 0)
 
+    def test_like_message_liked_by_someone_else(self):
+        self.setup_likes()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user2_id
+
+            resp = c.post("/messages/add_like/5", follow_redirects=True)
+            self.assertEqual(resp.status_code, 200)
+
+            likes = Likes.query.filter(Likes.message_id == 5).all()
+            self.assertEqual({l.user_id for l in likes},
+                             {self.testuser_id, self.user2_id})
+
     def test_unauthenticated_like(self):
         self.setup_likes()
 
@@ -261,4 +364,567 @@ class MessageViewTestCase(TestCase):
             resp = c.get(f"/users/{self.testuser_id}/followers", follow_redirects=True)
             self.assertEqual(resp.status_code, 200)
             self.assertNotIn("@abc", str(resp.data))
-            self.assertIn("Access unauthorized", str(resp.data))
\ No newline at end of file
+            self.assertIn("Access unauthorized", str(resp.data))
+
+    def test_follow_backfills_timeline(self):
+        msg = Message(id=7, text="old warble", user_id=self.user1_id)
+        db.session.add(msg)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post(f"/users/follow/{self.user1_id}")
+
+            entry = TimelineEntry.query.filter_by(
+                user_id=self.testuser_id).one()
+            self.assertEqual(entry.message_id, 7)
+
+            resp = c.get("/")
+            self.assertIn("old warble", str(resp.data))
+
+    def test_unfollow_trims_timeline(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post(f"/users/follow/{self.user1_id}")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            c.post("/messages/new", data={"text": "followed warble"})
+            self.assertEqual(TimelineEntry.query.filter_by(
+                user_id=self.testuser_id).count(), 1)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post(f"/users/stop-following/{self.user1_id}")
+            self.assertEqual(TimelineEntry.query.filter_by(
+                user_id=self.testuser_id).count(), 0)
+
+            resp = c.get("/")
+            self.assertNotIn("followed warble", str(resp.data))
+
+    def test_stop_following_unknown_or_unfollowed(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.post("/users/stop-following/99999")
+            self.assertEqual(resp.status_code, 404)
+
+            resp = c.post(f"/users/stop-following/{self.user1_id}")
+            self.assertEqual(resp.status_code, 302)
+            self.assertTrue(resp.location.endswith(
+                f"/users/{self.testuser_id}/following"))
+
+    def test_popular_author_read_at_request_time(self):
+        self.setup_followers()
+        app.config['TIMELINE_FANOUT_LIMIT'] = 1
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user1_id
+
+                c.post("/messages/new", data={"text": "popular warble"})
+
+                # user1 has a follower, so only their own entry is written
+                self.assertEqual(TimelineEntry.query.count(), 1)
+                self.assertTrue(User.query.get(self.user1_id).pulled)
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser_id
+
+                resp = c.get("/")
+                self.assertIn("popular warble", str(resp.data))
+
+                # still there once user1 is no longer popular
+                app.config['TIMELINE_FANOUT_LIMIT'] = 10000
+                resp = c.get("/")
+                self.assertIn("popular warble", str(resp.data))
+        finally:
+            app.config['TIMELINE_FANOUT_LIMIT'] = 10000
+
+    def test_pulled_authors_found_in_one_query(self):
+        for i in range(20):
+            user = User.signup(f"author{i}", f"author{i}@test.com",
+                               "password", None)
+            user.id = 600 + i
+            user.pulled = i in (3, 11)
+            db.session.add(Follows(user_being_followed_id=600 + i,
+                                   user_following_id=self.testuser_id))
+        db.session.commit()
+
+        with QueryCounter() as queries:
+            authors = followed_pulled_authors(self.testuser_id)
+
+        self.assertEqual(sorted(authors), [603, 611])
+        self.assertEqual(queries.count, 1)
+
+    def test_user_show_pagination(self):
+        app.config['TIMELINE_PAGE_SIZE'] = 2
+
+        try:
+            for i in range(1, 6):
+                db.session.add(Message(id=i, text=f"warble {i}",
+                                       user_id=self.testuser_id))
+            db.session.commit()
+
+            with self.client as c:
+                resp = c.get(f"/users/{self.testuser_id}")
+                soup = BeautifulSoup(resp.data, 'html.parser')
+                self.assertEqual(len(soup.select("#messages li")), 2)
+
+                pages = 1
+                older = soup.select_one("a.older-link")
+                while older:
+                    resp = c.get(older["href"])
+                    self.assertEqual(resp.status_code, 200)
+                    soup = BeautifulSoup(resp.data, 'html.parser')
+                    older = soup.select_one("a.older-link")
+                    pages += 1
+
+                self.assertEqual(pages, 3)
+                self.assertIn("warble 1", str(resp.data))
+                self.assertNotIn("warble 3", str(resp.data))
+
+                resp = c.get(f"/users/{self.testuser_id}?before=garbage")
+                self.assertEqual(resp.status_code, 400)
+        finally:
+            app.config['TIMELINE_PAGE_SIZE'] = 20
+
+    def setup_timeline(self, authors):
+        """`authors` users who each post a warble liked and followed by testuser."""
+
+        for i in range(authors):
+            author = User.signup(f"author{i}", f"author{i}@test.com",
+                                 "password", None)
+            author.id = 1000 + i
+            db.session.add(Message(id=1000 + i, text=f"warble {i}",
+                                   user_id=1000 + i))
+            db.session.add(Follows(user_being_followed_id=1000 + i,
+                                   user_following_id=self.testuser_id))
+            db.session.add(Likes(user_id=self.testuser_id,
+                                 message_id=1000 + i))
+        db.session.commit()
+
+        rebuild_timelines()
+        db.session.commit()
+        db.session.remove()
+
+    def count_route_queries(self, url):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            with QueryCounter() as queries:
+                resp = c.get(url)
+
+            self.assertEqual(resp.status_code, 200)
+            return queries.count
+
+    def test_message_list_queries_do_not_grow_with_page(self):
+        self.setup_timeline(authors=2)
+        few = {url: self.count_route_queries(url) for url in
+               ["/", f"/users/1000", f"/users/{self.testuser_id}/likes"]}
+
+        self.setUp()
+        self.setup_timeline(authors=8)
+        many = {url: self.count_route_queries(url) for url in few}
+
+        self.assertEqual(few, many)
+        self.assertLessEqual(max(many.values()), 6, many)
+
+    def test_users_show_conditional_get(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get(f"/users/{self.user1_id}")
+            etag = resp.headers['ETag']
+            self.assertEqual(resp.headers['Cache-Control'], "private, no-cache")
+
+            resp = c.get(f"/users/{self.user1_id}",
+                         headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b"")
+
+            # following them changes the Follow button
+            c.post(f"/users/follow/{self.user1_id}")
+            resp = c.get(f"/users/{self.user1_id}",
+                         headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_users_show_edited_twice_in_one_second(self):
+        url = f"/users/{self.user1_id}"
+        user1 = User.query.get(self.user1_id)
+
+        with self.client as c:
+            user1.bio = "First bio"
+            db.session.commit()
+            last_modified = c.get(url).headers.get('Last-Modified')
+
+            user1.bio = "Second bio"
+            db.session.commit()
+
+            # within one second both edits would share a Last-Modified, so
+            # none is sent until the second is over
+            headers = {}
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+            resp = c.get(url, headers=headers)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Second bio", str(resp.data))
+
+            # once it is, whole seconds are compared
+            User.query.filter_by(id=self.user1_id).update(
+                {'updated_at': datetime(2020, 1, 1, 12, 0, 0, 700000)})
+            db.session.commit()
+            last_modified = c.get(url).headers['Last-Modified']
+            self.assertEqual(last_modified, "Wed, 01 Jan 2020 12:00:00 GMT")
+
+            resp = c.get(url, headers={'If-Modified-Since': last_modified})
+            self.assertEqual(resp.status_code, 304)
+
+    def test_following_revalidates_when_followed_user_changes(self):
+        db.session.add(Follows(user_being_followed_id=self.user1_id,
+                               user_following_id=self.testuser_id))
+        db.session.commit()
+
+        url = f"/users/{self.testuser_id}/following"
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            etag = c.get(url).headers['ETag']
+            self.assertEqual(
+                c.get(url, headers={'If-None-Match': etag}).status_code, 304)
+
+            user1 = User.query.get(self.user1_id)
+            user1.bio = "New bio"
+            db.session.commit()
+
+            resp = c.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("New bio", str(resp.data))
+
+    def test_uncacheable_pages(self):
+        with self.client as c:
+            resp = c.get("/login")
+            self.assertIn("no-store", resp.headers['Cache-Control'])
+
+            resp = c.get("/")
+            self.assertEqual(resp.headers['Cache-Control'],
+                             "public, max-age=300")
+
+    def test_sql_stats_headers(self):
+        self.setup_timeline(authors=2)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            with QueryCounter() as queries:
+                resp = c.get("/")
+
+        self.assertEqual(resp.headers['X-DB-Query-Count'],
+                         str(queries.count))
+        self.assertTrue(resp.headers['Server-Timing'].startswith("db;dur="))
+
+    def test_sql_stats_logged_after_streamed_body(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger('warbler.sql')
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+
+        try:
+            with QueryCounter() as queries:
+                resp = self.client.get("/users")
+                resp.get_data()
+            self.assertNotIn('X-DB-Query-Count', resp.headers)
+
+            # logged once the body is sent, with the queries it ran
+            self.assertEqual(records, [])
+            resp.close()
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(logging.NOTSET)
+
+        logged = json.loads(records[-1].getMessage())
+        self.assertEqual(logged['endpoint'], 'list_users')
+        self.assertEqual(logged['queries'], queries.count)
+
+    def test_flash_shown_once_on_streamed_page(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['_flashes'] = [('success', 'Hello again')]
+
+            self.assertIn("Hello again", str(c.get("/users").data))
+            self.assertNotIn("Hello again", str(c.get("/users").data))
+
+    def test_message_lists_repeat_no_queries(self):
+        self.setup_timeline(authors=4)
+        app.config['SQL_REPEAT_LIMIT'] = 1
+
+        try:
+            for url in ["/", "/users/1000", f"/users/{self.testuser_id}/likes",
+                        f"/users/{self.testuser_id}/following"]:
+                self.count_route_queries(url)
+        finally:
+            app.config['SQL_REPEAT_LIMIT'] = None
+
+    def test_repeat_limit(self):
+        stats = RequestSQLStats(repeat_limit=2)
+        stats.started("SELECT * FROM users WHERE id IN (?, ?)")
+        stats.started("SELECT * FROM users\n WHERE id IN (?)")
+
+        with self.assertRaises(RepeatedQueryError):
+            stats.started("SELECT * FROM users WHERE id IN (?, ?, ?)")
+
+    def test_current_user_cached_between_requests(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            with QueryCounter() as queries:
+                c.get("/logout")
+            self.assertEqual(queries.count, 0)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.get("/users/profile")
+            with QueryCounter() as queries:
+                resp = c.get("/users/profile")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('value="test"', str(resp.data))
+            self.assertEqual(queries.count, 0, queries.statements)
+
+    def test_edit_profile_refreshes_current_user(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.get("/users/profile")
+            resp = c.post("/users/profile", data={
+                "username": "renamed",
+                "email": "test@gmail.com",
+                "password": "testuser",
+            }, follow_redirects=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("@renamed", str(resp.data))
+            self.assertNotIn(self.testuser_id, current_users.entries)
+
+            resp = c.get("/users/profile")
+            self.assertIn('value="renamed"', str(resp.data))
+
+    def test_message_fragments_cached(self):
+        m = Message(id=1, text="cached warble", user_id=self.testuser_id)
+        db.session.add(m)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.get(f"/users/{self.testuser_id}")
+            cache = app.extensions['message_fragments']
+            self.assertEqual(len(cache.entries), 1)
+
+            # a cached fragment is served as is, not rendered again
+            key = next(iter(cache.entries))
+            cache.entries[key] = "<p>from the cache</p>"
+            resp = c.get(f"/users/{self.testuser_id}")
+            self.assertIn("from the cache", str(resp.data))
+
+            # renaming the author bumps profile_version, so new keys
+            c.post("/users/profile", data={
+                "username": "renamed",
+                "email": "test@gmail.com",
+                "password": "testuser",
+            })
+            self.assertEqual(User.query.get(self.testuser_id).profile_version,
+                             2)
+            resp = c.get(f"/users/{self.testuser_id}")
+            self.assertNotIn("from the cache", str(resp.data))
+            self.assertIn("cached warble", str(resp.data))
+
+    def test_fragment_cache_evicts_least_recent(self):
+        cache = LRUFragmentCache(max_entries=2)
+        cache.set_many({'a': '1', 'b': '2'})
+        self.assertEqual(cache.get_many('a'), ['1'])
+
+        cache.set_many({'c': '3'})
+        self.assertEqual(cache.get_many('a', 'b', 'c'), ['1', None, '3'])
+
+    def test_api_timeline(self):
+        self.setup_timeline(3)
+
+        with self.client as c:
+            resp = c.get("/api/timeline")
+            self.assertEqual(resp.status_code, 401)
+            self.assertIn("error", resp.get_json())
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get("/api/timeline?limit=2&fields=text,username")
+            self.assertEqual(resp.status_code, 200)
+            data = resp.get_json()
+            self.assertEqual(data["messages"], [
+                {"text": "warble 2", "username": "author2"},
+                {"text": "warble 1", "username": "author1"},
+            ])
+
+            resp = c.get("/api/timeline?limit=2&fields=id,timestamp"
+                         f"&before={data['next']}")
+            data = resp.get_json()
+            self.assertEqual([m["id"] for m in data["messages"]], [1000])
+            self.assertIsNone(data["next"])
+
+            self.assertEqual(c.get("/api/timeline?fields=password")
+                             .status_code, 400)
+            self.assertEqual(c.get("/api/timeline?limit=100000")
+                             .status_code, 400)
+            self.assertEqual(c.get("/api/timeline?before=garbage")
+                             .status_code, 400)
+
+    def test_api_user_messages_and_likes(self):
+        self.setup_timeline(2)
+
+        with self.client as c:
+            resp = c.get("/api/users/1000/messages?fields=text")
+            self.assertEqual(resp.get_json(),
+                             {"messages": [{"text": "warble 0"}],
+                              "next": None})
+            self.assertEqual(c.get("/api/users/99999/messages").status_code,
+                             404)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get(f"/api/users/{self.testuser_id}/likes")
+            messages = resp.get_json()["messages"]
+            self.assertEqual([m["id"] for m in messages], [1001, 1000])
+            self.assertEqual(set(messages[0]), {
+                "id", "text", "timestamp", "user_id", "username",
+                "image_url"})
+
+    def test_api_followers_streamed_in_pages(self):
+        self.setup_timeline(5)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            url = (f"/api/users/{self.testuser_id}/following"
+                   "?limit=2&fields=username")
+            usernames = []
+            while url:
+                data = c.get(url).get_json()
+                usernames += [u["username"] for u in data["users"]]
+                url = data["next"] and (
+                    f"/api/users/{self.testuser_id}/following"
+                    f"?limit=2&fields=username&after={data['next']}")
+
+            self.assertEqual(usernames, [f"author{i}" for i in range(5)])
+
+            resp = c.get("/api/users/1000/followers?fields=id,username")
+            self.assertEqual(resp.get_json()["users"],
+                             [{"id": self.testuser_id, "username": "test"}])
+
+    def test_following_streamed_in_chunks(self):
+        self.setup_timeline(5)
+        app.config['STREAM_CHUNK_SIZE'] = 2
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser_id
+
+                resp = c.get(f"/users/{self.testuser_id}/following")
+                self.assertTrue(resp.is_streamed)
+
+                soup = BeautifulSoup(resp.data, 'html.parser')
+                cards = soup.select(".card-contents")
+                self.assertEqual([card.p.text for card in cards],
+                                 [f"@author{i}" for i in range(5)])
+                self.assertTrue(all("Unfollow" in card.text
+                                    for card in cards))
+        finally:
+            app.config['STREAM_CHUNK_SIZE'] = 100
+
+    def test_delete_user_disables_then_purges(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.post("/users/delete")
+            self.assertEqual(resp.status_code, 302)
+            self.assertNotIn(CURR_USER_KEY, session)
+
+        # gone from view at once, still in the table until the job runs
+        self.assertEqual(self.client.get(f"/users/{self.testuser_id}")
+                         .status_code, 404)
+        resp = self.client.get("/users")
+        self.assertNotIn("@test<", str(resp.data))
+        self.assertIsNotNone(User.query.get(self.testuser_id))
+
+        self.assertEqual(work(burst=True), 1)
+        self.assertIsNone(User.query.get(self.testuser_id))
+
+    def test_reads_from_replica_until_client_writes(self):
+        app.config['SQLALCHEMY_BINDS'] = {'replica0': REPLICA_URL}
+        app.config['REPLICA_BINDS'] = ['replica0']
+        replica = db.get_engine(app, bind='replica0')
+
+        try:
+            db.metadata.drop_all(replica)
+            db.metadata.create_all(replica)
+            replica.execute(User.__table__.insert(), id=self.testuser_id,
+                            username="replicated", email="r@test.com",
+                            password="password")
+            db.session.remove()
+
+            with app.test_request_context():
+                g.replica_bind = 'replica0'
+                self.assertIs(db.session.get_bind(clause=db.select([1])),
+                              replica)
+                self.assertIs(db.session.get_bind(
+                    clause=User.__table__.update()), db.engine)
+                db.session.add(Follows(user_being_followed_id=self.user1_id,
+                                       user_following_id=self.user2_id))
+                db.session.flush()
+                self.assertIs(db.session.get_bind(clause=db.select([1])),
+                              db.engine)
+                db.session.rollback()
+
+            resp = self.client.get(f"/users/{self.testuser_id}")
+            self.assertIn("@replicated", str(resp.data))
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser_id
+
+                c.post(f"/users/follow/{self.user1_id}")
+                resp = c.get(f"/users/{self.testuser_id}")
+                self.assertIn("@test", str(resp.data))
+
+                with c.session_transaction() as sess:
+                    sess['primary_until'] = 0
+                resp = c.get(f"/users/{self.testuser_id}")
+                self.assertIn("@replicated", str(resp.data))
+        finally:
+            app.config['SQLALCHEMY_BINDS'] = {}
+            app.config['REPLICA_BINDS'] = []
+            db.session.remove()
+            db.metadata.drop_all(replica)
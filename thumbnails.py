@@ -0,0 +1,383 @@
+"""Resized, locally cached copies of users' avatar and header images.
+
+Users' image URLs point at full-size images anywhere on the web, which the
+timeline then shows at 48px. Templates instead use
+`thumbnail(url, 'avatar')`, which links to /images/avatar/<token>. The
+token is the URL signed with SECRET_KEY, so the route only ever fetches URLs
+that the app itself rendered.
+
+The first request for a URL fetches it once and writes every size in SIZES.
+The results are content-addressed: blobs/<sha256>.<ext> holds the image
+bytes, and refs/<key> names the blob for one (size, URL) pair, so identical
+images are stored once. When the cache (blobs and refs both) outgrows
+THUMBNAIL_CACHE_MAX_BYTES, the least recently served files are deleted,
+and their URLs are fetched again the next time they're asked for.
+Thumbnails are served with a month-long public Cache-Control.
+
+THUMBNAIL_FETCHER can replace the function that downloads a URL (tests use
+local files). The default one reads /static/ paths from disk, and refuses
+other URLs that aren't http(s) or that resolve to private addresses. The
+address checked is the one connected to, so a host can't pass the check
+and then resolve somewhere else (DNS rebinding).
+"""
+
+import hashlib
+import http.client
+import io
+import ipaddress
+import mimetypes
+import os
+import socket
+import urllib.request
+from threading import Lock
+from urllib.parse import urlsplit
+
+from flask import (abort, current_app, redirect, request, send_file,
+                   url_for)
+from itsdangerous import BadSignature, URLSafeSerializer
+from PIL import Image, ImageOps
+from werkzeug.security import safe_join
+
+# name: (width, height, crop); sizes are twice the CSS size for hi-dpi
+SIZES = {
+    'avatar': (96, 96, True),       # .timeline-image
+    'card': (140, 140, True),       # .card-image
+    'profile': (400, 400, True),    # #profile-avatar
+    'hero': (600, None, False),     # .card-hero
+    'banner': (1600, None, False),  # #warbler-hero
+}
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+DEFAULT_MAX_SOURCE_BYTES = 10 * 1024 * 1024
+DEFAULT_FETCH_TIMEOUT = 5
+EVICT_TO = 0.9
+CACHE_CONTROL = 'public, max-age=2592000'
+
+
+class ThumbnailError(Exception):
+    """An image couldn't be fetched or decoded."""
+
+
+def _check_url(url):
+    """Refuse URLs that aren't http(s)."""
+
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ThumbnailError(f"Not an http(s) URL: {url}")
+
+
+def _public_address(host, port):
+    """The address to connect to for `host`, if all of its are public."""
+
+    try:
+        addresses = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except OSError as error:
+        raise ThumbnailError(str(error))
+
+    for *_, sockaddr in addresses:
+        if not ipaddress.ip_address(sockaddr[0]).is_global:
+            raise ThumbnailError(f"Refusing non-public address: {host}")
+
+    return addresses[0][4][:2]
+
+
+def _connect_public(address, *args):
+    """socket.create_connection, to the address `_public_address` vetted.
+
+    The host is resolved once, here, and the socket connects to that IP,
+    so a second DNS answer can't send it anywhere else.
+    """
+
+    return socket.create_connection(_public_address(*address), *args)
+
+
+class _PublicHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _connect_public
+
+
+class _PublicHTTPSConnection(http.client.HTTPSConnection):
+    # TLS still verifies the certificate against the host name
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _connect_public
+
+
+class _PublicHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(_PublicHTTPConnection, req)
+
+
+class _PublicHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(_PublicHTTPSConnection, req)
+
+
+class _CheckedRedirects(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        _check_url(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+# no proxies: a proxy would do the resolving, unchecked
+_opener = urllib.request.build_opener(
+    urllib.request.ProxyHandler({}), _PublicHTTPHandler, _PublicHTTPSHandler,
+    _CheckedRedirects)
+
+
+def fetch(url):
+    """Bytes of the image at `url` (a /static/ path or public http(s) URL)."""
+
+    app = current_app
+    max_bytes = app.config.get('THUMBNAIL_MAX_SOURCE_BYTES',
+                               DEFAULT_MAX_SOURCE_BYTES)
+
+    static_prefix = app.static_url_path + '/'
+    if url.startswith(static_prefix):
+        path = safe_join(app.static_folder, url[len(static_prefix):])
+        if path is None or not os.path.isfile(path):
+            raise ThumbnailError(f"No such static file: {url}")
+        with open(path, 'rb') as image:
+            return image.read(max_bytes + 1)
+
+    _check_url(url)
+    timeout = app.config.get('THUMBNAIL_FETCH_TIMEOUT', DEFAULT_FETCH_TIMEOUT)
+    try:
+        with _opener.open(url, timeout=timeout) as response:
+            data = response.read(max_bytes + 1)
+    except (OSError, ValueError) as error:
+        raise ThumbnailError(str(error))
+
+    if len(data) > max_bytes:
+        raise ThumbnailError(f"Image too large: {url}")
+    return data
+
+
+def resize(data, width, height, crop):
+    """Encoded (bytes, extension) of image `data` scaled for one size."""
+
+    try:
+        image = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+        image.load()
+    except Exception as error:
+        raise ThumbnailError(f"Can't decode image: {error}")
+
+    if crop:
+        image = ImageOps.fit(image, (width, height), Image.LANCZOS)
+    else:
+        image.thumbnail((width, width * 10), Image.LANCZOS)
+
+    out = io.BytesIO()
+    if image.mode in ('RGBA', 'LA', 'P') and (
+            image.mode != 'P' or 'transparency' in image.info):
+        image.save(out, 'PNG', optimize=True)
+        return out.getvalue(), 'png'
+
+    image.convert('RGB').save(out, 'JPEG', quality=85, optimize=True)
+    return out.getvalue(), 'jpg'
+
+
+class ThumbnailCache:
+    """Content-addressed thumbnail files in `directory`, LRU-evicted."""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total_bytes = None
+        self.size_lock = Lock()
+        self.fetch_locks = [Lock() for _ in range(64)]
+
+    def _ref_path(self, size, url):
+        key = hashlib.sha256(f"{size}\0{url}".encode('UTF-8')).hexdigest()
+        return os.path.join(self.directory, 'refs', key[:2], key)
+
+    def _blob_path(self, name):
+        return os.path.join(self.directory, 'blobs', name[:2], name)
+
+    def _files(self):
+        """Paths of every blob and ref."""
+
+        for kind in ['blobs', 'refs']:
+            for root, dirs, files in os.walk(os.path.join(self.directory,
+                                                          kind)):
+                for name in files:
+                    yield os.path.join(root, name)
+
+    def lookup(self, size, url):
+        """Path of the cached thumbnail of `url` at `size`, or None."""
+
+        ref_path = self._ref_path(size, url)
+        try:
+            with open(ref_path) as ref:
+                path = self._blob_path(ref.read())
+            os.utime(path)
+            os.utime(ref_path)
+        except FileNotFoundError:
+            return None
+
+        return path
+
+    def _write(self, path, content):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, 'wb') as out:
+            out.write(content)
+        os.replace(temporary, path)
+
+    def store(self, url, data):
+        """Resize `data` (the image at `url`) to every size and cache it.
+
+        Returns {size: (file name, bytes)} of what was made.
+        """
+
+        made = {}
+        added = 0
+        for size, (width, height, crop) in SIZES.items():
+            content, extension = resize(data, width, height, crop)
+            name = f"{hashlib.sha256(content).hexdigest()}.{extension}"
+            made[size] = (name, content)
+            blob = self._blob_path(name)
+
+            if not os.path.exists(blob):
+                self._write(blob, content)
+                added += len(content)
+
+            ref = self._ref_path(size, url)
+            if not os.path.exists(ref):
+                added += len(name)
+            self._write(ref, name.encode('UTF-8'))
+
+        self._account(added)
+        return made
+
+    def _account(self, added):
+        with self.size_lock:
+            if self.total_bytes is None:
+                self.total_bytes = sum(os.path.getsize(path)
+                                       for path in self._files())
+            else:
+                self.total_bytes += added
+
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Delete least recently served files until well under the limit.
+
+        A ref whose blob is gone, or the reverse, is a miss like any other.
+        """
+
+        files = []
+        for path in self._files():
+            stat = os.stat(path)
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+
+        self.total_bytes = sum(size for (_, size, _) in files)
+        for (_, size, path) in files:
+            if self.total_bytes <= self.max_bytes * EVICT_TO:
+                break
+            os.remove(path)
+            self.total_bytes -= size
+
+    def _open(self, size, url):
+        """(file name, open file) of a cached thumbnail, or None."""
+
+        path = self.lookup(size, url)
+        if path is None:
+            return None
+
+        try:
+            # once open, it can be evicted without harm to this reader
+            return os.path.basename(path), open(path, 'rb')
+        except FileNotFoundError:
+            return None
+
+    def get(self, size, url, fetcher):
+        """(file name, open file) of `url`'s thumbnail at `size`.
+
+        Fetches and stores the image if it isn't cached. If storing it
+        evicted the thumbnail straight away (the cache is tiny, or another
+        thread was evicting), the bytes just made are returned instead.
+        """
+
+        found = self._open(size, url)
+        if found is not None:
+            return found
+
+        key = hash(url) % len(self.fetch_locks)
+        with self.fetch_locks[key]:
+            found = self._open(size, url)
+            if found is None:
+                made = self.store(url, fetcher(url))
+                found = self._open(size, url)
+                if found is None:
+                    name, content = made[size]
+                    found = name, io.BytesIO(content)
+
+        return found
+
+
+def thumbnail_cache():
+    """The current app's ThumbnailCache."""
+
+    app = current_app._get_current_object()
+    cache = app.extensions.get('thumbnails')
+
+    if cache is None:
+        cache = ThumbnailCache(
+            app.config.get('THUMBNAIL_CACHE_DIR') or
+            os.path.join(app.instance_path, 'thumbnails'),
+            app.config.get('THUMBNAIL_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES))
+        app.extensions['thumbnails'] = cache
+
+    return cache
+
+
+def _signer():
+    return URLSafeSerializer(current_app.secret_key, salt='thumbnail')
+
+
+def thumbnail(url, size):
+    """URL of `url`'s image resized to `size` (a key of SIZES)."""
+
+    if not url:
+        return url
+    return url_for('thumbnail_image', size=size, token=_signer().dumps(url))
+
+
+def thumbnail_image(size, token):
+    """Serve a thumbnail, fetching and resizing the image the first time."""
+
+    if size not in SIZES:
+        abort(404)
+
+    try:
+        url = _signer().loads(token)
+    except BadSignature:
+        abort(404)
+
+    fetcher = current_app.config.get('THUMBNAIL_FETCHER') or fetch
+    try:
+        name, image = thumbnail_cache().get(size, url, fetcher)
+    except ThumbnailError:
+        current_app.logger.warning("Can't make thumbnail of %s", url)
+        if urlsplit(url).scheme in ('http', 'https'):
+            return redirect(url)
+        abort(404)
+
+    response = send_file(image, mimetype=mimetypes.guess_type(name)[0],
+                         add_etags=False)
+    response.set_etag(name)
+    response.make_conditional(request)
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    return response
+
+
+def init_app(app):
+    """Add the /images route and the `thumbnail` template helper."""
+
+    app.add_url_rule('/images/<size>/<token>', 'thumbnail_image',
+                     thumbnail_image)
+    app.add_template_global(thumbnail)
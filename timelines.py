@@ -0,0 +1,388 @@
+"""Materialized home timelines for Warbler.
+
+Every user's home timeline is stored in `timeline_entries` and filled when a
+message is posted (fan-out-on-write), so reading it is a single range read.
+
+Authors with at least TIMELINE_FANOUT_LIMIT followers are not fanned out:
+writing one row per follower for them would be a write storm. Their messages
+are merged into each follower's timeline when it is read instead
+(fan-out-on-read). Whether a message was pushed is recorded on it
+(`Message.pushed`), and reads pull the unpushed messages of followed
+authors, so an author crossing the limit either way loses nothing: what was
+pushed stays pushed and what wasn't is still pulled. Authors with unpushed
+messages are flagged (`User.pulled`), so finding the ones a reader follows
+is one join, however many users they follow.
+
+Every message list is paged with a keyset cursor on (timestamp, id) rather
+than an offset, so the 1000th page costs the same as the first, and is built
+on `timeline_query()` so a page's authors are loaded together rather than
+one lazy load per message. The page functions also accept any other query
+over messages whose rows have `id` and `timestamp`, e.g. the column selects
+the JSON API pages without building Message objects (see api.py).
+"""
+
+from datetime import datetime
+from heapq import merge
+
+from sqlalchemy import and_, exists, literal, tuple_
+from sqlalchemy.orm import selectinload
+
+from models import db, Follows, Likes, Message, TimelineEntry, User
+
+DEFAULT_FANOUT_LIMIT = 10000
+DEFAULT_BACKFILL = 100
+DEFAULT_PAGE_SIZE = 20
+
+ENTRY_COLUMNS = ['user_id', 'message_id', 'timestamp']
+
+CURSOR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def fanout_limit():
+    """Follower count at which an author switches to fan-out-on-read."""
+
+    return db.get_app().config.get('TIMELINE_FANOUT_LIMIT',
+                                   DEFAULT_FANOUT_LIMIT)
+
+
+def backfill_size():
+    """How many recent messages a new follow copies into a timeline."""
+
+    return db.get_app().config.get('TIMELINE_BACKFILL', DEFAULT_BACKFILL)
+
+
+def page_size():
+    """Number of messages on one page of a message list."""
+
+    return db.get_app().config.get('TIMELINE_PAGE_SIZE', DEFAULT_PAGE_SIZE)
+
+
+def encode_cursor(msg):
+    """Cursor pointing just past `msg`, for `?before=`."""
+
+    return f"{msg.timestamp.strftime(CURSOR_TIME_FORMAT)}_{msg.id}"
+
+
+def decode_cursor(cursor):
+    """Parse a `?before=` cursor into (timestamp, id).
+
+    Raises ValueError if `cursor` is malformed.
+    """
+
+    timestamp, _, message_id = cursor.rpartition('_')
+    return (datetime.strptime(timestamp, CURSOR_TIME_FORMAT),
+            int(message_id))
+
+
+def timeline_query():
+    """Base query for a rendered list of messages.
+
+    Loads the authors of every message in the page with one batched
+    SELECT ... WHERE id IN (...), since each message shows its author.
+    """
+
+    return Message.query.options(selectinload(Message.user))
+
+
+def _keyset_page(query, timestamp_col, id_col, before, limit):
+    """Run `query` for the page of `limit` rows older than `before`.
+
+    Fetches one extra row to learn whether an older page exists.
+    """
+
+    if before:
+        query = query.filter(tuple_(timestamp_col, id_col) < tuple_(*before))
+
+    return (query
+            .order_by(timestamp_col.desc(), id_col.desc())
+            .limit(limit + 1)
+            .all())
+
+
+def _keyset_since(query, timestamp_col, id_col, after, limit):
+    """Run `query` for the `limit` + 1 rows just newer than `after`.
+
+    The rows come oldest first.
+    """
+
+    return (query
+            .filter(tuple_(timestamp_col, id_col) > tuple_(*after))
+            .order_by(timestamp_col, id_col)
+            .limit(limit + 1)
+            .all())
+
+
+def _paginate(rows, limit):
+    """Split fetched `rows` into (page, cursor for the next page or None)."""
+
+    if len(rows) > limit:
+        return rows[:limit], encode_cursor(rows[limit - 1])
+
+    return rows, None
+
+
+def popular_authors():
+    """Select ids of users with too many followers to fan out to."""
+
+    return db.select([User.id]).where(User.follower_count >= fanout_limit())
+
+
+def mark_pushed():
+    """Set `Message.pushed` by each author's follower count now.
+
+    Used by `rebuild_timelines`, which pushes exactly those messages. Sets
+    `User.pulled` to match.
+    """
+
+    messages = Message.__table__
+    users = User.__table__
+    popular = popular_authors()
+
+    db.session.execute(
+        messages.update()
+        .where(messages.c.pushed)
+        .where(messages.c.user_id.in_(popular))
+        .values(pushed=False))
+    db.session.execute(
+        messages.update()
+        .where(~messages.c.pushed)
+        .where(~messages.c.user_id.in_(popular))
+        .values(pushed=True))
+
+    unpushed = exists().where(and_(messages.c.user_id == users.c.id,
+                                   ~messages.c.pushed))
+    db.session.execute(users.update()
+                       .where(users.c.pulled != unpushed)
+                       .values(pulled=unpushed))
+
+
+def is_popular(user_id):
+    """Are `user_id`'s messages read at request time rather than pushed?"""
+
+    (follower_count,) = (db.session.query(User.follower_count)
+                         .filter(User.id == user_id)
+                         .one())
+    return follower_count >= fanout_limit()
+
+
+def followed_pulled_authors(user_id):
+    """Ids of users `user_id` follows who have messages that weren't pushed.
+
+    One query joining `user_id`'s follows with the pulled authors. Authors
+    whose unpushed messages have since been deleted may still be listed;
+    pulling from them finds nothing.
+    """
+
+    rows = (db.session.query(Follows.user_being_followed_id)
+            .join(User, User.id == Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == user_id, User.pulled))
+
+    return [user_id for (user_id,) in rows]
+
+
+def _insert_entries(rows):
+    """INSERT ... SELECT `rows` (user_id, message_id, timestamp) as entries."""
+
+    insert = TimelineEntry.__table__.insert()
+    db.session.execute(insert.from_select(ENTRY_COLUMNS, rows))
+
+
+def fan_out_message(msg):
+    """Add a newly flushed `msg` to its author's and followers' timelines."""
+
+    db.session.add(TimelineEntry(user_id=msg.user_id,
+                                 message_id=msg.id,
+                                 timestamp=msg.timestamp))
+
+    if is_popular(msg.user_id):
+        msg.pushed = False
+        db.session.execute(
+            User.__table__.update()
+            .where(User.id == msg.user_id)
+            .where(~User.pulled)
+            .values(pulled=True))
+        return
+
+    db.session.flush()
+    _insert_entries(
+        db.select([Follows.user_following_id,
+                   literal(msg.id),
+                   literal(msg.timestamp, db.DateTime)])
+        .where(Follows.user_being_followed_id == msg.user_id)
+        .where(Follows.user_following_id != msg.user_id))
+
+
+def remove_message(msg):
+    """Remove `msg` from every timeline it was fanned out to."""
+
+    (TimelineEntry.query
+     .filter(TimelineEntry.message_id == msg.id)
+     .delete(synchronize_session=False))
+
+
+def backfill_follow(follower_id, followed_id):
+    """Copy `followed_id`'s recent messages into `follower_id`'s timeline.
+
+    Only pushed messages are copied; the rest are pulled when it's read.
+    """
+
+    if follower_id == followed_id:
+        return
+
+    already_there = exists().where(and_(
+        TimelineEntry.user_id == follower_id,
+        TimelineEntry.message_id == Message.id))
+
+    _insert_entries(
+        db.select([literal(follower_id), Message.id, Message.timestamp])
+        .where(Message.user_id == followed_id)
+        .where(Message.pushed)
+        .where(~already_there)
+        .order_by(Message.timestamp.desc(), Message.id.desc())
+        .limit(backfill_size()))
+
+
+def trim_unfollow(follower_id, followed_id):
+    """Drop `followed_id`'s messages from `follower_id`'s timeline."""
+
+    if follower_id == followed_id:
+        return
+
+    authored = db.select([Message.id]).where(Message.user_id == followed_id)
+
+    (TimelineEntry.query
+     .filter(TimelineEntry.user_id == follower_id,
+             TimelineEntry.message_id.in_(authored))
+     .delete(synchronize_session=False))
+
+
+def home_timeline(user_id, before=None, limit=None, query=None):
+    """A page of `user_id`'s home timeline, older than cursor `before`.
+
+    Pushed entries come from one indexed range read on `timeline_entries`;
+    unpushed messages of followed authors are read from `messages` and
+    merged in by (timestamp, id). Returns (messages, next cursor or None).
+    `query` replaces `timeline_query()` as the base query of both reads.
+    """
+
+    limit = limit or page_size()
+    query = timeline_query() if query is None else query
+
+    pushed = _keyset_page(
+        query
+        .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+        .filter(TimelineEntry.user_id == user_id),
+        TimelineEntry.timestamp, TimelineEntry.message_id, before, limit)
+
+    authors = followed_pulled_authors(user_id)
+    if not authors:
+        return _paginate(pushed, limit)
+
+    pulled = _keyset_page(
+        query.filter(Message.user_id.in_(authors), ~Message.pushed),
+        Message.timestamp, Message.id, before, limit)
+
+    messages = []
+    seen = set()
+    newest_first = merge(pushed, pulled,
+                         key=lambda msg: (msg.timestamp, msg.id),
+                         reverse=True)
+
+    for msg in newest_first:
+        if msg.id not in seen:
+            seen.add(msg.id)
+            messages.append(msg)
+        if len(messages) > limit:
+            break
+
+    return _paginate(messages, limit)
+
+
+def home_timeline_since(user_id, after, limit=None, query=None):
+    """`user_id`'s home timeline messages newer than cursor `after`.
+
+    The counterpart of `home_timeline` for catching up: returns the oldest
+    `limit` + 1 such messages, oldest first, so a caller getting more than
+    `limit` knows it hasn't got them all.
+    """
+
+    limit = limit or page_size()
+    query = timeline_query() if query is None else query
+
+    pushed = _keyset_since(
+        query
+        .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+        .filter(TimelineEntry.user_id == user_id),
+        TimelineEntry.timestamp, TimelineEntry.message_id, after, limit)
+
+    authors = followed_pulled_authors(user_id)
+    if not authors:
+        return pushed
+
+    pulled = _keyset_since(
+        query.filter(Message.user_id.in_(authors), ~Message.pushed),
+        Message.timestamp, Message.id, after, limit)
+
+    messages = []
+    seen = set()
+    oldest_first = merge(pushed, pulled,
+                         key=lambda msg: (msg.timestamp, msg.id))
+
+    for msg in oldest_first:
+        if msg.id not in seen:
+            seen.add(msg.id)
+            messages.append(msg)
+        if len(messages) > limit:
+            break
+
+    return messages
+
+
+def user_messages(user_id, before=None, limit=None, query=None):
+    """A page of messages written by `user_id`, newest first."""
+
+    limit = limit or page_size()
+    query = timeline_query() if query is None else query
+
+    rows = _keyset_page(
+        query.filter(Message.user_id == user_id),
+        Message.timestamp, Message.id, before, limit)
+
+    return _paginate(rows, limit)
+
+
+def liked_messages(user_id, before=None, limit=None, query=None):
+    """A page of messages liked by `user_id`, newest first."""
+
+    limit = limit or page_size()
+    query = timeline_query() if query is None else query
+
+    rows = _keyset_page(
+        query
+        .join(Likes, Likes.message_id == Message.id)
+        .filter(Likes.user_id == user_id),
+        Message.timestamp, Message.id, before, limit)
+
+    return _paginate(rows, limit)
+
+
+def rebuild_timelines():
+    """Recompute every timeline from `messages` and `follows`.
+
+    Used after seeding or bulk loads; the caller commits. Messages of
+    authors who are popular now are left to be pulled (see `mark_pushed`).
+    """
+
+    TimelineEntry.query.delete(synchronize_session=False)
+    mark_pushed()
+
+    _insert_entries(
+        db.select([Message.user_id, Message.id, Message.timestamp]))
+
+    _insert_entries(
+        db.select([Follows.user_following_id, Message.id, Message.timestamp])
+        .select_from(Follows.__table__.join(
+            Message.__table__,
+            Follows.user_being_followed_id == Message.user_id))
+        .where(Follows.user_following_id != Message.user_id)
+        .where(Message.pushed))
@@ -0,0 +1,108 @@
+"""Cross-request cache of logged-in users' rows.
+
+Nearly every request needs the current user, so their columns are kept in
+process for a few seconds (CURRENT_USER_CACHE_TTL). A cache hit rebuilds the
+user as a detached instance and merges it into the session with
+`load=False`, which costs no SQL; relationships still lazy-load as usual.
+
+This process drops its entry when it edits or deletes the user, when one of
+its flushes changes their counters (see counters.py), and when the tables
+are dropped. Other processes don't hear about it: with several workers,
+another worker (or the purge job, see accounts.py) can leave a stale entry
+behind that is served until it expires. That means a profile, counters or
+an account disabled elsewhere can be up to CURRENT_USER_CACHE_TTL seconds
+out of date, so keep the TTL short.
+"""
+
+from threading import Lock
+from time import monotonic
+
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+
+from counters import counters_changed
+from models import db, User
+
+DEFAULT_TTL = 30
+DEFAULT_MAX_ENTRIES = 10000
+
+
+class UserCache:
+    """Short-lived in-process cache of User column values, keyed by id."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.entries = {}
+
+    def _config(self, key, default):
+        return db.get_app().config.get(key, default)
+
+    def get(self, user_id):
+        """The User with `user_id`, attached to the session.
+
+        None if the user is gone or disabled (see accounts.py).
+        """
+
+        existing = db.session.identity_map.get(identity_key(User, user_id))
+        if existing is not None:
+            return existing
+
+        with self.lock:
+            entry = self.entries.get(user_id)
+
+        if entry and entry[0] > monotonic():
+            user = User(**entry[1])
+            make_transient_to_detached(user)
+            return db.session.merge(user, load=False)
+
+        user = User.query.get(user_id)
+        if user is None or user.disabled_at is not None:
+            return None
+
+        self.put(user)
+        return user
+
+    def put(self, user):
+        """Remember `user`'s current column values."""
+
+        values = {attr.key: getattr(user, attr.key)
+                  for attr in User.__mapper__.column_attrs}
+        expires = monotonic() + self._config('CURRENT_USER_CACHE_TTL',
+                                             DEFAULT_TTL)
+        max_entries = self._config('CURRENT_USER_CACHE_SIZE',
+                                   DEFAULT_MAX_ENTRIES)
+
+        with self.lock:
+            if len(self.entries) >= max_entries:
+                now = monotonic()
+                self.entries = {key: entry for key, entry
+                                in self.entries.items() if entry[0] > now}
+            while len(self.entries) >= max_entries:
+                self.entries.pop(next(iter(self.entries)))
+
+            self.entries[user.id] = (expires, values)
+
+    def invalidate(self, *user_ids):
+        """Forget `user_ids` in this process only; see the module docs."""
+
+        with self.lock:
+            for user_id in user_ids:
+                self.entries.pop(user_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+current_users = UserCache()
+
+
+@counters_changed.connect
+def _forget_recounted(session, user_ids):
+    current_users.invalidate(*user_ids)
+
+
+@event.listens_for(db.Model.metadata, 'after_drop')
+def _forget_dropped(target, connection, **kw):
+    current_users.clear()